@@ -0,0 +1,425 @@
+# Tests for the examples, run against fakegateway so they don't need TWS or the IB gateway
+#
+# python -m unittest Test
+#
+
+import asyncio
+import calendar
+import datetime
+import time
+import unittest
+
+import numpy as np
+import pandas as pd
+
+from ibapi.common import BarData
+from ibapi.contract import Contract as IBcontract
+
+from fakegateway import fakeGateway
+import asyncapp
+import histpricetest
+import mkstream
+import placetrade
+
+
+def _stock(symbol):
+    ibcontract = IBcontract()
+    ibcontract.secType = "STK"
+    ibcontract.symbol = symbol
+    ibcontract.exchange = "SMART"
+    ibcontract.currency = "USD"
+
+    return ibcontract
+
+
+class resolveContractTest(unittest.TestCase):
+    """
+    resolve_ib_contract end to end, through each example TestApp
+    """
+
+    @classmethod
+    def setUpClass(cls):
+        cls.gateway = fakeGateway(port=0)
+        cls.gateway.add_contract(_stock("AAPL"), price=150.0)
+        cls.gateway.start()
+        cls.conId = cls.gateway.find_contracts(_stock("AAPL"))[0].ibcontract.conId
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.gateway.stop()
+
+    def _connect(self, test_app_class, clientid):
+        app = test_app_class("127.0.0.1", self.gateway.port, clientid)
+        self.addCleanup(app.disconnect)
+
+        return app
+
+    def test_histpricetest(self):
+        app = self._connect(histpricetest.TestApp, 1)
+
+        resolved_ibcontract = app.resolve_ib_contract(_stock("AAPL"))
+
+        self.assertEqual(resolved_ibcontract.conId, self.conId)
+        self.assertEqual(resolved_ibcontract.symbol, "AAPL")
+
+    def test_unknown_contract_comes_back_unresolved(self):
+        app = self._connect(histpricetest.TestApp, 2)
+
+        resolved_ibcontract = app.resolve_ib_contract(_stock("NOPE"))
+
+        self.assertEqual(resolved_ibcontract.conId, 0)
+
+    def test_bulk(self):
+        app = self._connect(histpricetest.TestApp, 3)
+
+        resolutions = dict(app.resolve_ib_contracts([_stock("AAPL"), _stock("NOPE")]))
+
+        self.assertEqual(resolutions[0].resolved_ibcontract().conId, self.conId)
+        self.assertTrue(resolutions[1].failed())
+        self.assertEqual(resolutions[1].error.errorCode, 200)
+
+    def test_async(self):
+        app = self._connect(histpricetest.TestApp, 4)
+
+        resolved_ibcontract = asyncio.run(asyncapp.asyncTestApp(app).resolve_ib_contract(_stock("AAPL")))
+
+        self.assertEqual(resolved_ibcontract.conId, self.conId)
+
+    def test_mkstream(self):
+        app = self._connect(mkstream.TestApp, 5)
+
+        self.assertEqual(app.resolve_ib_contract(_stock("AAPL")).conId, self.conId)
+
+    def test_placetrade(self):
+        app = self._connect(placetrade.TestApp, 6)
+
+        self.assertEqual(app.resolve_ib_contract(_stock("AAPL")).conId, self.conId)
+
+
+def _bar(bar_date, close):
+    bar = BarData()
+    bar.date = bar_date
+    bar.open = bar.high = bar.low = bar.close = close
+    bar.volume = 10
+    bar.average = close
+    bar.barCount = 2
+
+    return bar
+
+
+class historicalBarBufferTest(unittest.TestCase):
+
+    def test_grows_and_hands_over_all_the_bars(self):
+        historic_data_queue = histpricetest.historicalBarBuffer(initial_size=2)
+        for day in range(5):
+            historic_data_queue.add_bar(_bar("2026010%d" % (day + 5), 100.0 + day))
+        historic_data_queue.finish()
+
+        historic_data = historic_data_queue.get(timeout=0)
+
+        self.assertTrue(historic_data_queue.finished())
+        self.assertEqual(list(historic_data.columns), histpricetest.BAR_COLUMNS)
+        self.assertEqual(list(historic_data.close), [100.0, 101.0, 102.0, 103.0, 104.0])
+        self.assertEqual(historic_data.index[-1].strftime("%Y%m%d"), "20260109")
+
+    def test_later_bars_dont_change_what_weve_handed_over(self):
+        historic_data_queue = histpricetest.historicalBarBuffer(initial_size=2)
+        historic_data_queue.add_bar(_bar("20260105", 100.0))
+        historic_data = historic_data_queue.get(timeout=0)
+
+        historic_data_queue.add_bar(_bar("20260106", 200.0))
+
+        self.assertEqual(list(historic_data.close), [100.0])
+        self.assertEqual(len(historic_data_queue), 1)
+
+
+class historicalDataChunksTest(unittest.TestCase):
+
+    def test_whole_chunks_then_the_rest_in_days(self):
+        chunks = histpricetest._historical_data_chunks(datetime.datetime(2026, 1, 5, 12, 0),
+                                                       datetime.datetime(2026, 1, 8, 0, 0), "1 min")
+
+        self.assertEqual([durationStr for endDateTime_unused, durationStr in chunks], ["1 D", "1 D", "1 D"])
+        self.assertEqual([endDateTime[:17] for endDateTime, durationStr_unused in chunks],
+                         ["20260108 00:00:00", "20260107 00:00:00", "20260106 00:00:00"])
+
+    def test_short_bars_go_in_seconds(self):
+        chunks = histpricetest._historical_data_chunks(datetime.datetime(2026, 1, 5, 12, 0, 0),
+                                                       datetime.datetime(2026, 1, 5, 12, 40, 0), "1 secs")
+
+        self.assertEqual([durationStr for endDateTime_unused, durationStr in chunks], ["1800 S", "600 S"])
+        self.assertEqual(chunks[1][0][:17], "20260105 12:10:00")
+
+    def test_nothing_to_get(self):
+        a_datetime = datetime.datetime(2026, 1, 5)
+
+        self.assertEqual(histpricetest._historical_data_chunks(a_datetime, a_datetime, "1 hour"), [])
+
+    def test_unknown_bar_size(self):
+        a_datetime = datetime.datetime(2026, 1, 5)
+
+        self.assertRaises(Exception, histpricetest._historical_data_chunks, a_datetime, a_datetime, "7 mins")
+
+
+def _bars(bar_times):
+    """
+    :param bar_times: list of str "yyyymmdd hh:mm", UTC
+    :return: pd.DataFrame as from get_IB_historical_data, with a close of 100, 101, 102...
+    """
+    closes = 100.0 + np.arange(len(bar_times))
+
+    return pd.DataFrame(dict(open=closes, high=closes + 1, low=closes - 1, close=closes,
+                             volume=np.full(len(bar_times), 10.0), wap=closes,
+                             barCount=np.full(len(bar_times), 2.0)),
+                        index=pd.DatetimeIndex(pd.to_datetime(bar_times), name="date"))[histpricetest.BAR_COLUMNS]
+
+
+def _labels(historic_data):
+    return [bar_time.strftime("%Y%m%d %H:%M") for bar_time in historic_data.index]
+
+
+class resampleTest(unittest.TestCase):
+
+    def test_intraday_bars_start_with_the_session(self):
+        historic_data = _bars(["20260105 14:30", "20260105 15:00", "20260105 15:30", "20260105 16:00",
+                               "20260106 14:30", "20260106 15:00"])
+
+        resampled_data = histpricetest.resample_historical_data(historic_data, "1 hour")
+
+        self.assertEqual(_labels(resampled_data), ["20260105 14:30", "20260105 15:00", "20260105 16:00",
+                                                   "20260106 14:30", "20260106 15:00"])
+        self.assertEqual(list(resampled_data.close), [100.0, 102.0, 103.0, 104.0, 105.0])
+        self.assertEqual(list(resampled_data.high), [101.0, 103.0, 104.0, 105.0, 106.0])
+        self.assertEqual(list(resampled_data.volume), [10.0, 20.0, 10.0, 10.0, 10.0])
+
+    def test_calendar_bars(self):
+        historic_data = _bars(["20260105 14:30", "20260105 20:30", "20260106 14:30", "20260113 14:30"])
+
+        daily_data = histpricetest.resample_historical_data(historic_data, "1 day")
+        weekly_data = histpricetest.resample_historical_data(historic_data, "1 week")
+        monthly_data = histpricetest.resample_historical_data(historic_data, "1 month")
+
+        self.assertEqual(_labels(daily_data), ["20260105 00:00", "20260106 00:00", "20260113 00:00"])
+        self.assertEqual(list(daily_data.open), [100.0, 102.0, 103.0])
+        self.assertEqual(list(daily_data.close), [101.0, 102.0, 103.0])
+        self.assertEqual(_labels(weekly_data), ["20260105 00:00", "20260112 00:00"])
+        self.assertEqual(_labels(monthly_data), ["20260101 00:00"])
+
+    def test_day_starts_the_evening_before(self):
+        historic_data = _bars(["20260105 22:00", "20260106 14:00"])
+
+        daily_data = histpricetest.resample_historical_data(historic_data, "1 day",
+                                                            day_starts_at=datetime.timedelta(hours=-7))
+
+        self.assertEqual(_labels(daily_data), ["20260106 00:00"])
+
+    def test_daily_bars_stay_on_their_day(self):
+        historic_data = _bars(["20260105 00:00", "20260106 00:00", "20260107 00:00"])
+        day_starts_at = datetime.timedelta(hours=9, minutes=30)
+
+        told = histpricetest.resample_historical_data(historic_data, "1 day", day_starts_at=day_starts_at,
+                                                      base_barSizeSetting="1 day")
+        worked_out = histpricetest.resample_historical_data(historic_data, "1 day", day_starts_at=day_starts_at)
+
+        self.assertEqual(_labels(told), ["20260105 00:00", "20260106 00:00", "20260107 00:00"])
+        self.assertEqual(_labels(worked_out), _labels(told))
+
+    def test_intraday_bar_at_midnight_isnt_a_daily_bar(self):
+        historic_data = _bars(["20260106 00:00"])
+
+        daily_data = histpricetest.resample_historical_data(historic_data, "1 day",
+                                                            day_starts_at=datetime.timedelta(hours=9, minutes=30),
+                                                            base_barSizeSetting="1 hour")
+
+        self.assertEqual(_labels(daily_data), ["20260105 00:00"])
+
+    def test_multiple_resolutions(self):
+        historic_data = _bars(["20260105 14:30", "20260105 15:00", "20260105 15:30"])
+        all_resolutions = histpricetest.multiResolutionHistoricalData(historic_data, "30 mins")
+
+        self.assertEqual(len(all_resolutions.get("1 hour")), 2)
+        self.assertIs(all_resolutions.get("1 hour"), all_resolutions.get("1 hour"))
+        self.assertRaises(Exception, all_resolutions.get, "45 mins")
+
+
+
+class historicalTicksTest(unittest.TestCase):
+    """
+    get_IB_historical_ticks, with pages served the way IB does: up to MAX_HISTORICAL_TICKS_PER_REQUEST ticks from
+       the start time, but always every tick in the last second
+    """
+
+    start_datetime = datetime.datetime(2026, 1, 5, 14, 30)
+    start_epoch = calendar.timegm(start_datetime.timetuple())
+
+    def _get_ticks(self, seconds_in, end_seconds_in):
+        """
+        :param seconds_in: list of int, when each tick was, in seconds after start_epoch
+        :param end_seconds_in: int, when to ask for ticks up to
+        :return: list of int, which ticks we got, in the order we got them
+        """
+
+        tick_times = self.start_epoch + np.array(seconds_in, dtype=np.int64)
+        page_size = histpricetest.MAX_HISTORICAL_TICKS_PER_REQUEST
+
+        def _get_historical_ticks_page(ibcontract_unused, page_start, whatToShow_unused):
+            page = np.flatnonzero(tick_times>=page_start)[:page_size]
+            if len(page)==page_size:
+                page = np.flatnonzero((tick_times>=page_start) & (tick_times<=tick_times[page[-1]]))
+
+            return pd.DataFrame(dict(price=page.astype(np.float64), size=np.ones(len(page), dtype=np.int64)),
+                                index=pd.DatetimeIndex(pd.to_datetime(tick_times[page], unit="s", utc=True),
+                                                       name="time"))
+
+        client = histpricetest.TestClient(histpricetest.TestWrapper())
+        client._get_historical_ticks_page = _get_historical_ticks_page
+
+        end_datetime = self.start_datetime + datetime.timedelta(seconds=end_seconds_in)
+        pages = list(client.get_IB_historical_ticks(None, self.start_datetime, end_datetime, whatToShow="MIDPOINT"))
+
+        return [int(price) for page in pages for price in page.price]
+
+    def test_pages_which_end_part_way_through_a_second(self):
+        seconds_in = [tick_number // 3 for tick_number in range(2500)]
+
+        self.assertEqual(self._get_ticks(seconds_in, 1000), list(range(2500)))
+
+    def test_more_than_a_page_in_one_second(self):
+        seconds_in = [0] * 2500 + [1] * 10
+
+        self.assertEqual(self._get_ticks(seconds_in, 1000), list(range(2510)))
+
+    def test_stops_at_the_end(self):
+        seconds_in = list(range(3000))
+
+        self.assertEqual(self._get_ticks(seconds_in, 1500), list(range(1501)))
+
+    def test_no_ticks(self):
+        self.assertEqual(self._get_ticks([], 1000), [])
+
+
+class timezoneTest(unittest.TestCase):
+
+    def test_local_bar_times_end_up_in_utc(self):
+        historic_data_queue = histpricetest.historicalBarBuffer(tws_timezone="US/Eastern")
+        historic_data_queue.add_bar(_bar("20260105  09:30:00", 100.0))
+        historic_data_queue.add_bar(_bar("20260706  09:30:00", 101.0))
+        historic_data_queue.add_bar(_bar("1767627000", 102.0))
+        historic_data_queue.finish()
+
+        historic_data = historic_data_queue.get(timeout=0)
+
+        self.assertEqual(str(historic_data.index.tz), "UTC")
+        self.assertEqual(_labels(historic_data), ["20260105 14:30", "20260706 13:30", "20260105 15:30"])
+
+    def test_daily_bars_stay_on_their_day(self):
+        historic_data = _bars(["20260330 00:00", "20260331 00:00", "20260401 00:00"])
+
+        daily_data = histpricetest.resample_historical_data(historic_data, "1 day", base_barSizeSetting="1 day",
+                                                            timezone="US/Eastern")
+        monthly_data = histpricetest.resample_historical_data(historic_data, "1 month", timezone="US/Eastern")
+
+        self.assertEqual(_labels(daily_data), ["20260330 00:00", "20260331 00:00", "20260401 00:00"])
+        self.assertEqual(_labels(monthly_data), ["20260301 00:00", "20260401 00:00"])
+
+    def test_intraday_bars_go_by_the_exchange_clock(self):
+        historic_data = _bars(["20260106 00:00"])
+
+        daily_data = histpricetest.resample_historical_data(historic_data, "1 day", base_barSizeSetting="1 hour",
+                                                            timezone="US/Eastern")
+        hourly_data = histpricetest.resample_historical_data(_bars(["20260105 14:30", "20260105 15:00"]), "1 hour",
+                                                             timezone="US/Eastern")
+
+        self.assertEqual(_labels(daily_data), ["20260105 00:00"])
+        self.assertEqual(_labels(hourly_data), ["20260105 14:30", "20260105 15:00"])
+
+
+def _ring_buffer(capacity, tick_count):
+    ## tick n has timestamp n and value n
+    tick_buffer = mkstream.tickRingBuffer(capacity)
+    for tick_number in range(tick_count):
+        tick_buffer.append(tick_number, 1, float(tick_number))
+
+    return tick_buffer
+
+
+class tickRingBufferTest(unittest.TestCase):
+
+    def test_read_wraps_round(self):
+        tick_buffer = _ring_buffer(8, 10)
+
+        ticks, cursor = tick_buffer.read(5)
+
+        self.assertEqual(list(ticks.values), [5.0, 6.0, 7.0, 8.0, 9.0])
+        self.assertEqual(list(ticks.timestamps), [5, 6, 7, 8, 9])
+        self.assertEqual(ticks.ticks_lost, 0)
+        self.assertEqual(cursor, 10)
+
+    def test_overwritten_ticks_are_counted_as_lost(self):
+        tick_buffer = _ring_buffer(8, 20)
+
+        ticks, cursor = tick_buffer.read(3)
+
+        self.assertEqual(len(ticks) + ticks.ticks_lost, 20 - 3)
+        self.assertGreaterEqual(ticks.ticks_lost, 20 - 8 - 3)
+        self.assertEqual(list(ticks.values), [float(tick_number) for tick_number in range(20 - len(ticks), 20)])
+        self.assertEqual(cursor, 20)
+
+    def test_take_only_gets_new_ticks(self):
+        tick_buffer = _ring_buffer(8, 3)
+        first_ticks = tick_buffer.take()
+
+        for tick_number in range(3, 5):
+            tick_buffer.append(tick_number, 2, float(tick_number))
+
+        self.assertEqual(list(first_ticks.values), [0.0, 1.0, 2.0])
+        self.assertEqual(list(tick_buffer.take().fields), [2, 2])
+        self.assertEqual(len(tick_buffer.take()), 0)
+
+    def test_slicing(self):
+        ticks, cursor_unused = _ring_buffer(8, 20).read(0)
+
+        some_ticks = ticks[1:3]
+
+        self.assertIsInstance(some_ticks, mkstream.stream_of_ticks)
+        self.assertEqual(list(some_ticks.values), list(ticks.values[1:3]))
+        self.assertEqual(some_ticks.ticks_lost, 0)
+        self.assertEqual(ticks[:2].ticks_lost, ticks.ticks_lost)
+        self.assertEqual(ticks[-1].bid_price, 19.0)
+
+
+class marketDataTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.gateway = fakeGateway(port=0, ticks_per_second=50)
+        cls.gateway.add_contract(_stock("AAPL"), price=150.0)
+        cls.gateway.start()
+        cls.ibcontract = cls.gateway.find_contracts(_stock("AAPL"))[0].ibcontract
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.gateway.stop()
+
+    def setUp(self):
+        self.app = mkstream.TestApp("127.0.0.1", self.gateway.port, 10)
+        self.addCleanup(self.app.disconnect)
+
+    def test_resubscribe(self):
+        tickerid = self.app.start_getting_IB_market_data(self.ibcontract)
+        self.app.stop_getting_IB_market_data(tickerid)
+        self.app.start_getting_IB_market_data(self.ibcontract, tickerid=tickerid)
+
+        self.assertGreaterEqual(len(self.app.get_IB_market_data(tickerid, min_new_ticks=5, timeout=5)), 5)
+
+    def test_reuse_tickerid_after_error(self):
+        ## no tickReqParams comes for a request that fails, so this is the one that could get out of step
+        self.app.start_getting_IB_market_data(_stock("NOPE"), tickerid=42)
+        time.sleep(0.5)
+        self.app.stop_getting_IB_market_data(42)
+        self.app.start_getting_IB_market_data(self.ibcontract, tickerid=42)
+
+        self.assertGreaterEqual(len(self.app.get_IB_market_data(42, min_new_ticks=5, timeout=5)), 5)
+
+if __name__ == '__main__':
+    unittest.main()
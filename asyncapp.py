@@ -0,0 +1,345 @@
+# asyncio facade over the TestApp examples
+#
+# The TestApp methods block a thread until the wrapper has finished with a request. Here the request is sent
+#    from the event loop, and the wrapper (running in the EClient.run thread) completes an asyncio future via
+#    call_soon_threadsafe when the End callback arrives. So a request in flight costs a coroutine, not an OS thread.
+#
+# Works with any TestApp which has the relevant methods, eg histpricetest.TestApp for contracts and prices,
+#    getposition.TestApp for positions, placetrade.TestApp for orders and executions
+#
+
+import asyncio
+
+from ibapi.execution import ExecutionFilter
+
+from placetrade import list_of_orderInformation, list_of_execInformation
+from histpricetest import REFERENCE_DATA_PRIORITY, contract_from_details
+
+## same as the blocking versions
+MAX_WAIT_SECONDS = 10
+MAX_WAIT_SECONDS_OPEN_ORDERS = 5
+
+
+class asyncTestApp(object):
+    """
+    Wraps a connected TestApp, exposing coroutine versions of the request methods
+    """
+
+    def __init__(self, app):
+        self._app = app
+
+    async def _wait_until_finished(self, finishable_queue, timeout):
+        """
+        Wait for the wrapper to finish the queue, without blocking the event loop
+
+        :param finishable_queue: finishableQueue the wrapper is putting data into
+        :param timeout: overall deadline in seconds
+        :return: list of queue elements; status is set on the queue as with finishableQueue.get
+        """
+
+        loop = asyncio.get_running_loop()
+        finished_future = loop.create_future()
+
+        def _set_finished():
+            ## runs in the event loop
+            if not finished_future.done():
+                finished_future.set_result(True)
+
+        def _call_from_wrapper_thread():
+            try:
+                loop.call_soon_threadsafe(_set_finished)
+            except RuntimeError:
+                ## event loop has been closed, nobody is waiting any more
+                pass
+
+        finishable_queue.add_done_callback(_call_from_wrapper_thread)
+
+        try:
+            await asyncio.wait_for(finished_future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+        ## nothing left to wait for, this just collects what has arrived and sets the status
+        return finishable_queue.get(timeout=0)
+
+    async def _wait_for_bars(self, historic_data_queue, timeout):
+        """
+        Wait until historic_data_queue has bars for get_block, or is finished, without blocking the event loop
+        """
+
+        loop = asyncio.get_running_loop()
+        bars_future = loop.create_future()
+
+        def _set_bars():
+            if not bars_future.done():
+                bars_future.set_result(True)
+
+        def _call_from_wrapper_thread():
+            try:
+                loop.call_soon_threadsafe(_set_bars)
+            except RuntimeError:
+                pass
+
+        historic_data_queue.add_data_callback(_call_from_wrapper_thread)
+
+        try:
+            await asyncio.wait_for(bars_future, timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def _wait_until_sent(self, pacing_ticket):
+        """
+        Wait for the pacing scheduler to send a request, without blocking the event loop; raises whatever the send
+        function raised, if it did
+        """
+
+        loop = asyncio.get_running_loop()
+        sent_future = loop.create_future()
+
+        def _set_sent():
+            if not sent_future.done():
+                sent_future.set_result(True)
+
+        def _call_from_scheduler_thread():
+            try:
+                loop.call_soon_threadsafe(_set_sent)
+            except RuntimeError:
+                pass
+
+        pacing_ticket.add_sent_callback(_call_from_scheduler_thread)
+
+        await sent_future
+
+        if pacing_ticket.error is not None:
+            raise pacing_ticket.error
+
+    def _print_errors(self):
+        app = self._app
+        while app.is_error():
+            print(app.get_error())
+
+    async def resolve_ib_contract(self, ibcontract, reqId=None):
+        """
+        From a partially formed contract, returns a fully fledged version
+
+        :returns fully resolved IB contract
+        """
+
+        app = self._app
+
+        ## only histpricetest.TestApp has a contract cache
+        contract_cache = getattr(app, "_contract_cache", None)
+
+        new_contract_details = None
+        if contract_cache is not None:
+            new_contract_details = contract_cache.get(ibcontract)
+
+        if new_contract_details is None:
+            reqId, contract_details_queue = app._requests.new_request(reqId=reqId)
+
+            ## histpricetest.TestApp sends it via the pacing scheduler
+            pacing = getattr(app, "_pacing", None)
+            if pacing is None:
+                app.reqContractDetails(reqId, ibcontract)
+            else:
+                try:
+                    await self._wait_until_sent(pacing.submit(lambda: app.reqContractDetails(reqId, ibcontract),
+                                                              [("messages",)], priority=REFERENCE_DATA_PRIORITY))
+                except Exception:
+                    app._requests.release(reqId)
+                    raise
+
+            new_contract_details = await self._wait_until_finished(contract_details_queue, MAX_WAIT_SECONDS)
+            app._requests.release(reqId)
+
+            self._print_errors()
+
+            if contract_details_queue.timed_out():
+                print("Exceeded maximum wait for wrapper to confirm finished")
+
+            if contract_details_queue.failed():
+                print(contract_details_queue.error)
+
+            if contract_cache is not None and contract_details_queue.finished() and len(new_contract_details)>0:
+                contract_cache.put(ibcontract, new_contract_details)
+
+        if len(new_contract_details)==0:
+            print("Failed to get additional contract details: returning unresolved contract")
+            return ibcontract
+
+        if len(new_contract_details)>1:
+            print("got multiple contracts using first one")
+
+        return contract_from_details(new_contract_details[0])
+
+    async def get_IB_historical_data(self, ibcontract, durationStr="1 Y", barSizeSetting="1 day",
+                                     tickerid=None):
+        """
+        Returns historical prices for a contract, up to today
+
+        :returns pd.DataFrame indexed by date, columns open high low close volume wap barCount
+        """
+
+        app = self._app
+        tickerid, historic_data_queue, pacing_ticket = app._request_historical_data(ibcontract, durationStr,
+                                                                                    barSizeSetting, tickerid)
+
+        ## The pacing scheduler might hold the request back; the clock starts once it's gone
+        try:
+            await self._wait_until_sent(pacing_ticket)
+        except Exception:
+            app._requests.release(tickerid)
+            raise
+
+        historic_data = await self._wait_until_finished(historic_data_queue, MAX_WAIT_SECONDS)
+
+        self._print_errors()
+
+        if historic_data_queue.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished")
+
+        if historic_data_queue.failed():
+            print(historic_data_queue.error)
+
+        if historic_data_queue.partial():
+            print("Only got %d bars before giving up: data is incomplete" % len(historic_data))
+
+        app.cancelHistoricalData(tickerid)
+        app._requests.release(tickerid)
+
+        return historic_data
+
+    async def iterate_IB_historical_data(self, ibcontract, durationStr="1 Y", barSizeSetting="1 day",
+                                         whatToShow="TRADES"):
+        """
+        Historical prices for a contract, up to today, in blocks as they arrive rather than all at the end
+
+        An async generator; nothing is taken off the queue until we're asked for the next block. If the request
+           fails or times out, it raises an Exception.
+
+        :returns yields pd.DataFrame indexed by date, columns open high low close volume wap barCount
+        """
+
+        app = self._app
+        tickerid, historic_data_queue, pacing_ticket = app._request_historical_data(ibcontract, durationStr,
+                                                                                    barSizeSetting,
+                                                                                    whatToShow=whatToShow)
+
+        try:
+            await self._wait_until_sent(pacing_ticket)
+
+            finished = False
+            while not finished:
+                await self._wait_for_bars(historic_data_queue, MAX_WAIT_SECONDS)
+
+                ## same as the blocking version, but we've already done the waiting
+                historic_data, finished = app._take_historical_block(historic_data_queue, timeout=0)
+                if len(historic_data)>0:
+                    yield historic_data
+
+        finally:
+            ## we might have been stopped early
+            app._finish_historical_request(tickerid, historic_data_queue, pacing_ticket)
+
+    async def get_current_positions(self):
+        """
+        Current positions held
+
+        :return: list of tuples account, contract, position, avgCost
+        """
+
+        app = self._app
+        positions_queue = app.init_positions()
+
+        app.reqPositions()
+
+        positions_list = await self._wait_until_finished(positions_queue, MAX_WAIT_SECONDS)
+
+        self._print_errors()
+
+        if positions_queue.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished whilst getting positions")
+
+        return positions_list
+
+    async def get_open_orders(self):
+        """
+        Returns a dict of any open orders, keys are orderids
+        """
+
+        app = self._app
+        open_orders_queue = app.init_open_orders()
+
+        app.reqAllOpenOrders()
+
+        open_orders_list = list_of_orderInformation(
+            await self._wait_until_finished(open_orders_queue, MAX_WAIT_SECONDS_OPEN_ORDERS))
+
+        self._print_errors()
+
+        if open_orders_queue.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished whilst getting orders")
+
+        return open_orders_list.merged_dict()
+
+    async def get_executions_and_commissions(self, reqId=None, execution_filter=None):
+        """
+        Returns a dict of all executions done today with commission data, keys are execids
+        """
+
+        if execution_filter is None:
+            execution_filter = ExecutionFilter()
+
+        app = self._app
+        reqId, execution_queue = app._requests.new_request(reqId=reqId)
+
+        app.reqExecutions(reqId, execution_filter)
+
+        exec_list = list_of_execInformation(await self._wait_until_finished(execution_queue, MAX_WAIT_SECONDS))
+        app._requests.release(reqId)
+
+        self._print_errors()
+
+        if execution_queue.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished whilst getting exec / commissions")
+
+        if execution_queue.failed():
+            print(execution_queue.error)
+
+        ## Commissions will arrive seperately. We get all of them, but will only use those relevant for us
+        commissions = app._all_commissions()
+
+        return exec_list.blended_dict(commissions)
+
+
+if __name__ == '__main__':
+
+    from ibapi.contract import Contract as IBcontract
+    from histpricetest import TestApp
+
+    async def main():
+        app = TestApp("127.0.0.1", 4001, 1)
+        async_app = asyncTestApp(app)
+
+        ibcontracts = []
+        for expiry in ["201809", "201812", "201903"]:
+            ibcontract = IBcontract()
+            ibcontract.secType = "FUT"
+            ibcontract.lastTradeDateOrContractMonth = expiry
+            ibcontract.symbol = "GE"
+            ibcontract.exchange = "GLOBEX"
+            ibcontracts.append(ibcontract)
+
+        ## all of these are in flight at the same time
+        resolved_ibcontracts = await asyncio.gather(*[async_app.resolve_ib_contract(ibcontract)
+                                                      for ibcontract in ibcontracts])
+
+        all_historic_data = await asyncio.gather(*[async_app.get_IB_historical_data(resolved_ibcontract)
+                                                   for resolved_ibcontract in resolved_ibcontracts])
+
+        for historic_data in all_historic_data:
+            print(historic_data[:5])
+
+        app.disconnect()
+
+    asyncio.run(main())
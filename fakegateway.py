@@ -0,0 +1,1106 @@
+# A stand in for TWS / IB Gateway, so the examples can run without a live connection
+#
+# It speaks enough of the socket protocol for the requests these examples make: contract details, historical bars
+#    and ticks, streaming and snapshot market data, orders with their status / execution / commission messages,
+#    positions and account updates. Prices are made up, but always the same for the same contract and time, and
+#    anything can be scripted instead.
+#
+#    gateway = fakeGateway(port=4001)
+#    gateway.add_contract(ibcontract, price=97.0)
+#    gateway.start()
+#
+#    app = TestApp("127.0.0.1", 4001, 1)   ## unchanged
+#    ...
+#    gateway.stop()
+#
+# Or run this file to leave one listening on 127.0.0.1:4001
+#
+
+from ibapi.comm import make_field, make_msg, read_fields
+from ibapi.message import IN, OUT
+from ibapi.contract import Contract as IBcontract
+from ibapi.order import Order
+from ibapi.server_versions import MIN_SERVER_VER_HISTORICAL_TICKS
+
+from threading import Thread, Lock, Event
+
+import calendar
+import datetime
+import math
+import random
+import socket
+import struct
+import time
+
+## High enough for keepUpToDate and historical ticks; every version after this adds fields we'd have to send
+FAKE_SERVER_VERSION = MIN_SERVER_VER_HISTORICAL_TICKS
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 4001
+DEFAULT_ACCOUNT = "DU0000001"
+DEFAULT_TICKS_PER_SECOND = 4.0
+DEFAULT_COMMISSION = 2.0
+FIRST_ORDER_ID = 1
+FIRST_CONID = 100000
+
+## Don't generate silly numbers of bars if someone asks for 20 years of 1 sec bars
+MAX_BARS_PER_REQUEST = 100000
+
+## As TWS: at most this many historical ticks per request, though we finish off the last second
+MAX_HISTORICAL_TICKS_PER_REQUEST = 1000
+
+## Now and then a second is busy enough that its ticks won't fit in one request
+BUSY_SECOND_PROBABILITY = 0.002
+TICKS_IN_BUSY_SECOND = 1500
+
+## error codes we send back, as TWS does
+NO_SECURITY_DEFINITION_CODE = 200
+ORDER_CANCELLED_CODE = 202
+HISTORICAL_DATA_ERROR_CODE = 162
+ORDER_NOT_FOUND_CODE = 135
+COMBOS_NOT_SUPPORTED_CODE = 321
+
+## openOrder has ~110 fields, most of which are empty for a simple order. We fill in the ones that matter and pad
+##    the rest; these positions in the message are for FAKE_SERVER_VERSION and OPEN_ORDER_VERSION
+OPEN_ORDER_VERSION = 34
+OPEN_ORDER_STATUS_FIELD = 87
+OPEN_ORDER_FIELDS = 111
+
+## tick types
+BID_TICK = 1
+ASK_TICK = 2
+LAST_TICK = 4
+VOLUME_TICK = 8
+
+## tickReqParams snapshotPermissions: we let anyone have snapshots
+SNAPSHOT_PERMISSIONS = 3
+
+BAR_SECONDS = {"sec": 1, "secs": 1, "min": 60, "mins": 60, "hour": 3600, "hours": 3600, "day": 86400,
+               "days": 86400, "week": 7*86400, "weeks": 7*86400, "month": 30*86400, "months": 30*86400}
+DURATION_SECONDS = dict(S=1, D=86400, W=7*86400, M=30*86400, Y=365*86400)
+
+
+def _bar_seconds(barSizeSetting):
+    ## "1 day" -> 86400
+    number, unit = barSizeSetting.split()
+    return int(number) * BAR_SECONDS[unit]
+
+
+def _duration_seconds(durationStr):
+    ## "1 Y" -> 31536000
+    number, unit = durationStr.split()
+    return int(number) * DURATION_SECONDS[unit]
+
+
+def _parse_end_time(endDateTime):
+    """
+    :param endDateTime: "" for now, or "yyyymmdd hh:mm:ss", optionally with a timezone (ignored) or as yyyymmdd-hh:mm:ss
+    :return: epoch seconds, treating the time as UTC
+    """
+    if endDateTime=="":
+        return int(time.time())
+
+    end_time = datetime.datetime.strptime(endDateTime.replace("-", " ")[:17], "%Y%m%d %H:%M:%S")
+
+    return calendar.timegm(end_time.timetuple())
+
+
+def _format_bar_time(epoch, bar_seconds, formatDate):
+    ## Daily and longer bars are always yyyymmdd; intraday depends on formatDate
+    if bar_seconds>=86400:
+        return time.strftime("%Y%m%d", time.gmtime(epoch))
+
+    if formatDate==2:
+        return str(epoch)
+
+    return time.strftime("%Y%m%d  %H:%M:%S", time.gmtime(epoch))
+
+
+def _is_weekend(epoch):
+    return time.gmtime(epoch).tm_wday>=5
+
+
+def _read_contract(fields):
+    """
+    Read the contract fields that most requests start with, from an iterator over a client message
+
+    :return: IBcontract
+    """
+
+    ibcontract = IBcontract()
+    ibcontract.conId = int(next(fields) or 0)
+    ibcontract.symbol = next(fields)
+    ibcontract.secType = next(fields)
+    ibcontract.lastTradeDateOrContractMonth = next(fields)
+    ibcontract.strike = float(next(fields) or 0.0)
+    ibcontract.right = next(fields)
+    ibcontract.multiplier = next(fields)
+    ibcontract.exchange = next(fields)
+    ibcontract.primaryExchange = next(fields)
+    ibcontract.currency = next(fields)
+    ibcontract.localSymbol = next(fields)
+    ibcontract.tradingClass = next(fields)
+
+    return ibcontract
+
+
+class fakeContract(object):
+    """
+    A contract the gateway knows about, with its made up price
+    """
+
+    def __init__(self, ibcontract, price, min_tick, long_name):
+        self.ibcontract = ibcontract
+        self.min_tick = min_tick
+
+        ## price moves as we stream, but historical bars are always around where we started
+        self.price = price
+        self.base_price = price
+        self.long_name = long_name
+
+        ## what we've scripted with fakeGateway.set_historical_bars; keys are whatToShow
+        self.historical_bars = {}
+
+    def matches(self, ibcontract):
+        ## Every field filled in on the request has to agree; expiries can be given as just the month
+        if ibcontract.conId and ibcontract.conId!=self.ibcontract.conId:
+            return False
+
+        for field_name in ["symbol", "secType", "exchange", "currency", "right", "multiplier", "localSymbol"]:
+            requested = getattr(ibcontract, field_name)
+            if requested and requested!=getattr(self.ibcontract, field_name):
+                return False
+
+        if ibcontract.lastTradeDateOrContractMonth and \
+                not self.ibcontract.lastTradeDateOrContractMonth.startswith(ibcontract.lastTradeDateOrContractMonth):
+            return False
+
+        if ibcontract.strike and ibcontract.strike!=self.ibcontract.strike:
+            return False
+
+        return True
+
+    def round_price(self, price):
+        return round(round(price / self.min_tick) * self.min_tick, 8)
+
+    def bar(self, epoch, whatToShow):
+        """
+        Made up bar for the period starting at epoch; the same every time we're asked
+
+        :return: tuple open, high, low, close, volume, wap, count
+        """
+
+        bar_random = random.Random("%d %s %d" % (self.ibcontract.conId, whatToShow, epoch))
+
+        ## slow cycle, so charts look like something
+        mid = self.base_price * (1.0 + 0.05 * math.sin(epoch / (86400.0 * 20)))
+
+        open_price = mid * (1.0 + bar_random.uniform(-0.005, 0.005))
+        close_price = mid * (1.0 + bar_random.uniform(-0.005, 0.005))
+        high_price = max(open_price, close_price) * (1.0 + bar_random.uniform(0.0, 0.003))
+        low_price = min(open_price, close_price) * (1.0 - bar_random.uniform(0.0, 0.003))
+
+        if whatToShow=="TRADES":
+            volume = bar_random.randint(100, 10000)
+            count = max(1, volume // 10)
+        else:
+            volume = -1
+            count = -1
+
+        open_price, high_price, low_price, close_price = [self.round_price(price) for price in
+                                                          [open_price, high_price, low_price, close_price]]
+        wap = round((high_price + low_price + close_price) / 3.0, 8)
+
+        return (open_price, high_price, low_price, close_price, volume, wap, count)
+
+    def ticks(self, epoch, whatToShow):
+        """
+        Made up historical ticks for the second starting at epoch; the same every time we're asked
+
+        :param whatToShow: "TRADES", "MIDPOINT" or "BID_ASK"
+        :return: list of tuples: price, size for TRADES and MIDPOINT; bid, ask, bid size, ask size for BID_ASK
+        """
+
+        tick_random = random.Random("%d %s %d ticks" % (self.ibcontract.conId, whatToShow, epoch))
+
+        if tick_random.random()<BUSY_SECOND_PROBABILITY:
+            tick_count = TICKS_IN_BUSY_SECOND
+        else:
+            tick_count = tick_random.randint(0, 3)
+
+        mid = self.base_price * (1.0 + 0.05 * math.sin(epoch / (86400.0 * 20)))
+
+        ticks = []
+        for tick_number_unused in range(tick_count):
+            price = self.round_price(mid * (1.0 + tick_random.uniform(-0.001, 0.001)))
+            if whatToShow=="BID_ASK":
+                ticks.append((price - self.min_tick, price + self.min_tick, tick_random.randint(1, 50),
+                              tick_random.randint(1, 50)))
+            elif whatToShow=="TRADES":
+                ticks.append((price, tick_random.randint(1, 500)))
+            else:
+                ticks.append((price, 0))
+
+        return ticks
+
+
+class fakeOrder(object):
+    """
+    An order someone has placed with us
+    """
+
+    def __init__(self, orderId, ibcontract, order, clientId, permId):
+        self.orderId = orderId
+        self.ibcontract = ibcontract
+        self.order = order
+        self.clientId = clientId
+        self.permId = permId
+
+        self.status = "Submitted"
+        self.filled = 0.0
+        self.avgFillPrice = 0.0
+        self.lastFillPrice = 0.0
+
+    def remaining(self):
+        return self.order.totalQuantity - self.filled
+
+    def is_open(self):
+        return self.status not in ["Filled", "Cancelled"]
+
+
+class fakeExecution(object):
+    def __init__(self, execId, orderId, ibcontract, side, shares, price, clientId, permId, cumQty, avgPrice,
+                 orderRef, exec_time, account, commission):
+        self.execId = execId
+        self.orderId = orderId
+        self.ibcontract = ibcontract
+        self.side = side
+        self.shares = shares
+        self.price = price
+        self.clientId = clientId
+        self.permId = permId
+        self.cumQty = cumQty
+        self.avgPrice = avgPrice
+        self.orderRef = orderRef
+        self.exec_time = exec_time
+        self.account = account
+        self.commission = commission
+
+
+class fakeGatewaySession(object):
+    """
+    One client connection. Reads requests in its own thread, and replies straight away from that thread apart from
+       streaming market data and historical updates, which come from the gateway's ticker thread
+    """
+
+    def __init__(self, gateway, client_socket):
+        self._gateway = gateway
+        self._socket = client_socket
+        self._send_lock = Lock()
+        self._buffer = b""
+
+        self.clientId = None
+        self.closed = False
+
+        ## tickerid -> fakeContract, for streaming prices
+        self.market_data = {}
+
+        ## reqId -> (fakeContract, bar_seconds, whatToShow), for historical requests with keepUpToDate
+        self.historical_updates = {}
+
+        self._handlers = {
+            OUT.START_API: self._start_api,
+            OUT.REQ_CONTRACT_DATA: self._req_contract_details,
+            OUT.REQ_HISTORICAL_DATA: self._req_historical_data,
+            OUT.CANCEL_HISTORICAL_DATA: self._cancel_historical_data,
+            OUT.REQ_HISTORICAL_TICKS: self._req_historical_ticks,
+            OUT.REQ_MKT_DATA: self._req_mkt_data,
+            OUT.CANCEL_MKT_DATA: self._cancel_mkt_data,
+            OUT.PLACE_ORDER: self._place_order,
+            OUT.CANCEL_ORDER: self._cancel_order,
+            OUT.REQ_GLOBAL_CANCEL: self._global_cancel,
+            OUT.REQ_OPEN_ORDERS: self._req_open_orders,
+            OUT.REQ_ALL_OPEN_ORDERS: self._req_open_orders,
+            OUT.REQ_EXECUTIONS: self._req_executions,
+            OUT.REQ_IDS: self._req_ids,
+            OUT.REQ_POSITIONS: self._req_positions,
+            OUT.REQ_ACCT_DATA: self._req_account_updates,
+            OUT.REQ_CURRENT_TIME: self._req_current_time,
+        }
+
+    ## wire format
+    def _read_exactly(self, size):
+        while len(self._buffer)<size:
+            data = self._socket.recv(65536)
+            if len(data)==0:
+                raise ConnectionError("client went away")
+            self._buffer += data
+
+        result = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+
+        return result
+
+    def _read_message(self):
+        size = struct.unpack("!I", self._read_exactly(4))[0]
+        return self._read_exactly(size)
+
+    def send(self, *fields):
+        ## One message, with fields in the order the decoder reads them
+        msg = make_msg("".join([make_field(field) for field in fields]))
+
+        with self._send_lock:
+            if self.closed:
+                return
+            try:
+                self._socket.sendall(msg)
+            except OSError:
+                self.closed = True
+
+    def send_error(self, reqId, errorCode, errorString):
+        self.send(IN.ERR_MSG, 2, reqId, errorCode, errorString)
+
+    def run(self):
+        try:
+            ## handshake: "API\0", then the range of versions the client can do; we reply with ours and the time
+            if self._read_exactly(4)!=b"API\0":
+                return
+            self._read_message()
+
+            self.send(FAKE_SERVER_VERSION, time.strftime("%Y%m%d %H:%M:%S GMT", time.gmtime()))
+
+            while True:
+                fields = [field.decode() for field in read_fields(self._read_message())]
+                if len(fields)==0:
+                    continue
+
+                handler = self._handlers.get(int(fields[0]), None)
+                if handler is None:
+                    ## anything we don't know about gets ignored, as TWS would for something we're not allowed
+                    continue
+
+                self._gateway.wait_before_responding()
+                try:
+                    handler(iter(fields[1:]))
+                except (StopIteration, ValueError):
+                    print("Fake gateway couldn't understand %s" % str(fields))
+
+        except (ConnectionError, OSError):
+            pass
+
+        finally:
+            self.close()
+
+    def close(self):
+        with self._send_lock:
+            self.closed = True
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+
+        self._gateway._session_closed(self)
+
+    ## connection
+    def _start_api(self, fields):
+        next(fields)
+        self.clientId = int(next(fields))
+
+        gateway = self._gateway
+        self.send(IN.NEXT_VALID_ID, 1, gateway.next_order_id())
+        self.send(IN.MANAGED_ACCTS, 1, gateway.account)
+
+    def _req_ids(self, fields):
+        self.send(IN.NEXT_VALID_ID, 1, self._gateway.next_order_id())
+
+    def _req_current_time(self, fields):
+        self.send(IN.CURRENT_TIME, 1, int(time.time()))
+
+    ## contract details
+    def _req_contract_details(self, fields):
+        next(fields)
+        reqId = int(next(fields))
+        ibcontract = _read_contract(fields)
+
+        matching_contracts = self._gateway.find_contracts(ibcontract)
+        if len(matching_contracts)==0:
+            self.send_error(reqId, NO_SECURITY_DEFINITION_CODE,
+                            "No security definition has been found for the request")
+            return
+
+        for fake_contract in matching_contracts:
+            self.send_contract_details(reqId, fake_contract)
+
+        self.send(IN.CONTRACT_DATA_END, 1, reqId)
+
+    def send_contract_details(self, reqId, fake_contract):
+        ibcontract = fake_contract.ibcontract
+
+        self.send(IN.CONTRACT_DATA, 8, reqId, ibcontract.symbol, ibcontract.secType,
+                  ibcontract.lastTradeDateOrContractMonth, ibcontract.strike, ibcontract.right, ibcontract.exchange,
+                  ibcontract.currency, ibcontract.localSymbol, ibcontract.tradingClass, ibcontract.tradingClass,
+                  ibcontract.conId, fake_contract.min_tick, 1, ibcontract.multiplier, "LMT,MKT,STP",
+                  ibcontract.exchange, 1, 0, fake_contract.long_name, ibcontract.primaryExchange,
+                  ibcontract.lastTradeDateOrContractMonth[:6], "", "", "", "UTC", "", "", "", 0,
+                  ## no sec ids, aggGroup, underlying symbol and sec type, market rules
+                  0, 0, "", "", "")
+
+    ## historical data
+    def _req_historical_data(self, fields):
+        reqId = int(next(fields))
+        ibcontract = _read_contract(fields)
+        next(fields) # includeExpired
+        endDateTime = next(fields)
+        barSizeSetting = next(fields)
+        durationStr = next(fields)
+        next(fields) # useRTH
+        whatToShow = next(fields)
+        formatDate = int(next(fields))
+        if ibcontract.secType=="BAG":
+            self.send_error(reqId, COMBOS_NOT_SUPPORTED_CODE, "Fake gateway doesn't do combos")
+            return
+        keepUpToDate = next(fields)=="1"
+
+        matching_contracts = self._gateway.find_contracts(ibcontract)
+        if len(matching_contracts)==0:
+            self.send_error(reqId, NO_SECURITY_DEFINITION_CODE,
+                            "No security definition has been found for the request")
+            return
+
+        fake_contract = matching_contracts[0]
+
+        try:
+            bars = self._gateway.historical_bars(fake_contract, endDateTime, durationStr, barSizeSetting,
+                                                 whatToShow, formatDate)
+        except (ValueError, KeyError):
+            self.send_error(reqId, HISTORICAL_DATA_ERROR_CODE,
+                            "Historical Market Data Service error message:invalid duration or bar size")
+            return
+
+        if len(bars)==0 and not keepUpToDate:
+            ## as TWS does, eg for a weekend
+            self.send_error(reqId, HISTORICAL_DATA_ERROR_CODE,
+                            "Historical Market Data Service error message:HMDS query returned no data: %s@%s %s" %
+                            (fake_contract.ibcontract.symbol, fake_contract.ibcontract.exchange, whatToShow))
+            return
+
+        message = [IN.HISTORICAL_DATA, reqId]
+        if len(bars)>0:
+            message += [bars[0][0], bars[-1][0]]
+        else:
+            message += ["", ""]
+        message.append(len(bars))
+        for bar in bars:
+            message += list(bar)
+
+        self.send(*message)
+
+        if keepUpToDate:
+            self.historical_updates[reqId] = (fake_contract, _bar_seconds(barSizeSetting), whatToShow, formatDate)
+
+    def _cancel_historical_data(self, fields):
+        next(fields)
+        reqId = int(next(fields))
+        self.historical_updates.pop(reqId, None)
+
+    def send_historical_update(self, reqId, fake_contract, bar_seconds, whatToShow, formatDate):
+        ## the bar we're part way through, with the latest price as the close
+        now = int(time.time())
+        bar_start = now - now % bar_seconds
+        (open_price, high_price, low_price, close_price, volume, wap, count) = fake_contract.bar(bar_start,
+                                                                                                 whatToShow)
+        close_price = fake_contract.price
+        high_price = max(high_price, close_price)
+        low_price = min(low_price, close_price)
+
+        self.send(IN.HISTORICAL_DATA_UPDATE, reqId, count, _format_bar_time(bar_start, bar_seconds, formatDate),
+                  open_price, close_price, high_price, low_price, wap, volume)
+
+    def _req_historical_ticks(self, fields):
+        reqId = int(next(fields))
+        ibcontract = _read_contract(fields)
+        next(fields) # includeExpired
+        startDateTime = next(fields)
+        endDateTime = next(fields)
+        numberOfTicks = int(next(fields))
+        whatToShow = next(fields)
+
+        matching_contracts = self._gateway.find_contracts(ibcontract)
+        if len(matching_contracts)==0:
+            self.send_error(reqId, NO_SECURITY_DEFINITION_CODE,
+                            "No security definition has been found for the request")
+            return
+
+        if (startDateTime=="")==(endDateTime==""):
+            self.send_error(reqId, HISTORICAL_DATA_ERROR_CODE,
+                            "Historical Market Data Service error message:exactly one of start and end")
+            return
+
+        if whatToShow not in ["TRADES", "MIDPOINT", "BID_ASK"]:
+            self.send_error(reqId, HISTORICAL_DATA_ERROR_CODE,
+                            "Historical Market Data Service error message:invalid what to show")
+            return
+
+        ticks = self._gateway.historical_ticks(matching_contracts[0], startDateTime, endDateTime,
+                                               min(numberOfTicks, MAX_HISTORICAL_TICKS_PER_REQUEST), whatToShow)
+
+        ## every tick has a mask for its attributes, except MIDPOINT which has an empty field there
+        if whatToShow=="TRADES":
+            message = [IN.HISTORICAL_TICKS_LAST, reqId, len(ticks)]
+            for tick_time, (price, size) in ticks:
+                message += [tick_time, 0, price, size, "ISLAND", ""]
+        elif whatToShow=="BID_ASK":
+            message = [IN.HISTORICAL_TICKS_BID_ASK, reqId, len(ticks)]
+            for tick_time, (bid, ask, bid_size, ask_size) in ticks:
+                message += [tick_time, 0, bid, ask, bid_size, ask_size]
+        else:
+            message = [IN.HISTORICAL_TICKS, reqId, len(ticks)]
+            for tick_time, (price, size) in ticks:
+                message += [tick_time, "", price, size]
+
+        message.append(1) # done
+        self.send(*message)
+
+    ## market data
+    def _req_mkt_data(self, fields):
+        next(fields)
+        tickerid = int(next(fields))
+        ibcontract = _read_contract(fields)
+        if ibcontract.secType=="BAG":
+            self.send_error(tickerid, COMBOS_NOT_SUPPORTED_CODE, "Fake gateway doesn't do combos")
+            return
+        if next(fields)=="1":
+            ## delta neutral contract
+            next(fields)
+            next(fields)
+            next(fields)
+        next(fields) # generic tick list
+        snapshot = next(fields)=="1"
+
+        matching_contracts = self._gateway.find_contracts(ibcontract)
+        if len(matching_contracts)==0:
+            self.send_error(tickerid, NO_SECURITY_DEFINITION_CODE,
+                            "No security definition has been found for the request")
+            return
+
+        fake_contract = matching_contracts[0]
+
+        ## like TWS, every subscription starts with one of these
+        self.send(IN.TICK_REQ_PARAMS, tickerid, fake_contract.min_tick, "", SNAPSHOT_PERMISSIONS)
+
+        if snapshot:
+            self.send_ticks(tickerid, fake_contract)
+            self.send(IN.TICK_SNAPSHOT_END, 1, tickerid)
+        else:
+            self.market_data[tickerid] = fake_contract
+
+    def _cancel_mkt_data(self, fields):
+        next(fields)
+        tickerid = int(next(fields))
+        self.market_data.pop(tickerid, None)
+
+    def send_ticks(self, tickerid, fake_contract):
+        price = fake_contract.price
+        min_tick = fake_contract.min_tick
+        size = random.randint(1, 20)
+
+        self.send(IN.TICK_PRICE, 6, tickerid, BID_TICK, fake_contract.round_price(price - min_tick), size, 0)
+        self.send(IN.TICK_PRICE, 6, tickerid, ASK_TICK, fake_contract.round_price(price + min_tick), size, 0)
+        self.send(IN.TICK_PRICE, 6, tickerid, LAST_TICK, price, size, 0)
+        self.send(IN.TICK_SIZE, 6, tickerid, VOLUME_TICK, random.randint(1000, 100000))
+
+    ## orders
+    def _place_order(self, fields):
+        next(fields)
+        orderId = int(next(fields))
+        ibcontract = _read_contract(fields)
+        next(fields) # secIdType
+        next(fields) # secId
+
+        order = Order()
+        order.action = next(fields)
+        order.totalQuantity = float(next(fields))
+        order.orderType = next(fields)
+        order.lmtPrice = float(next(fields) or 0.0)
+        order.auxPrice = float(next(fields) or 0.0)
+        order.tif = next(fields)
+        order.ocaGroup = next(fields)
+        order.account = next(fields)
+        order.openClose = next(fields)
+        order.origin = int(next(fields) or 0)
+        order.orderRef = next(fields)
+
+        matching_contracts = self._gateway.find_contracts(ibcontract)
+        if len(matching_contracts)==0:
+            self.send_error(orderId, NO_SECURITY_DEFINITION_CODE,
+                            "No security definition has been found for the request")
+            return
+
+        self._gateway.place_order(self, orderId, matching_contracts[0], order)
+
+    def _cancel_order(self, fields):
+        next(fields)
+        orderId = int(next(fields))
+        self._gateway.cancel_order(self, orderId)
+
+    def _global_cancel(self, fields):
+        self._gateway.cancel_all_orders(self)
+
+    def _req_open_orders(self, fields):
+        for fake_order in self._gateway.open_orders():
+            self.send_open_order(fake_order)
+            self.send_order_status(fake_order)
+
+        self.send(IN.OPEN_ORDER_END, 1)
+
+    def send_open_order(self, fake_order):
+        ibcontract = fake_order.ibcontract
+        order = fake_order.order
+
+        message = [IN.OPEN_ORDER, OPEN_ORDER_VERSION, fake_order.orderId, ibcontract.conId, ibcontract.symbol,
+                   ibcontract.secType, ibcontract.lastTradeDateOrContractMonth, ibcontract.strike, ibcontract.right,
+                   ibcontract.multiplier, ibcontract.exchange, ibcontract.currency, ibcontract.localSymbol,
+                   ibcontract.tradingClass, order.action, order.totalQuantity, order.orderType, order.lmtPrice,
+                   order.auxPrice, order.tif, order.ocaGroup, self._gateway.account, order.openClose, order.origin,
+                   order.orderRef, fake_order.clientId, fake_order.permId]
+
+        ## everything else is empty, apart from the order state
+        message += [""] * (OPEN_ORDER_STATUS_FIELD - len(message))
+        message.append(fake_order.status)
+        message += [""] * (OPEN_ORDER_FIELDS - len(message))
+
+        self.send(*message)
+
+    def send_order_status(self, fake_order):
+        self.send(IN.ORDER_STATUS, 6, fake_order.orderId, fake_order.status, fake_order.filled,
+                  fake_order.remaining(), fake_order.avgFillPrice, fake_order.permId, 0, fake_order.lastFillPrice,
+                  fake_order.clientId, "")
+
+    def send_execution(self, reqId, fake_execution):
+        ibcontract = fake_execution.ibcontract
+
+        self.send(IN.EXECUTION_DATA, 10, reqId, fake_execution.orderId, ibcontract.conId, ibcontract.symbol,
+                  ibcontract.secType, ibcontract.lastTradeDateOrContractMonth, ibcontract.strike, ibcontract.right,
+                  ibcontract.multiplier, ibcontract.exchange, ibcontract.currency, ibcontract.localSymbol,
+                  ibcontract.tradingClass, fake_execution.execId, fake_execution.exec_time, fake_execution.account,
+                  ibcontract.exchange, fake_execution.side, fake_execution.shares, fake_execution.price,
+                  fake_execution.permId, fake_execution.clientId, 0, fake_execution.cumQty, fake_execution.avgPrice,
+                  fake_execution.orderRef, "", "", "")
+
+    def send_commission(self, fake_execution):
+        self.send(IN.COMMISSION_REPORT, 1, fake_execution.execId, fake_execution.commission,
+                  fake_execution.ibcontract.currency, 0.0, 0.0, 0)
+
+    def _req_executions(self, fields):
+        next(fields)
+        reqId = int(next(fields))
+        next(fields) # clientId
+        next(fields) # acctCode
+        next(fields) # time
+        symbol = next(fields)
+
+        executions = [fake_execution for fake_execution in self._gateway.executions()
+                      if symbol=="" or fake_execution.ibcontract.symbol==symbol]
+
+        for fake_execution in executions:
+            self.send_execution(reqId, fake_execution)
+
+        self.send(IN.EXECUTION_DATA_END, 1, reqId)
+
+        for fake_execution in executions:
+            self.send_commission(fake_execution)
+
+    ## positions and accounts
+    def _req_positions(self, fields):
+        gateway = self._gateway
+        for fake_contract, (position, avgCost) in gateway.positions():
+            ibcontract = fake_contract.ibcontract
+            self.send(IN.POSITION_DATA, 3, gateway.account, ibcontract.conId, ibcontract.symbol, ibcontract.secType,
+                      ibcontract.lastTradeDateOrContractMonth, ibcontract.strike, ibcontract.right,
+                      ibcontract.multiplier, ibcontract.exchange, ibcontract.currency, ibcontract.localSymbol,
+                      ibcontract.tradingClass, position, avgCost)
+
+        self.send(IN.POSITION_END, 1)
+
+    def _req_account_updates(self, fields):
+        next(fields)
+        subscribe = next(fields)=="1"
+        if not subscribe:
+            return
+
+        gateway = self._gateway
+        for key, (value, currency) in gateway.account_values().items():
+            self.send(IN.ACCT_VALUE, 2, key, value, currency, gateway.account)
+
+        for fake_contract, (position, avgCost) in gateway.positions():
+            ibcontract = fake_contract.ibcontract
+            multiplier = float(ibcontract.multiplier or 1)
+            market_value = position * fake_contract.price * multiplier
+            unrealised_pnl = market_value - position * avgCost
+            self.send(IN.PORTFOLIO_VALUE, 8, ibcontract.conId, ibcontract.symbol, ibcontract.secType,
+                      ibcontract.lastTradeDateOrContractMonth, ibcontract.strike, ibcontract.right,
+                      ibcontract.multiplier, ibcontract.primaryExchange, ibcontract.currency, ibcontract.localSymbol,
+                      ibcontract.tradingClass, position, fake_contract.price, market_value, avgCost,
+                      unrealised_pnl, 0.0, gateway.account)
+
+        self.send(IN.ACCT_UPDATE_TIME, 1, time.strftime("%H:%M", time.gmtime()))
+        self.send(IN.ACCT_DOWNLOAD_END, 1, gateway.account)
+
+
+class fakeGateway(object):
+    """
+    Listens for connections, and holds the state every session shares: contracts, orders, fills and positions
+    """
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, account=DEFAULT_ACCOUNT,
+                 ticks_per_second=DEFAULT_TICKS_PER_SECOND, response_delay_seconds=0.0, fill_orders=True,
+                 commission=DEFAULT_COMMISSION):
+        """
+        :param ticks_per_second: how often streaming prices (and keepUpToDate bars) update, per subscription
+        :param response_delay_seconds: wait this long before dealing with each request, to look like a real gateway
+        :param fill_orders: if True, market orders and marketable limit orders fill straight away
+        """
+
+        self.host = host
+        self.port = port
+        self.account = account
+        self.ticks_per_second = ticks_per_second
+        self.response_delay_seconds = response_delay_seconds
+        self.fill_orders = fill_orders
+        self.commission = commission
+
+        self._lock = Lock()
+        self._contracts = []
+        self._next_conid = FIRST_CONID
+        self._next_order_id = FIRST_ORDER_ID
+        self._next_perm_id = 1
+        self._next_exec_id = 1
+        self._orders = {}
+        self._executions = []
+
+        ## conId -> (fakeContract, [position, avgCost])
+        self._positions = {}
+
+        self._account_values = dict(NetLiquidation=("1000000.00", "USD"), TotalCashValue=("1000000.00", "USD"),
+                                    BuyingPower=("4000000.00", "USD"))
+
+        self._sessions = []
+        self._listener = None
+        self._stopped = Event()
+
+    ## setting up what we know about
+    def add_contract(self, ibcontract, price=100.0, min_tick=0.01, long_name=""):
+        """
+        :param ibcontract: IBcontract; conId is allocated if not set, and currency defaults to USD
+        :return: fakeContract
+        """
+
+        with self._lock:
+            if not ibcontract.conId:
+                ibcontract.conId = self._next_conid
+                self._next_conid += 1
+
+            if not ibcontract.currency:
+                ibcontract.currency = "USD"
+
+            if not ibcontract.localSymbol:
+                ibcontract.localSymbol = ibcontract.symbol
+
+            if not ibcontract.tradingClass:
+                ibcontract.tradingClass = ibcontract.symbol
+
+            fake_contract = fakeContract(ibcontract, price, min_tick, long_name)
+            self._contracts.append(fake_contract)
+
+        return fake_contract
+
+    def find_contracts(self, ibcontract):
+        if not ibcontract.conId and not ibcontract.symbol:
+            ## TWS won't look for everything
+            return []
+
+        with self._lock:
+            return [fake_contract for fake_contract in self._contracts if fake_contract.matches(ibcontract)]
+
+    def set_historical_bars(self, fake_contract, bars, whatToShow="TRADES"):
+        """
+        Send these bars, rather than making them up
+
+        :param bars: list of tuples date, open, high, low, close, volume, wap, count; date already formatted
+        """
+        fake_contract.historical_bars[whatToShow] = list(bars)
+
+    def set_position(self, fake_contract, position, avgCost):
+        with self._lock:
+            self._positions[fake_contract.ibcontract.conId] = (fake_contract, [position, avgCost])
+
+    def set_account_value(self, key, value, currency="USD"):
+        with self._lock:
+            self._account_values[key] = (str(value), currency)
+
+    ## what the sessions ask us for
+    def wait_before_responding(self):
+        if self.response_delay_seconds>0:
+            time.sleep(self.response_delay_seconds)
+
+    def next_order_id(self):
+        with self._lock:
+            return self._next_order_id
+
+    def positions(self):
+        with self._lock:
+            return [(fake_contract, tuple(position_and_cost))
+                    for fake_contract, position_and_cost in self._positions.values()]
+
+    def account_values(self):
+        with self._lock:
+            return dict(self._account_values)
+
+    def open_orders(self):
+        with self._lock:
+            return [fake_order for fake_order in self._orders.values() if fake_order.is_open()]
+
+    def executions(self):
+        with self._lock:
+            return list(self._executions)
+
+    def historical_bars(self, fake_contract, endDateTime, durationStr, barSizeSetting, whatToShow, formatDate):
+        """
+        :return: list of tuples date, open, high, low, close, volume, wap, count; oldest first
+        """
+
+        scripted_bars = fake_contract.historical_bars.get(whatToShow, None)
+        if scripted_bars is not None:
+            return scripted_bars
+
+        bar_seconds = _bar_seconds(barSizeSetting)
+        end_time = _parse_end_time(endDateTime)
+        start_time = end_time - _duration_seconds(durationStr)
+
+        ## bars start on a whole number of bar lengths, and the last one can still be forming
+        bar_start = end_time - end_time % min(bar_seconds, 86400)
+
+        bars = []
+        while bar_start>=start_time and len(bars)<MAX_BARS_PER_REQUEST:
+            if not _is_weekend(bar_start):
+                bars.append((_format_bar_time(bar_start, bar_seconds, formatDate),)
+                            + fake_contract.bar(bar_start, whatToShow))
+            bar_start -= bar_seconds
+
+        bars.reverse()
+
+        return bars
+
+    def historical_ticks(self, fake_contract, startDateTime, endDateTime, numberOfTicks, whatToShow):
+        """
+        numberOfTicks ticks going forward from startDateTime, or back from endDateTime; as TWS we always include
+           all the ticks in the last second, so there can be more
+
+        :return: list of tuples time, tick as fakeContract.ticks; oldest first
+        """
+
+        now = int(time.time())
+        if startDateTime!="":
+            tick_time = _parse_end_time(startDateTime)
+            step = 1
+        else:
+            tick_time = min(_parse_end_time(endDateTime), now)
+            step = -1
+
+        ticks = []
+        while len(ticks)<numberOfTicks and tick_time<=now and tick_time>=0:
+            if _is_weekend(tick_time):
+                ## skip to the start (or end) of the weekend, rather than one second at a time
+                day_start = tick_time - tick_time % 86400
+                tick_time = day_start + 86400 if step==1 else day_start - 1
+                continue
+
+            second_ticks = [(tick_time, tick) for tick in fake_contract.ticks(tick_time, whatToShow)]
+            if step==1:
+                ticks = ticks + second_ticks
+            else:
+                ticks = second_ticks + ticks
+
+            tick_time += step
+
+        return ticks
+
+    def place_order(self, session, orderId, fake_contract, order):
+        with self._lock:
+            existing_order = self._orders.get(orderId, None)
+            if existing_order is not None and existing_order.is_open():
+                ## modification
+                existing_order.order = order
+                fake_order = existing_order
+            else:
+                fake_order = fakeOrder(orderId, fake_contract.ibcontract, order, session.clientId,
+                                       self._next_perm_id)
+                self._next_perm_id += 1
+                self._orders[orderId] = fake_order
+
+            self._next_order_id = max(self._next_order_id, orderId+1)
+
+        session.send_open_order(fake_order)
+        session.send_order_status(fake_order)
+
+        if self.fill_orders and self._is_marketable(fake_contract, order):
+            self._fill(session, fake_order, fake_contract)
+
+    def _is_marketable(self, fake_contract, order):
+        if order.orderType=="MKT":
+            return True
+
+        if order.orderType=="LMT":
+            if order.action=="BUY":
+                return order.lmtPrice>=fake_contract.price
+            return order.lmtPrice<=fake_contract.price
+
+        return False
+
+    def _fill(self, session, fake_order, fake_contract):
+        ## all in one go, at the current price
+        price = fake_contract.price
+        shares = fake_order.remaining()
+        side = "BOT" if fake_order.order.action=="BUY" else "SLD"
+        signed_shares = shares if side=="BOT" else -shares
+
+        with self._lock:
+            fake_order.filled += shares
+            fake_order.avgFillPrice = price
+            fake_order.lastFillPrice = price
+            fake_order.status = "Filled"
+
+            fake_execution = fakeExecution("0000e0d5.%08d.01.01" % self._next_exec_id, fake_order.orderId,
+                                           fake_order.ibcontract, side, shares, price, fake_order.clientId,
+                                           fake_order.permId, fake_order.filled, price, fake_order.order.orderRef,
+                                           time.strftime("%Y%m%d  %H:%M:%S", time.gmtime()), self.account,
+                                           self.commission)
+            self._next_exec_id += 1
+            self._executions.append(fake_execution)
+
+            conId = fake_contract.ibcontract.conId
+            if conId not in self._positions:
+                self._positions[conId] = (fake_contract, [0.0, 0.0])
+            position_and_cost = self._positions[conId][1]
+            new_position = position_and_cost[0] + signed_shares
+            if new_position!=0 and abs(new_position)>abs(position_and_cost[0]):
+                ## adding to the position, so average in the cost
+                position_and_cost[1] = (position_and_cost[0]*position_and_cost[1] + signed_shares*price) \
+                                       / new_position
+            position_and_cost[0] = new_position
+
+        session.send_order_status(fake_order)
+        ## fills we didn't ask for come with reqId -1
+        session.send_execution(-1, fake_execution)
+        session.send_commission(fake_execution)
+
+    def cancel_order(self, session, orderId):
+        with self._lock:
+            fake_order = self._orders.get(orderId, None)
+            if fake_order is None or not fake_order.is_open():
+                fake_order = None
+            else:
+                fake_order.status = "Cancelled"
+
+        if fake_order is None:
+            session.send_error(orderId, ORDER_NOT_FOUND_CODE, "Can't find order with id =%d" % orderId)
+            return
+
+        session.send_order_status(fake_order)
+        session.send_error(orderId, ORDER_CANCELLED_CODE, "Order Canceled - reason:")
+
+    def cancel_all_orders(self, session):
+        for fake_order in self.open_orders():
+            self.cancel_order(session, fake_order.orderId)
+
+    ## running
+    def start(self):
+        """
+        Start listening; returns once we are ready for connections
+        """
+
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind((self.host, self.port))
+        listener.listen(16)
+
+        ## so port=0 works
+        self.port = listener.getsockname()[1]
+        self._listener = listener
+        self._stopped.clear()
+
+        Thread(target=self._accept, daemon=True).start()
+        Thread(target=self._tick, daemon=True).start()
+
+    def stop(self):
+        self._stopped.set()
+
+        if self._listener is not None:
+            self._listener.close()
+            self._listener = None
+
+        with self._lock:
+            sessions = list(self._sessions)
+
+        for session in sessions:
+            session.close()
+
+    def _accept(self):
+        while not self._stopped.is_set():
+            try:
+                client_socket, _address = self._listener.accept()
+            except (OSError, AttributeError):
+                ## listener closed
+                return
+
+            client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            session = fakeGatewaySession(self, client_socket)
+            with self._lock:
+                self._sessions.append(session)
+
+            Thread(target=session.run, daemon=True).start()
+
+    def _session_closed(self, session):
+        with self._lock:
+            if session in self._sessions:
+                self._sessions.remove(session)
+
+    def _tick(self):
+        ## Moves prices and sends streaming updates
+        while not self._stopped.wait(1.0 / self.ticks_per_second):
+            with self._lock:
+                contracts = list(self._contracts)
+                sessions = list(self._sessions)
+
+            for fake_contract in contracts:
+                fake_contract.price = fake_contract.round_price(
+                    fake_contract.price + random.choice([-1, 0, 1]) * fake_contract.min_tick)
+
+            for session in sessions:
+                for tickerid, fake_contract in list(session.market_data.items()):
+                    session.send_ticks(tickerid, fake_contract)
+
+                for reqId, historical_update in list(session.historical_updates.items()):
+                    session.send_historical_update(reqId, *historical_update)
+
+
+if __name__ == '__main__':
+
+    gateway = fakeGateway()
+
+    ibcontract = IBcontract()
+    ibcontract.secType = "FUT"
+    ibcontract.lastTradeDateOrContractMonth="20181217"
+    ibcontract.symbol="GE"
+    ibcontract.exchange="GLOBEX"
+    ibcontract.multiplier="2500"
+    gateway.add_contract(ibcontract, price=97.0, min_tick=0.005, long_name="90 Day Eurodollar Futures")
+
+    gateway.start()
+    print("Fake gateway listening on %s:%d, ctrl-C to stop" % (gateway.host, gateway.port))
+
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        gateway.stop()
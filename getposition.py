@@ -21,8 +21,9 @@
 from ibapi.wrapper import EWrapper
 from ibapi.client import EClient
 
-from threading import Thread
+from threading import Thread, Condition
 import queue
+import datetime
 import time
 
 
@@ -76,6 +77,10 @@ class list_of_identified_items(list):
 FINISHED = object()
 STARTED = object()
 TIME_OUT = object()
+## timed out, but with some data
+PARTIAL = object()
+## the gateway sent an error for this request
+FAILED = object()
 
 
 class finishableQueue(object):
@@ -83,42 +88,133 @@ class finishableQueue(object):
     Creates a queue which will finish at some point
     """
 
-    def __init__(self, queue_to_finish):
+    def __init__(self):
 
-        self._queue = queue_to_finish
+        self._contents = []
+        self._finished = False
+        self._done_callbacks = []
+        self._condition = Condition()
         self.status = STARTED
+        self.error = None
+
+    def put(self, element):
+        """
+        Add an element; called from the wrapper, ie the thread running EClient.run
+
+        Putting FINISHED marks the queue as finished and wakes up anyone waiting in get()
+        """
+        done_callbacks = []
+
+        with self._condition:
+            if element is FINISHED:
+                self._finished = True
+                done_callbacks = self._done_callbacks
+                self._done_callbacks = []
+            else:
+                self._contents.append(element)
+
+            self._condition.notify_all()
+
+        for done_callback in done_callbacks:
+            done_callback()
+
+    def finish(self):
+        ## called by the wrapper when the relevant ...End method arrives
+        self.put(FINISHED)
+
+    def fail(self, error):
+        """
+        Called by the wrapper if the gateway sends an error for this request, so we don't wait for an End that
+        won't come
+
+        :param error: IBerror
+        """
+        with self._condition:
+            self.error = error
+
+        self.put(FINISHED)
+
+    def add_done_callback(self, done_callback):
+        """
+        Call done_callback() once the queue is finished, or straight away if it already is
+
+        It will usually be called from the wrapper thread, so it needs to be quick and thread safe
+        """
+        with self._condition:
+            already_finished = self._finished
+            if not already_finished:
+                self._done_callbacks.append(done_callback)
+
+        if already_finished:
+            done_callback()
 
     def get(self, timeout):
         """
-        Returns a list of queue elements once timeout is finished, or a FINISHED flag is received in the queue
+        Returns a list of queue elements as soon as a FINISHED flag is received, or once timeout is finished
+
+        The timeout is one overall deadline for the request, it doesn't restart every time an element arrives
 
         :param timeout: how long to wait before giving up
         :return: list of queue elements
         """
-        contents_of_queue=[]
-        finished=False
 
-        while not finished:
-            try:
-                current_element = self._queue.get(timeout=timeout)
-                if current_element is FINISHED:
-                    finished = True
-                    self.status = FINISHED
-                else:
-                    contents_of_queue.append(current_element)
-                    ## keep going and try and get more data
+        with self._condition:
+            finished = self._condition.wait_for(lambda: self._finished, timeout=timeout)
 
-            except queue.Empty:
-                ## If we hit a time out it's most probable we're not getting a finished element any time soon
-                ## give up and return what we have
-                finished = True
-                self.status = TIME_OUT
+            contents_of_queue = self._contents
+            self._contents = []
 
+        if finished and self.error is not None:
+            self.status = FAILED
+        elif finished:
+            self.status = FINISHED
+        elif len(contents_of_queue)>0:
+            ## we have some data but never got the end marker
+            self.status = PARTIAL
+        else:
+            self.status = TIME_OUT
 
         return contents_of_queue
 
     def timed_out(self):
-        return self.status is TIME_OUT
+        return self.status is TIME_OUT or self.status is PARTIAL
+
+    def partial(self):
+        return self.status is PARTIAL
+
+    def finished(self):
+        return self.status is FINISHED
+
+    def failed(self):
+        return self.status is FAILED
+
+## errors which are about the connection or the data farms, not about any one request
+CONNECTION_ERROR_CODES = [502, 504, 1100, 1101, 1102, 1300, 2103, 2104, 2105, 2106, 2107, 2108, 2110, 2119, 2157, 2158]
+
+
+class IBerror(object):
+    """
+    An error message from the gateway
+    """
+
+    def __init__(self, id, errorCode, errorString):
+        """
+        :param id: reqId or orderId the error is about, -1 if it isn't about anything in particular
+        :param errorCode: int
+        :param errorString: str
+        """
+
+        self.id = id
+        self.errorCode = errorCode
+        self.errorString = errorString
+        self.timestamp = datetime.datetime.now()
+
+    def __repr__(self):
+        return "IB error id %d errorcode %d string %s" % (self.id, self.errorCode, self.errorString)
+
+    def is_connection_error(self):
+        return self.id==-1 or self.errorCode in CONNECTION_ERROR_CODES
+
 
 
 ## cache used for accounting data
@@ -273,9 +369,12 @@ class TestWrapper(EWrapper):
         self._my_accounts = {}
 
         ## We set these up as we could get things coming along before we run an init
-        self._my_positions = queue.Queue()
+        self._my_positions = finishableQueue()
         self._my_errors = queue.Queue()
 
+        ## connectivity and data farm messages go here, rather than in with everything else
+        self._my_connection_errors = queue.Queue()
+
 
     def get_error(self, timeout=5):
         if self.is_error():
@@ -290,14 +389,32 @@ class TestWrapper(EWrapper):
         an_error_if=not self._my_errors.empty()
         return an_error_if
 
+    def get_connection_error(self, timeout=5):
+        if self.is_connection_error():
+            try:
+                return self._my_connection_errors.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        return None
+
+    def is_connection_error(self):
+        a_connection_error_if=not self._my_connection_errors.empty()
+        return a_connection_error_if
+
     def error(self, id, errorCode, errorString):
         ## Overriden method
-        errormsg = "IB error id %d errorcode %d string %s" % (id, errorCode, errorString)
-        self._my_errors.put(errormsg)
+        ib_error = IBerror(id, errorCode, errorString)
+
+        if ib_error.is_connection_error():
+            self._my_connection_errors.put(ib_error)
+            return
+
+        self._my_errors.put(ib_error)
 
     ## get positions code
     def init_positions(self):
-        positions_queue = self._my_positions = queue.Queue()
+        positions_queue = self._my_positions = finishableQueue()
 
         return positions_queue
 
@@ -313,12 +430,15 @@ class TestWrapper(EWrapper):
     def positionEnd(self):
         ## overriden method
 
-        self._my_positions.put(FINISHED)
+        self._my_positions.finish()
 
 
     ## get accounting data
     def init_accounts(self, accountName):
-        accounting_queue = self._my_accounts[accountName] = queue.Queue()
+        accounting_queue = self._my_accounts[accountName] = finishableQueue()
+
+        ## updateAccountTime doesn't tell us which account it's for, so remember the one we asked about
+        self._my_current_account_name = accountName
 
         return accounting_queue
 
@@ -345,12 +465,12 @@ class TestWrapper(EWrapper):
 
         ## use this to seperate out different account data
         data = identifed_as(ACCOUNT_TIME_FLAG, timeStamp)
-        self._my_accounts[accountName].put(data)
+        self._my_accounts[self._my_current_account_name].put(data)
 
 
     def accountDownloadEnd(self, accountName:str):
 
-        self._my_accounts[accountName].put(FINISHED)
+        self._my_accounts[accountName].finish()
 
 
 
@@ -378,7 +498,7 @@ class TestClient(EClient):
         """
 
         ## Make a place to store the data we're going to return
-        positions_queue = finishableQueue(self.init_positions())
+        positions_queue = self.init_positions()
 
         ## ask for the data
         self.reqPositions()
@@ -404,7 +524,7 @@ class TestClient(EClient):
         """
 
         ## Make a place to store the data we're going to return
-        accounting_queue = finishableQueue(self.init_accounts(accountName))
+        accounting_queue = self.init_accounts(accountName)
 
         ## ask for the data
         self.reqAccountUpdates(True, accountName)
@@ -20,273 +20,2749 @@
 from ibapi.wrapper import EWrapper
 from ibapi.client import EClient
 from ibapi.contract import Contract as IBcontract
-from threading import Thread
+from threading import Thread, Condition, Lock, Event
+from collections import OrderedDict, deque
+from bisect import insort
 import queue
+import calendar
 import datetime
-
-DEFAULT_HISTORIC_DATA_ID=50
-DEFAULT_GET_CONTRACT_ID=43
+import math
+import shelve
+import time
+import os
+import json
+import numpy as np
+import pandas as pd
 
 ## marker for when queue is finished
 FINISHED = object()
 STARTED = object()
 TIME_OUT = object()
+## timed out, but with some data
+PARTIAL = object()
+## the gateway sent an error for this request
+FAILED = object()
+
+## reqIds are handed out from here upwards, high enough not to clash with broker order ids
+FIRST_REQUEST_ID=10000000
+
+## where to keep contracts we've already resolved on disk, if a TestApp is asked to; only one process at a time should
+##    use the file, as shelve doesn't lock it
+DEFAULT_CONTRACT_CACHE_FILENAME="contract_details_cache"
+DEFAULT_CONTRACT_CACHE_TTL_SECONDS=24*60*60
+DEFAULT_CONTRACT_CACHE_MAX_ENTRIES=10000
+
+## how many contract details requests resolve_ib_contracts will have in flight at once
+DEFAULT_MAX_CONTRACTS_IN_FLIGHT=50
+
+## where we keep historical bars we've already downloaded
+DEFAULT_BAR_STORE_DIRECTORY="historical_bar_store"
+
+## how many historical data requests get_IB_historical_data_range will have in flight at once
+DEFAULT_MAX_HISTORICAL_CHUNKS_IN_FLIGHT=10
+
+## IB will only give us these up to now, so they can't be split into chunks or kept in the bar store
+WHAT_TO_SHOW_UP_TO_NOW=["ADJUSTED_LAST"]
+
+## what get_IB_historical_data_fields gets if we don't say
+DEFAULT_WHAT_TO_SHOW_FIELDS=["TRADES", "MIDPOINT", "BID", "ASK"]
+
+## how many historical data requests get_IB_historical_data_batch will have in flight at once
+DEFAULT_MAX_HISTORICAL_REQUESTS_IN_FLIGHT=10
+
+## Longest duration IB will give us in one request for each bar size, from the IB table of valid durations
+MAX_DURATION_FOR_BAR_SIZE={
+    "1 secs": "1800 S", "5 secs": "3600 S", "10 secs": "14400 S", "15 secs": "14400 S", "30 secs": "28800 S",
+    "1 min": "1 D", "2 mins": "2 D", "3 mins": "1 W", "5 mins": "1 W", "10 mins": "1 W", "15 mins": "1 W",
+    "20 mins": "1 W", "30 mins": "30 D", "1 hour": "30 D", "2 hours": "30 D", "3 hours": "30 D", "4 hours": "30 D",
+    "8 hours": "30 D", "1 day": "1 Y", "1 week": "1 Y", "1 month": "1 Y"}
+
+BAR_SIZE_UNIT_SECONDS=dict(sec=1, secs=1, min=60, mins=60, hour=3600, hours=3600, day=86400, days=86400,
+                           week=7*86400, weeks=7*86400, month=30*86400, months=30*86400)
+DURATION_UNIT_SECONDS=dict(S=1, D=86400, W=7*86400, M=31*86400, Y=365*86400)
+
+## bar sizes that go by the calendar, rather than a number of seconds
+CALENDAR_BAR_SIZES=["1 day", "1 week", "1 month"]
+
+## when each trading day starts, relative to midnight; eg -7 hours for a session that opens at 5pm the day before
+DEFAULT_DAY_STARTS_AT=datetime.timedelta(0)
+
+## IB only applies the historical data pacing limits to bars this long or shorter
+MAX_SMALL_BAR_SECONDS=30
+
+## IB pacing limits. Bucket type: (capacity, period in seconds)
+PACING_LIMITS=dict(
+    messages=(50, 1.0),       # all messages to the gateway
+    historical=(60, 600.0),   # historical data requests in any ten minutes
+    identical=(1, 15.0),      # identical historical data requests
+    contract=(6, 2.0))        # historical data requests for the same contract, exchange and tick type
+
+## lower numbers go first; contract details are quick so don't make them wait behind a big download
+REFERENCE_DATA_PRIORITY=0
+HISTORICAL_DATA_PRIORITY=10
+
+## once we have this many pacing buckets we throw away the idle ones
+MAX_PACING_BUCKETS=1000
+
+## if the scheduler hasn't sent a request after this long, it's being held back for pacing
+PACING_NOTICE_SECONDS=0.1
+
+## every data frame we hand back is indexed by time in this timezone
+DATA_TIMEZONE="UTC"
+
+## with formatDate=2 intraday bar times come as seconds since 1970, so there's nothing to parse; daily bars are
+##    always yyyymmdd
+DEFAULT_FORMAT_DATE=2
+
+## the timezone TWS is logged in with, unless get_IB_historical_data is told otherwise; with formatDate=1, intraday
+##    bar times without a timezone are in this
+DEFAULT_TWS_TIMEZONE="UTC"
+
+## historical bars are kept as columns: time as int64 seconds since 1970, and these as float64
+BAR_COLUMNS=["open", "high", "low", "close", "volume", "wap", "barCount"]
+## doubles each time it fills up
+INITIAL_BAR_BUFFER_SIZE=1024
+## how many bars a keepUpToDate stream holds on to
+DEFAULT_MAX_STREAMING_BARS=10000
+
+## historical ticks are kept as columns: time as int64 seconds since 1970, then these for each whatToShow
+HISTORICAL_TICK_COLUMNS=dict(
+    TRADES=[("price", np.float64), ("size", np.int64), ("exchange", object), ("specialConditions", object),
+            ("pastLimit", np.bool_), ("unreported", np.bool_)],
+    BID_ASK=[("priceBid", np.float64), ("priceAsk", np.float64), ("sizeBid", np.int64), ("sizeAsk", np.int64),
+             ("askPastHigh", np.bool_), ("bidPastLow", np.bool_)],
+    MIDPOINT=[("price", np.float64), ("size", np.int64)])
+
+## how many requests iterate_IB_historical_data_range gets ahead of whoever is using the bars
+DEFAULT_MAX_HISTORICAL_CHUNKS_AHEAD=2
+
+## IB won't send more than this many historical ticks for one request
+MAX_HISTORICAL_TICKS_PER_REQUEST=1000
 
 class finishableQueue(object):
 
-    def __init__(self, queue_to_finish):
+    def __init__(self):
 
-        self._queue = queue_to_finish
+        self._contents = []
+        self._finished = False
+        self._done_callbacks = []
+        self._condition = Condition()
         self.status = STARTED
+        self.error = None
+
+    def put(self, element):
+        """
+        Add an element; called from the wrapper, ie the thread running EClient.run
+
+        Putting FINISHED marks the queue as finished and wakes up anyone waiting in get()
+        """
+        done_callbacks = []
+
+        with self._condition:
+            if element is FINISHED:
+                self._finished = True
+                done_callbacks = self._done_callbacks
+                self._done_callbacks = []
+            else:
+                self._contents.append(element)
+
+            self._condition.notify_all()
+
+        for done_callback in done_callbacks:
+            done_callback()
+
+    def finish(self):
+        ## called by the wrapper when the relevant ...End method arrives
+        self.put(FINISHED)
+
+    def fail(self, error):
+        """
+        Called by the wrapper if the gateway sends an error for this request, so we don't wait for an End that
+        won't come
+
+        :param error: IBerror
+        """
+        with self._condition:
+            self.error = error
+
+        self.put(FINISHED)
+
+    def add_done_callback(self, done_callback):
+        """
+        Call done_callback() once the queue is finished, or straight away if it already is
+
+        It will usually be called from the wrapper thread, so it needs to be quick and thread safe
+        """
+        with self._condition:
+            already_finished = self._finished
+            if not already_finished:
+                self._done_callbacks.append(done_callback)
+
+        if already_finished:
+            done_callback()
 
     def get(self, timeout):
         """
-        Returns a list of queue elements once timeout is finished, or a FINISHED flag is received in the queue
+        Returns a list of queue elements as soon as a FINISHED flag is received, or once timeout is finished
+
+        The timeout is one overall deadline for the request, it doesn't restart every time an element arrives
+
         :param timeout: how long to wait before giving up
         :return: list of queue elements
         """
-        contents_of_queue=[]
-        finished=False
 
-        while not finished:
-            try:
-                current_element = self._queue.get(timeout=timeout)
-                if current_element is FINISHED:
-                    finished = True
-                    self.status = FINISHED
-                else:
-                    contents_of_queue.append(current_element)
-                    ## keep going and try and get more data
+        with self._condition:
+            finished = self._condition.wait_for(lambda: self._finished, timeout=timeout)
 
-            except queue.Empty:
-                ## If we hit a time out it's most probable we're not getting a finished element any time soon
-                ## give up and return what we have
-                finished = True
-                self.status = TIME_OUT
+            contents_of_queue = self._take_contents()
+
+        if finished and self.error is not None:
+            self.status = FAILED
+        elif finished:
+            self.status = FINISHED
+        elif len(contents_of_queue)>0:
+            ## we have some data but never got the end marker
+            self.status = PARTIAL
+        else:
+            self.status = TIME_OUT
+
+        return contents_of_queue
 
+    def _take_contents(self):
+        ## must hold the lock
+        contents_of_queue = self._contents
+        self._contents = []
 
         return contents_of_queue
 
     def timed_out(self):
-        return self.status is TIME_OUT
+        return self.status is TIME_OUT or self.status is PARTIAL
 
+    def partial(self):
+        return self.status is PARTIAL
 
+    def finished(self):
+        return self.status is FINISHED
 
+    def failed(self):
+        return self.status is FAILED
 
 
-class TestWrapper(EWrapper):
+## day part of a bar date -> epoch seconds at midnight UTC; there aren't many different days in any download
+_DAY_EPOCHS = {}
+
+def _bar_date_to_epoch(bar_date, timezone=DEFAULT_TWS_TIMEZONE):
     """
-    The wrapper deals with the action coming back from the IB gateway or TWS instance
-    We override methods in EWrapper that will get called when this action happens, like currentTime
-    Extra methods are added as we need to store the results in this object
+    :param bar_date: str, as the gateway sends it: "yyyymmdd", "yyyymmdd  hh:mm:ss" possibly followed by a
+        timezone, or seconds since 1970 if formatDate was 2
+    :param timezone: str, what any time without a timezone is in
+    :return: int seconds since 1970 UTC; dates are midnight UTC, as they're days rather than times
     """
 
-    def __init__(self):
-        self._my_contract_details = {}
-        self._my_historic_data_dict = {}
+    if len(bar_date)!=8 and bar_date.isdigit():
+        return int(bar_date)
 
-    ## error handling code
-    def init_error(self):
-        error_queue=queue.Queue()
-        self._my_errors = error_queue
+    if len(bar_date)>8 and (timezone!="UTC" or len(bar_date.split())>2):
+        return int(_bar_dates_to_epochs([bar_date], timezone)[0])
 
-    def get_error(self, timeout=5):
-        if self.is_error():
-            try:
-                return self._my_errors.get(timeout=timeout)
-            except queue.Empty:
-                return None
+    day = bar_date[:8]
+    day_epoch = _DAY_EPOCHS.get(day, None)
+    if day_epoch is None:
+        day_epoch = calendar.timegm((int(day[:4]), int(day[4:6]), int(day[6:8]), 0, 0, 0))
+        _DAY_EPOCHS[day] = day_epoch
 
-        return None
+    if len(bar_date)==8:
+        return day_epoch
 
-    def is_error(self):
-        an_error_if=not self._my_errors.empty()
-        return an_error_if
+    time_of_day = bar_date[8:].split()[0]
 
-    def error(self, id, errorCode, errorString):
-        ## Overriden method
-        errormsg = "IB error id %d errorcode %d string %s" % (id, errorCode, errorString)
-        self._my_errors.put(errormsg)
+    return day_epoch + int(time_of_day[:2])*3600 + int(time_of_day[3:5])*60 + int(time_of_day[6:8])
 
 
-    ## get contract details code
-    def init_contractdetails(self, reqId):
-        contract_details_queue = self._my_contract_details[reqId] = queue.Queue()
+def _bar_dates_to_epochs(bar_dates, timezone=DEFAULT_TWS_TIMEZONE):
+    """
+    Vectorised version of _bar_date_to_epoch, for bar times with a time of day
 
-        return contract_details_queue
+    :param bar_dates: list of str "yyyymmdd  hh:mm:ss", each possibly followed by a timezone
+    :param timezone: str, what any time without a timezone is in
+    :return: np.array of int64 seconds since 1970 UTC
+    """
 
-    def contractDetails(self, reqId, contractDetails):
-        ## overridden method
+    ## one row of character codes per bar date, so the digits can be picked out by position
+    characters = np.array(bar_dates, dtype="U")
+    width = characters.dtype.itemsize // 4
+    characters = characters.view(np.uint32).reshape(len(bar_dates), width)
+    digits = characters.astype(np.int64) - ord("0")
+
+    years = digits[:, 0]*1000 + digits[:, 1]*100 + digits[:, 2]*10 + digits[:, 3]
+    months = digits[:, 4]*10 + digits[:, 5]
+    days = digits[:, 6]*10 + digits[:, 7]
+    day_epochs = ((((years-1970)*12 + months-1).astype("datetime64[M]").astype("datetime64[D]").view(np.int64)
+                   + days-1) * 86400)
+
+    ## the gateway usually puts two spaces between the date and the time, but we allow for one
+    local_epochs = np.empty(len(bar_dates), dtype=np.int64)
+    timezones = np.empty(len(bar_dates), dtype=object)
+    two_spaces = characters[:, 9]==ord(" ")
+    for time_starts_at, in_group in [(9, ~two_spaces), (10, two_spaces)]:
+        if not in_group.any():
+            continue
+
+        group_digits = digits[in_group]
+        hours = group_digits[:, time_starts_at]*10 + group_digits[:, time_starts_at+1]
+        minutes = group_digits[:, time_starts_at+3]*10 + group_digits[:, time_starts_at+4]
+        seconds = group_digits[:, time_starts_at+6]*10 + group_digits[:, time_starts_at+7]
+        local_epochs[in_group] = day_epochs[in_group] + hours*3600 + minutes*60 + seconds
+
+        timezone_width = width - time_starts_at - 9
+        if timezone_width>0:
+            timezone_characters = np.ascontiguousarray(characters[in_group, time_starts_at+9:])
+            timezones[in_group] = timezone_characters.view("U%d" % timezone_width).ravel()
+        else:
+            timezones[in_group] = ""
+
+    epochs = local_epochs.copy()
+    for bar_timezone in pd.unique(timezones):
+        local_timezone = bar_timezone.strip() or timezone
+        if local_timezone in ["UTC", "GMT"]:
+            continue
+
+        in_timezone = timezones==bar_timezone
+        local_times = pd.DatetimeIndex(local_epochs[in_timezone].view("datetime64[s]"))
+        try:
+            ## bars are in order, so in the hour that happens twice when the clocks go back we can tell which is which
+            utc_times = local_times.tz_localize(local_timezone, ambiguous="infer", nonexistent="shift_forward")
+        except ValueError:
+            utc_times = local_times.tz_localize(local_timezone, ambiguous=True, nonexistent="shift_forward")
+
+        epochs[in_timezone] = utc_times.tz_convert("UTC").tz_localize(None).values.astype(
+            "datetime64[s]").view(np.int64)
+
+    return epochs
+
+
+def _epochs_to_index(epochs, name="date"):
+    """
+    :param epochs: np.array of int64 seconds since 1970 UTC
+    :return: pd.DatetimeIndex in DATA_TIMEZONE
+    """
+    return pd.DatetimeIndex(epochs.view("datetime64[s]"), name=name).tz_localize("UTC").tz_convert(DATA_TIMEZONE)
 
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
 
-        self._my_contract_details[reqId].put(contractDetails)
+class historicalBarBuffer(finishableQueue):
+    """
+    A finishableQueue for historical data, which the wrapper writes bars into as numpy columns rather than as a
+       tuple per bar
 
-    def contractDetailsEnd(self, reqId):
-        ## overriden method
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
+    get() returns a pd.DataFrame that is a view on the columns, so nothing is copied when we hand it over.
+       get_block() returns whatever bars have arrived so far, without waiting for the end
+    """
+
+    def __init__(self, initial_size=INITIAL_BAR_BUFFER_SIZE, tws_timezone=DEFAULT_TWS_TIMEZONE):
+        """
+        :param tws_timezone: str, the timezone TWS is logged in with, for bar times that come without one
+        """
+        super().__init__()
+        self._new_columns(initial_size)
+        self._data_callbacks = []
+        self._tws_timezone = tws_timezone
+
+    def _new_columns(self, size):
+        ## must hold the lock, or be in __init__
+        self._times = np.empty(size, dtype=np.int64)
+        self._values = np.empty((len(BAR_COLUMNS), size), dtype=np.float64)
+        self._bar_count = 0
+
+        ## tuples bar index, date str, for bar times we haven't parsed yet
+        self._unparsed_dates = []
+
+    def _grow(self):
+        ## must hold the lock
+        old_times = self._times
+        old_values = self._values
+        bar_count = self._bar_count
+        unparsed_dates = self._unparsed_dates
+
+        self._new_columns(2*len(old_times))
+        self._times[:bar_count] = old_times[:bar_count]
+        self._values[:, :bar_count] = old_values[:, :bar_count]
+        self._bar_count = bar_count
+        self._unparsed_dates = unparsed_dates
+
+    def _parse_dates(self):
+        ## must hold the lock; local times all get parsed together, which is much quicker than one at a time
+        if len(self._unparsed_dates)==0:
+            return
+
+        bar_indices, bar_dates = zip(*self._unparsed_dates)
+        self._times[list(bar_indices)] = _bar_dates_to_epochs(bar_dates, self._tws_timezone)
+        self._unparsed_dates = []
+
+    def add_bar(self, bar):
+        """
+        Called from the wrapper
 
-        self._my_contract_details[reqId].put(FINISHED)
+        :param bar: BarData
+        """
 
-    ## Historic data code
-    def init_historicprices(self, tickerid):
-        historic_data_queue = self._my_historic_data_dict[tickerid] = queue.Queue()
+        bar_date = bar.date
+        if len(bar_date)>8 and not bar_date.isdigit():
+            ## a local time, which gets parsed along with the others when they're taken
+            bar_time = None
+        else:
+            bar_time = _bar_date_to_epoch(bar_date)
 
-        return historic_data_queue
+        with self._condition:
+            if self._bar_count==len(self._times):
+                self._grow()
 
+            bar_index = self._bar_count
+            if bar_time is None:
+                self._unparsed_dates.append((bar_index, bar_date))
+                bar_time = 0
 
-    def historicalData(self, tickerid , bar):
+            self._times[bar_index] = bar_time
+            self._values[:, bar_index] = (bar.open, bar.high, bar.low, bar.close, bar.volume, bar.average,
+                                          bar.barCount)
+            self._bar_count += 1
 
-        ## Overriden method
-        ## Note I'm choosing to ignore barCount, WAP and hasGaps but you could use them if you like
-        bardata=(bar.date, bar.open, bar.high, bar.low, bar.close, bar.volume)
+            data_callbacks = self._data_callbacks
+            self._data_callbacks = []
 
-        historic_data_dict=self._my_historic_data_dict
+        for data_callback in data_callbacks:
+            data_callback()
 
-        ## Add on to the current data
-        if tickerid not in historic_data_dict.keys():
-            self.init_historicprices(tickerid)
+    def put(self, element):
+        super().put(element)
 
-        historic_data_dict[tickerid].put(bardata)
+        ## whoever is waiting for a block needs to know it's finished
+        with self._condition:
+            data_callbacks = self._data_callbacks
+            self._data_callbacks = []
 
-    def historicalDataEnd(self, tickerid, start:str, end:str):
-        ## overriden method
+        for data_callback in data_callbacks:
+            data_callback()
 
-        if tickerid not in self._my_historic_data_dict.keys():
-            self.init_historicprices(tickerid)
+    def add_data_callback(self, data_callback):
+        """
+        Call data_callback() once, as soon as there are bars for get_block or the request is finished; or straight
+           away if there already are, or it already is
 
-        self._my_historic_data_dict[tickerid].put(FINISHED)
+        It will usually be called from the wrapper thread, so it needs to be quick and thread safe
+        """
+        with self._condition:
+            ready = self._bar_count>0 or self._finished
+            if not ready:
+                self._data_callbacks.append(data_callback)
 
+        if ready:
+            data_callback()
 
+    def get_block(self, timeout):
+        """
+        Returns the bars that have arrived since the last block, once there are some, or the request finishes, or
+           timeout runs out
 
+        Afterwards finished(), failed() or timed_out() say if there's nothing more to come; if none of them are True
+           there are more bars on the way
 
-class TestClient(EClient):
+        :param timeout: how long to wait for the first bar
+        :return: pd.DataFrame as from get(), possibly empty
+        """
+
+        with self._condition:
+            self._condition.wait_for(lambda: self._bar_count>0 or self._finished, timeout=timeout)
+
+            finished = self._finished
+            block = self._take_contents()
+
+        if finished and self.error is not None:
+            self.status = FAILED
+        elif finished:
+            self.status = FINISHED
+        elif len(block)==0:
+            self.status = TIME_OUT
+
+        return block
+
+    def __len__(self):
+        with self._condition:
+            return self._bar_count
+
+    def _take_contents(self):
+        ## must hold the lock
+        bar_count = self._bar_count
+        self._parse_dates()
+
+        ## .T of a slice of the 2d array is a view, which pandas uses as it is
+        index = _epochs_to_index(self._times[:bar_count])
+        historic_data = pd.DataFrame(self._values[:, :bar_count].T, index=index, columns=BAR_COLUMNS, copy=False)
+
+        ## anything that arrives after this goes into new columns, so the data frame we've handed over won't change
+        self._new_columns(INITIAL_BAR_BUFFER_SIZE)
+
+        return historic_data
+
+
+class historicalBarStream(historicalBarBuffer):
     """
-    The client method
-    We don't override native methods, but instead call them from our own wrappers
+    Channel for a keepUpToDate historical data request: the history, then the latest bar kept current in place
+
+    historicalData and historicalDataEnd fill it and finish it as usual, then the gateway keeps sending
+    historicalDataUpdate with the bar that's still forming. When one arrives for a later bar, the one before has
+    closed, and on_bar_close gets called with it.
+
+    get() waits for the history, then returns a copy of the newest max_bars bars; it doesn't empty the stream
     """
-    def __init__(self, wrapper):
-        ## Set up with a wrapper inside
-        EClient.__init__(self, wrapper)
 
+    def __init__(self, max_bars=DEFAULT_MAX_STREAMING_BARS, on_bar_close=None, tws_timezone=DEFAULT_TWS_TIMEZONE):
+        """
+        :param max_bars: older bars than this get dropped
+        :param on_bar_close: function, called with a pd.Series of the bar (named by its date) each time one closes.
+            Called from the wrapper thread, so it needs to be quick and thread safe
+        :param tws_timezone: str, as historicalBarBuffer
+        """
+        self._max_bars = max_bars
+        self._on_bar_close = on_bar_close
+
+        super().__init__(initial_size=min(max_bars, INITIAL_BAR_BUFFER_SIZE), tws_timezone=tws_timezone)
 
-    def resolve_ib_contract(self, ibcontract, reqId=DEFAULT_GET_CONTRACT_ID):
+    def _grow(self):
+        ## must hold the lock
+        if len(self._times)<2*self._max_bars:
+            super()._grow()
+            return
 
+        ## full up: slide the newest bars back to the start, rather than allocating
+        self._parse_dates()
+        first_bar_to_keep = self._bar_count - self._max_bars
+        self._times[:self._max_bars] = self._times[first_bar_to_keep:self._bar_count]
+        self._values[:, :self._max_bars] = self._values[:, first_bar_to_keep:self._bar_count]
+        self._bar_count = self._max_bars
+
+    def update_bar(self, bar):
         """
-        From a partially formed contract, returns a fully fledged version
-        :returns fully resolved IB contract
+        Called from the wrapper with historicalDataUpdate
+
+        :param bar: BarData
         """
 
-        ## Make a place to store the data we're going to return
-        contract_details_queue = finishableQueue(self.init_contractdetails(reqId))
+        bar_time = _bar_date_to_epoch(bar.date, self._tws_timezone)
+        bar_values = (bar.open, bar.high, bar.low, bar.close, bar.volume, bar.average, bar.barCount)
 
-        print("Getting full contract details from the server... ")
+        closed_bar = None
+        with self._condition:
+            self._parse_dates()
+            last_bar_index = self._bar_count - 1
 
-        self.reqContractDetails(reqId, ibcontract)
+            if last_bar_index>=0 and bar_time==self._times[last_bar_index]:
+                ## the same bar, still forming
+                self._values[:, last_bar_index] = bar_values
+                return
 
-        ## Run until we get a valid contract(s) or get bored waiting
-        MAX_WAIT_SECONDS = 10
-        new_contract_details = contract_details_queue.get(timeout = MAX_WAIT_SECONDS)
+            if last_bar_index>=0 and bar_time<self._times[last_bar_index]:
+                ## out of date
+                return
 
-        while self.wrapper.is_error():
-            print(self.get_error())
+            if last_bar_index>=0:
+                closed_bar = pd.Series(self._values[:, last_bar_index].copy(), index=BAR_COLUMNS,
+                                       name=_epochs_to_index(self._times[last_bar_index:last_bar_index+1])[0])
 
-        if contract_details_queue.timed_out():
-            print("Exceeded maximum wait for wrapper to confirm finished - seems to be normal behaviour")
+            if self._bar_count==len(self._times):
+                self._grow()
 
-        if len(new_contract_details)==0:
-            print("Failed to get additional contract details: returning unresolved contract")
-            return ibcontract
+            self._times[self._bar_count] = bar_time
+            self._values[:, self._bar_count] = bar_values
+            self._bar_count += 1
 
-        if len(new_contract_details)>1:
-            print("got multiple contracts using first one")
+        if closed_bar is not None and self._on_bar_close is not None:
+            self._on_bar_close(closed_bar)
 
-        new_contract_details=new_contract_details[0]
+    def __len__(self):
+        with self._condition:
+            return min(self._bar_count, self._max_bars)
 
-        resolved_ibcontract=new_contract_details.summary
+    def _take_contents(self):
+        ## must hold the lock; we keep updating the bars, so this is a copy, not a view
+        self._parse_dates()
+        first_bar = max(self._bar_count - self._max_bars, 0)
 
-        return resolved_ibcontract
+        index = _epochs_to_index(self._times[first_bar:self._bar_count])
 
+        return pd.DataFrame(self._values[:, first_bar:self._bar_count].T, index=index, columns=BAR_COLUMNS,
+                            copy=True)
 
-    def get_IB_historical_data(self, ibcontract, durationStr="1 Y", barSizeSetting="1 day",
-                               tickerid=DEFAULT_HISTORIC_DATA_ID):
 
+def _historical_ticks_to_data_frame(ticks, whatToShow):
+    """
+    :param ticks: list of HistoricalTick, HistoricalTickBidAsk or HistoricalTickLast, as the wrapper gets them
+    :return: pd.DataFrame indexed by time, columns as HISTORICAL_TICK_COLUMNS[whatToShow]
+    """
+
+    if whatToShow=="TRADES":
+        values = [[tick.price for tick in ticks], [tick.size for tick in ticks],
+                  [tick.exchange for tick in ticks], [tick.specialConditions for tick in ticks],
+                  [tick.tickAttribLast.pastLimit for tick in ticks], [tick.tickAttribLast.unreported for tick in ticks]]
+    elif whatToShow=="BID_ASK":
+        values = [[tick.priceBid for tick in ticks], [tick.priceAsk for tick in ticks],
+                  [tick.sizeBid for tick in ticks], [tick.sizeAsk for tick in ticks],
+                  [tick.tickAttribBidAsk.askPastHigh for tick in ticks],
+                  [tick.tickAttribBidAsk.bidPastLow for tick in ticks]]
+    else:
+        values = [[tick.price for tick in ticks], [tick.size for tick in ticks]]
+
+    columns = HISTORICAL_TICK_COLUMNS[whatToShow]
+    times = np.array([tick.time for tick in ticks], dtype=np.int64)
+
+    return pd.DataFrame(dict([(column, np.array(column_values, dtype=dtype))
+                              for (column, dtype), column_values in zip(columns, values)]),
+                        index=_epochs_to_index(times, name="time"))
+
+
+class historicalTickBuffer(finishableQueue):
+    """
+    Channel for a historical ticks request; each page of ticks goes straight into columns as it arrives
+
+    get() returns a pd.DataFrame indexed by time, with the columns in HISTORICAL_TICK_COLUMNS for whatToShow
+    """
+
+    def __init__(self, whatToShow):
+        super().__init__()
+        self.whatToShow = whatToShow
+
+    def add_ticks(self, ticks, done):
         """
-        Returns historical prices for a contract, up to today
-        ibcontract is a Contract
-        :returns list of prices in 4 tuples: Open high low close volume
+        Called from the wrapper, with one of the historicalTicks callbacks
+
+        :param ticks: list of HistoricalTick, HistoricalTickBidAsk or HistoricalTickLast
+        :param done: bool, True if that's all of them
         """
 
+        self.put(_historical_ticks_to_data_frame(ticks, self.whatToShow))
 
-        ## Make a place to store the data we're going to return
-        historic_data_queue = finishableQueue(self.init_historicprices(tickerid))
+        if done:
+            self.finish()
 
-        # Request some historical data. Native method in EClient
-        self.reqHistoricalData(
-            tickerid,  # tickerId,
-            ibcontract,  # contract,
-            datetime.datetime.today().strftime("%Y%m%d %H:%M:%S %Z"),  # endDateTime,
-            durationStr,  # durationStr,
-            barSizeSetting,  # barSizeSetting,
-            "TRADES",  # whatToShow,
-            1,  # useRTH,
-            1,  # formatDate
-            False,  # KeepUpToDate <<==== added for api 9.73.2
-            [] ## chartoptions not used
-        )
+    def _take_contents(self):
+        ## must hold the lock
+        pages = self._contents
+        self._contents = []
 
+        if len(pages)==0:
+            return _historical_ticks_to_data_frame([], self.whatToShow)
+        if len(pages)==1:
+            return pages[0]
 
+        return pd.concat(pages)
 
-        ## Wait until we get a completed data, an error, or get bored waiting
-        MAX_WAIT_SECONDS = 10
-        print("Getting historical data from the server... could take %d seconds to complete " % MAX_WAIT_SECONDS)
 
-        historic_data = historic_data_queue.get(timeout = MAX_WAIT_SECONDS)
+def _datetime_to_epoch(a_datetime):
+    ## datetimes with a timezone are converted; ones without are taken as UTC
+    return calendar.timegm(a_datetime.utctimetuple())
 
-        while self.wrapper.is_error():
-            print(self.get_error())
 
-        if historic_data_queue.timed_out():
-            print("Exceeded maximum wait for wrapper to confirm finished - seems to be normal behaviour")
+def _epoch_to_datetime(epoch):
+    ## datetime.datetime in UTC, without a timezone
+    return datetime.datetime(1970, 1, 1) + datetime.timedelta(seconds=epoch)
 
-        self.cancelHistoricalData(tickerid)
 
+def _utc_datetime(a_datetime):
+    ## we work in UTC without timezones, whatever we're given
+    return _epoch_to_datetime(_datetime_to_epoch(a_datetime))
 
-        return historic_data
 
+def _utc_now():
+    return _epoch_to_datetime(int(time.time()))
 
 
-class TestApp(TestWrapper, TestClient):
-    def __init__(self, ipaddress, portid, clientid):
-        TestWrapper.__init__(self)
-        TestClient.__init__(self, wrapper=self)
+def _epoch_to_ib_datetime(epoch):
+    ## as IB wants for endDateTime and startDateTime; with the timezone, so it doesn't matter what TWS is set to
+    return time.strftime("%Y%m%d %H:%M:%S GMT", time.gmtime(epoch))
 
-        self.connect(ipaddress, portid, clientid)
 
-        thread = Thread(target = self.run)
-        thread.start()
+def _merge_intervals(intervals):
+    """
+    :param intervals: list of (start, end)
+    :return: sorted list of (start, end), with any that overlap or touch joined up
+    """
 
-        setattr(self, "_thread", thread)
+    merged_intervals = []
+    for start, end in sorted(intervals):
+        if len(merged_intervals)>0 and start<=merged_intervals[-1][1]:
+            merged_intervals[-1] = (merged_intervals[-1][0], max(end, merged_intervals[-1][1]))
+        else:
+            merged_intervals.append((start, end))
 
-        self.init_error()
+    return merged_intervals
+
+
+def _can_use_bar_store(ibcontract, barSizeSetting, whatToShow):
+    ## we need the conId to know where to keep the bars, and to be able to split the request into chunks
+    return (ibcontract.conId not in [None, 0] and barSizeSetting in MAX_DURATION_FOR_BAR_SIZE and
+            whatToShow not in WHAT_TO_SHOW_UP_TO_NOW)
+
+
+def _stitch_historical_data(list_of_historic_data, start_datetime, end_datetime):
+    """
+    Joins up historical data from several requests
+
+    :param list_of_historic_data: list of pd.DataFrame, which may overlap and be in any order
+    :return: pd.DataFrame, sorted with one row per bar, from start_datetime to end_datetime
+    """
+
+    list_of_historic_data = [historic_data for historic_data in list_of_historic_data if len(historic_data)>0]
+    if len(list_of_historic_data)==0:
+        ## an empty one, with the right columns
+        return historicalBarBuffer().get(timeout=0)
+
+    historic_data = pd.concat(list_of_historic_data).sort_index(kind="stable")
+
+    ## where requests overlap we get the same bar more than once
+    historic_data = historic_data[~historic_data.index.duplicated(keep="last")]
+
+    return historic_data[pd.Timestamp(_datetime_to_epoch(start_datetime), unit="s", tz="UTC"):
+                         pd.Timestamp(_datetime_to_epoch(end_datetime), unit="s", tz="UTC")]
+
+
+def resample_historical_data(historic_data, barSizeSetting, day_starts_at=DEFAULT_DAY_STARTS_AT,
+                             base_barSizeSetting=None, timezone=None):
+    """
+    Builds longer bars from shorter ones, the way IB would
+
+    Bars shorter than a day are lined up with the clock, except the first bar of each trading day starts when the
+       session does (eg with 1 hour bars, 09:30 then 10:00 then 11:00). Daily bars are labelled with the date of
+       the trading day, weekly with the Monday, and monthly with the first of the month.
+
+    :param historic_data: pd.DataFrame as from get_IB_historical_data
+    :param barSizeSetting: str, the bar size we want eg "5 mins", "1 hour", "1 day"
+    :param day_starts_at: datetime.timedelta, when each trading day starts relative to midnight
+    :param base_barSizeSetting: str, the bar size of historic_data; if None, worked out from the gaps between bars
+    :param timezone: str, the exchange's timezone eg "US/Eastern"; the clock and the trading days are in this. If
+        None, UTC
+    :return: pd.DataFrame, in the same form
+    """
+
+    index = historic_data.index
+    if index.tz is None:
+        index = index.tz_localize("UTC")
+
+    ## seconds since 1970 UTC, and how far ahead of that the exchange's clock is, for each bar
+    utc_times = index.tz_convert("UTC").tz_localize(None).values.astype("datetime64[s]").view(np.int64)
+
+    ## Daily bars are already trading days, labelled midnight UTC; moving them onto the exchange's clock, or by when
+    ##    the day starts, would put them on the day before
+    if base_barSizeSetting is None:
+        ## at least a day apart, and all at midnight
+        gaps = np.diff(utc_times)
+        whole_days = len(gaps)>0 and gaps.min()>=86400 and (utc_times % 86400==0).all()
+    else:
+        whole_days = base_barSizeSetting in CALENDAR_BAR_SIZES
+
+    if timezone is None or whole_days:
+        local_offsets = np.zeros(len(utc_times), dtype=np.int64)
+    else:
+        local_offsets = index.tz_convert(timezone).tz_localize(None).values.astype("datetime64[s]").view(
+            np.int64) - utc_times
+
+    ## the exchange's clock, and which trading day each bar is in
+    times = utc_times + local_offsets
+    if whole_days:
+        trading_days = times // 86400
+    else:
+        trading_days = (times - int(day_starts_at.total_seconds())) // 86400
+
+    if barSizeSetting in CALENDAR_BAR_SIZES:
+        day_labels = pd.DatetimeIndex((trading_days * 86400).view("datetime64[s]"))
+        if barSizeSetting=="1 day":
+            labels = day_labels
+        elif barSizeSetting=="1 week":
+            labels = day_labels - pd.to_timedelta(day_labels.dayofweek, unit="D")
+        else:
+            labels = day_labels.to_period("M").to_timestamp()
+        labels = labels.values.astype("datetime64[s]").view(np.int64)
+    else:
+        bar_seconds = _bar_size_seconds(barSizeSetting)
+        bar_starts = times - times % bar_seconds
+
+        ## the first bar of a trading day can't start before the session does
+        session_starts = pd.Series(times).groupby(trading_days).transform("min").values
+        labels = np.maximum(bar_starts, session_starts)
+
+    bars = historic_data.groupby(labels, sort=True)
+    resampled_data = bars.agg(open=("open", "first"), high=("high", "max"), low=("low", "min"),
+                              close=("close", "last"), volume=("volume", "sum"), barCount=("barCount", "sum"))
+
+    ## volume weighted; where there's no volume (eg MIDPOINT bars) just the average
+    volume = historic_data["volume"].clip(lower=0)
+    total_volume = volume.groupby(labels, sort=True).sum().values
+    weighted_wap = (historic_data["wap"] * volume).groupby(labels, sort=True).sum().values
+    mean_wap = historic_data["wap"].groupby(labels, sort=True).mean().values
+    with np.errstate(divide="ignore", invalid="ignore"):
+        resampled_data["wap"] = np.where(total_volume>0, weighted_wap / total_volume, mean_wap)
+
+    if barSizeSetting in CALENDAR_BAR_SIZES:
+        ## days rather than times, so midnight UTC as IB's own daily bars are
+        utc_labels = resampled_data.index.values
+    else:
+        utc_labels = pd.Series(labels - local_offsets).groupby(labels, sort=True).first().values
+
+    resampled_data.index = _epochs_to_index(utc_labels.astype(np.int64))
+
+    return resampled_data[BAR_COLUMNS]
+
+
+class multiResolutionHistoricalData(object):
+    """
+    One download of short bars, and all the longer bar sizes we can make from it
+
+    Only base_barSizeSetting comes from IB; the others are resampled locally the first time they're asked for,
+       and kept
+    """
+
+    def __init__(self, historic_data, base_barSizeSetting, day_starts_at=DEFAULT_DAY_STARTS_AT, timezone=None):
+        """
+        :param historic_data: pd.DataFrame as from get_IB_historical_data
+        :param base_barSizeSetting: str, the bar size of historic_data
+        :param day_starts_at: datetime.timedelta, see resample_historical_data
+        :param timezone: str, the exchange's timezone, see resample_historical_data
+        """
+
+        self.base_barSizeSetting = base_barSizeSetting
+        self._day_starts_at = day_starts_at
+        self._timezone = timezone
+        self._historic_data = {base_barSizeSetting: historic_data}
+
+    def __repr__(self):
+        return "Historical data resampled from %s bars: %s" % (self.base_barSizeSetting,
+                                                                 ", ".join(self._historic_data.keys()))
+
+    def get(self, barSizeSetting):
+        """
+        :param barSizeSetting: str eg "1 hour"; needs to be a whole number of base bars, or a calendar bar size
+        :return: pd.DataFrame as from get_IB_historical_data
+        """
+
+        if barSizeSetting not in self._historic_data:
+            base_seconds = _bar_size_seconds(self.base_barSizeSetting)
+            if barSizeSetting not in CALENDAR_BAR_SIZES and _bar_size_seconds(barSizeSetting) % base_seconds!=0:
+                raise Exception("Can't make %s bars out of %s bars" % (barSizeSetting, self.base_barSizeSetting))
+
+            self._historic_data[barSizeSetting] = resample_historical_data(
+                self._historic_data[self.base_barSizeSetting], barSizeSetting, day_starts_at=self._day_starts_at,
+                base_barSizeSetting=self.base_barSizeSetting, timezone=self._timezone)
+
+        return self._historic_data[barSizeSetting]
+
+
+## errors which are about the connection or the data farms, not about any one request
+CONNECTION_ERROR_CODES = [502, 504, 1100, 1101, 1102, 1300, 2103, 2104, 2105, 2106, 2107, 2108, 2110, 2119, 2157, 2158]
+
+
+def _is_warning(errorCode):
+    ## 2100-2199 are warnings; the request carries on regardless
+    return errorCode>=2100 and errorCode<2200
+
+## 162 is any historical data service problem, including pacing violations; this one just means there are no bars
+HISTORICAL_DATA_ERROR_CODE = 162
+NO_HISTORICAL_DATA_MESSAGE = "query returned no data"
+
+
+class IBerror(object):
+    """
+    An error message from the gateway
+    """
+
+    def __init__(self, id, errorCode, errorString):
+        """
+        :param id: reqId or orderId the error is about, -1 if it isn't about anything in particular
+        :param errorCode: int
+        :param errorString: str
+        """
+
+        self.id = id
+        self.errorCode = errorCode
+        self.errorString = errorString
+        self.timestamp = datetime.datetime.now()
+
+    def __repr__(self):
+        return "IB error id %d errorcode %d string %s" % (self.id, self.errorCode, self.errorString)
+
+    def is_connection_error(self):
+        return self.id==-1 or self.errorCode in CONNECTION_ERROR_CODES
+
+    def is_no_data(self):
+        ## eg asking for a weekend; the request worked, there just wasn't anything
+        return self.errorCode==HISTORICAL_DATA_ERROR_CODE and NO_HISTORICAL_DATA_MESSAGE in self.errorString
+
+
+
+class requestRegistry(object):
+    """
+    Hands out unique reqIds, and owns the channel (usually a finishableQueue) for each request in flight
+
+    The wrapper looks up the channel for whatever reqId it gets called with, so any number of requests can be
+    running at once over the same connection
+    """
+
+    def __init__(self, first_reqid=FIRST_REQUEST_ID):
+
+        self._lock = Lock()
+        self._next_reqid = first_reqid
+        self._channels = {}
+        self._times_requested = {}
+
+    def new_request(self, channel=None, reqId=None):
+        """
+        Register a new request
+
+        :param channel: where the wrapper will put the data; a new finishableQueue if not supplied
+        :param reqId: use this id rather than allocating one, eg if the caller wants a particular tickerid
+        :return: tuple reqId, channel
+        """
+
+        if channel is None:
+            channel = finishableQueue()
+
+        with self._lock:
+            if reqId is None:
+                reqId = self._next_reqid
+                self._next_reqid += 1
+            elif reqId in self._channels.keys():
+                raise Exception("reqId %d is already being used by a request in flight" % reqId)
+
+            self._channels[reqId] = channel
+            self._times_requested[reqId] = time.time()
+
+        return reqId, channel
+
+    def channel(self, reqId):
+        """
+        Called from the wrapper
+
+        :return: channel for reqId, or None if we never made this request or have released it
+        """
+        with self._lock:
+            return self._channels.get(reqId, None)
+
+    def release(self, reqId):
+        ## we're done with this request; anything else that arrives for it will be ignored
+        with self._lock:
+            self._channels.pop(reqId, None)
+            self._times_requested.pop(reqId, None)
+
+    def time_requested(self, reqId):
+        """
+        :return: time.time() when the request was registered, or None; any gap before it is sent is our queueing
+        """
+        with self._lock:
+            return self._times_requested.get(reqId, None)
+
+    def in_flight(self):
+        with self._lock:
+            return list(self._channels.keys())
+
+
+def contract_from_details(contract_details):
+    ## the resolved contract; older versions of the API call it summary
+    return getattr(contract_details, "contract", None) or contract_details.summary
+
+
+class pacingBucket(object):
+    """
+    Token bucket for one IB pacing limit, "no more than capacity requests in any period_seconds"
+
+    Each token comes back exactly period_seconds after it was taken, which is how IB counts
+    """
+
+    def __init__(self, capacity, period_seconds):
+
+        self._capacity = capacity
+        self._period_seconds = period_seconds
+        self._times_taken = deque()
+
+    def _return_tokens(self, time_now):
+        times_taken = self._times_taken
+        while len(times_taken)>0 and times_taken[0]<=time_now - self._period_seconds:
+            times_taken.popleft()
+
+    def seconds_until_available(self, time_now):
+        """
+        :return: 0 if we can take a token now, otherwise how long until one comes back
+        """
+        self._return_tokens(time_now)
+
+        if len(self._times_taken)<self._capacity:
+            return 0.0
+
+        return self._times_taken[0] + self._period_seconds - time_now
+
+    def take(self, time_now):
+        self._times_taken.append(time_now)
+
+    def is_idle(self, time_now):
+        ## all the tokens are back, so we can throw this bucket away
+        self._return_tokens(time_now)
+        return len(self._times_taken)==0
+
+
+class pacingTicket(object):
+    """
+    A request waiting in the pacingScheduler
+    """
+
+    def __init__(self, send_function, bucket_keys, priority):
+
+        self.send_function = send_function
+        self.bucket_keys = bucket_keys
+        self.priority = priority
+
+        self.time_sent = None
+        self.error = None
+        self.cancelled = False
+
+        self._sent = Event()
+        self._sent_callbacks = []
+        self._lock = Lock()
+
+    def wait_until_sent(self, timeout=None):
+        """
+        :return: True if the request has gone to the gateway; raises whatever the send function raised, if it did
+        """
+        sent = self._sent.wait(timeout)
+        if self.error is not None:
+            raise self.error
+
+        return sent
+
+    def add_sent_callback(self, sent_callback):
+        """
+        Call sent_callback() once the request has been sent, or straight away if it already has
+
+        It will usually be called from the scheduler thread, so it needs to be quick and thread safe
+        """
+        with self._lock:
+            already_sent = self._sent.is_set()
+            if not already_sent:
+                self._sent_callbacks.append(sent_callback)
+
+        if already_sent:
+            sent_callback()
+
+    def cancel(self):
+        ## if it hasn't been sent yet, it won't be
+        self.cancelled = True
+
+    def _mark_sent(self, time_sent=None, error=None):
+        ## error is what the send function raised, in which case it never got to the gateway
+        with self._lock:
+            self.time_sent = time_sent
+            self.error = error
+            self._sent.set()
+            sent_callbacks = self._sent_callbacks
+            self._sent_callbacks = []
+
+        for sent_callback in sent_callbacks:
+            sent_callback()
+
+
+def _contract_details_pacing_keys():
+    ## only the overall message rate applies
+    return [("messages",)]
+
+
+def _historical_data_pacing_keys(ibcontract, endDateTime, durationStr, barSizeSetting, whatToShow, useRTH):
+    if _bar_size_seconds(barSizeSetting)>MAX_SMALL_BAR_SECONDS:
+        ## only the overall message rate applies
+        return [("messages",)]
+
+    contract_key = (ibcontract.conId, ibcontract.symbol, ibcontract.secType,
+                    ibcontract.lastTradeDateOrContractMonth, ibcontract.exchange, whatToShow)
+    identical_key = contract_key + (endDateTime, durationStr, barSizeSetting, useRTH)
+
+    return [("messages",), ("historical",), ("identical",)+identical_key, ("contract",)+contract_key]
+
+
+def _historical_ticks_pacing_keys(ibcontract, startDateTime, whatToShow, useRth):
+    ## historical ticks count towards the same limits as small bars
+    contract_key = (ibcontract.conId, ibcontract.symbol, ibcontract.secType,
+                    ibcontract.lastTradeDateOrContractMonth, ibcontract.exchange, whatToShow)
+    identical_key = contract_key + (startDateTime, "ticks", useRth)
+
+    return [("messages",), ("historical",), ("identical",)+identical_key, ("contract",)+contract_key]
+
+
+def _bar_size_seconds(barSizeSetting):
+    ## "5 mins" -> 300
+    number, unit = barSizeSetting.split()
+    return int(number) * BAR_SIZE_UNIT_SECONDS[unit]
+
+
+def _duration_seconds(durationStr):
+    ## "2 D" -> 172800; months aren't a fixed length so we count the longest, and never ask for them in chunks
+    number, unit = durationStr.split()
+    return int(number) * DURATION_UNIT_SECONDS[unit]
+
+
+def _historical_data_chunks(start_datetime, end_datetime, barSizeSetting):
+    """
+    Splits a date range into requests IB will accept, working back from the end
+
+    :param start_datetime: datetime.datetime in UTC, without a timezone
+    :param end_datetime: datetime.datetime in UTC, without a timezone
+    :param barSizeSetting: str eg "1 min"
+    :return: list of tuples endDateTime, durationStr; newest first
+    """
+
+    if barSizeSetting not in MAX_DURATION_FOR_BAR_SIZE:
+        raise Exception("Don't know the longest duration IB allows for bar size %s" % barSizeSetting)
+
+    max_durationStr = MAX_DURATION_FOR_BAR_SIZE[barSizeSetting]
+    max_duration_seconds = _duration_seconds(max_durationStr)
+    in_seconds = max_durationStr.endswith("S")
+
+    chunks = []
+    chunk_end = end_datetime
+    while chunk_end>start_datetime:
+        seconds_left = (chunk_end - start_datetime).total_seconds()
+
+        if seconds_left>=max_duration_seconds:
+            durationStr = max_durationStr
+            chunk_seconds = max_duration_seconds
+        elif in_seconds:
+            chunk_seconds = int(math.ceil(seconds_left))
+            durationStr = "%d S" % chunk_seconds
+        else:
+            ## the last bit, rounded up to whole days; we trim off anything before start_datetime afterwards
+            days = int(math.ceil(seconds_left / 86400.0))
+            durationStr = "%d D" % days
+            chunk_seconds = days * 86400
+
+        chunks.append((_epoch_to_ib_datetime(_datetime_to_epoch(chunk_end)), durationStr))
+        chunk_end = chunk_end - datetime.timedelta(seconds=chunk_seconds)
+
+    return chunks
+
+
+class pacingScheduler(object):
+    """
+    Sits in front of the EClient request methods, holding requests back so we never break the IB pacing rules
+
+    Each request names the buckets it needs a token from, eg ("historical",) or ("contract", contract_key); the
+    first element picks the limit from pacing_limits. Waiting requests go out in priority order (lowest first),
+    but a request that is held up by its own limits doesn't hold up ones behind it that could go now.
+    """
+
+    def __init__(self, pacing_limits=PACING_LIMITS):
+        """
+        :param pacing_limits: dict, bucket type: tuple capacity, period_seconds
+        """
+
+        self._pacing_limits = pacing_limits
+        self._buckets = {}
+
+        ## sorted list of tuples (priority, sequence number, ticket)
+        self._waiting = []
+        self._sequence = 0
+
+        self._condition = Condition()
+        self._thread = None
+
+    def submit(self, send_function, bucket_keys, priority=HISTORICAL_DATA_PRIORITY):
+        """
+        Queue up a request
+
+        :param send_function: function with no arguments that calls the EClient method
+        :param bucket_keys: list of tuples, the first element of each is a key in pacing_limits
+        :param priority: lower numbers go first
+        :return: pacingTicket
+        """
+
+        ticket = pacingTicket(send_function, bucket_keys, priority)
+
+        with self._condition:
+            self._sequence += 1
+            insort(self._waiting, (priority, self._sequence, ticket), key=lambda waiting: waiting[:2])
+
+            if self._thread is None:
+                self._thread = Thread(target=self._run, daemon=True)
+                self._thread.start()
+
+            self._condition.notify_all()
+
+        return ticket
+
+    def waiting(self):
+        ## how many requests are held up
+        with self._condition:
+            return len(self._waiting)
+
+    def _bucket(self, bucket_key):
+        ## must hold the lock
+        bucket = self._buckets.get(bucket_key, None)
+        if bucket is None:
+            capacity, period_seconds = self._pacing_limits[bucket_key[0]]
+            bucket = self._buckets[bucket_key] = pacingBucket(capacity, period_seconds)
+
+        return bucket
+
+    def _next_ticket(self):
+        """
+        Waits until there is a request we can legally send now, takes its tokens, and returns it
+        """
+
+        with self._condition:
+            while True:
+                time_now = time.time()
+                seconds_to_wait = None
+
+                for waiting in list(self._waiting):
+                    ticket = waiting[2]
+
+                    if ticket.cancelled:
+                        self._waiting.remove(waiting)
+                        continue
+
+                    buckets = [self._bucket(bucket_key) for bucket_key in ticket.bucket_keys]
+                    seconds_until_available = max([bucket.seconds_until_available(time_now)
+                                                   for bucket in buckets] + [0.0])
+
+                    if seconds_until_available<=0:
+                        for bucket in buckets:
+                            bucket.take(time_now)
+
+                        self._waiting.remove(waiting)
+                        self._throw_away_idle_buckets(time_now)
+
+                        return ticket
+
+                    if seconds_to_wait is None or seconds_until_available<seconds_to_wait:
+                        seconds_to_wait = seconds_until_available
+
+                ## nothing can go yet; wait for a token to come back or a new request
+                self._condition.wait(seconds_to_wait)
+
+    def _throw_away_idle_buckets(self, time_now):
+        ## must hold the lock; otherwise we'd keep a bucket for every contract we've ever asked about
+        if len(self._buckets)<MAX_PACING_BUCKETS:
+            return
+
+        for bucket_key in [bucket_key for bucket_key, bucket in self._buckets.items() if bucket.is_idle(time_now)]:
+            del self._buckets[bucket_key]
+
+    def _run(self):
+        while True:
+            ticket = self._next_ticket()
+
+            try:
+                ticket.send_function()
+            except Exception as e:
+                ## whoever is waiting for it gets the exception
+                ticket._mark_sent(error=e)
+                continue
+
+            ticket._mark_sent(time.time())
+
+
+class contractResolution(object):
+    """
+    What happened when we tried to resolve one partially formed contract
+    """
+
+    def __init__(self, ibcontract, contract_details_list, error=None):
+        """
+        :param ibcontract: the partially formed contract we asked about
+        :param contract_details_list: list of ContractDetails we got back, empty if it failed
+        :param error: why it failed, if it did: IBerror from the gateway, or str
+        """
+
+        self.ibcontract = ibcontract
+        self.contract_details_list = contract_details_list
+        self.error = error
+
+    def __repr__(self):
+        if self.failed():
+            return "Failed to resolve %s: %s" % (self.ibcontract.symbol, str(self.error))
+
+        return "Resolved %s" % self.ibcontract.symbol
+
+    def failed(self):
+        return len(self.contract_details_list)==0
+
+    def resolved_ibcontract(self):
+        """
+        :return: fully resolved IB contract (the first one if there were several), or None if it failed
+        """
+        if self.failed():
+            return None
+
+        return contract_from_details(self.contract_details_list[0])
+
+
+class historicalDataBatch(object):
+    """
+    What happened when we got historical data for a lot of contracts at once
+    """
+
+    def __init__(self, data, errors):
+        """
+        :param data: pd.DataFrame indexed by (contract, date), columns as for get_IB_historical_data
+        :param errors: dict, keys are the contracts that failed, values why: IBerror from the gateway, or str
+        """
+
+        self.data = data
+        self.errors = errors
+
+    def __repr__(self):
+        return "Historical data for %d contracts, %d failed" % (len(self.data.index.unique(level="contract")),
+                                                                 len(self.errors))
+
+    def failed_keys(self):
+        return list(self.errors.keys())
+
+    def for_contract(self, key):
+        """
+        :return: pd.DataFrame indexed by date, for one contract
+        """
+        return self.data.xs(key, level="contract")
+
+
+## cache used for resolved contracts
+class contractDetailsCache(object):
+    """
+    Contract details we've already resolved, keyed by the partially formed contract we asked about
+
+    Recently used entries are kept in memory (least recently used are thrown away once we have max_entries),
+    everything is also kept on disk in a shelve file so that warm starts don't need to go to the gateway.
+    Entries older than ttl_seconds are treated as missing and deleted.
+    """
+
+    def __init__(self, filename=None, ttl_seconds=DEFAULT_CONTRACT_CACHE_TTL_SECONDS,
+                 max_entries=DEFAULT_CONTRACT_CACHE_MAX_ENTRIES):
+        """
+        :param filename: shelve file to store the cache in, or None to only cache in memory; shelve doesn't lock the
+            file, so it mustn't be shared with another client
+        :param ttl_seconds: how long before a cached entry is stale
+        :param max_entries: how many entries to keep in memory
+        """
+
+        self._lock = Lock()
+        self._memory_cache = OrderedDict()
+        self._ttl_seconds = ttl_seconds
+        self._max_entries = max_entries
+
+        if filename is None:
+            self._disk_cache = None
+        else:
+            self._disk_cache = shelve.open(filename)
+
+    def __repr__(self):
+        return "Contract details cache with %d entries in memory" % len(self._memory_cache)
+
+    def _cache_key(self, ibcontract):
+        """
+        Normalise the partially formed contract; shelve needs str keys
+
+        As well as symbol, secType, expiry, exchange and currency we include the option fields so different strikes
+        don't get mixed up, and everything else which can pick out a contract on its own (eg just a conId)
+
+        :return: str, or None if there's nothing in the contract to key on
+        """
+
+        key_fields = [ibcontract.conId, ibcontract.symbol, ibcontract.localSymbol, ibcontract.secType,
+                      ibcontract.lastTradeDateOrContractMonth, ibcontract.exchange, ibcontract.primaryExchange,
+                      ibcontract.currency, ibcontract.tradingClass,
+                      ibcontract.strike, ibcontract.right, ibcontract.multiplier]
+
+        key_fields = [str(field).strip().upper() for field in key_fields]
+
+        ## unset fields are blank, or zero for conId and strike
+        if all([field in ["", "0", "0.0"] for field in key_fields]):
+            return None
+
+        return "|".join(key_fields)
+
+    def _is_stale(self, time_cached):
+        return (time.time() - time_cached) > self._ttl_seconds
+
+    def get(self, ibcontract):
+        """
+        :param ibcontract: partially formed contract
+        :return: list of ContractDetails, or None if we don't have an up to date entry
+        """
+
+        cache_key = self._cache_key(ibcontract)
+        if cache_key is None:
+            return None
+
+        with self._lock:
+            cache_entry = self._memory_cache.get(cache_key, None)
+
+            if cache_entry is None and self._disk_cache is not None:
+                cache_entry = self._disk_cache.get(cache_key, None)
+
+            if cache_entry is None:
+                return None
+
+            time_cached, contract_details_list = cache_entry
+
+            if self._is_stale(time_cached):
+                self._delete(cache_key)
+                return None
+
+            self._add_to_memory_cache(cache_key, cache_entry)
+
+        return contract_details_list
+
+    def put(self, ibcontract, contract_details_list, sync=True):
+        """
+        :param ibcontract: partially formed contract
+        :param contract_details_list: list of ContractDetails we got back for it
+        :param sync: if True write the disk cache out now; pass False when adding a lot and call sync() after
+        """
+
+        cache_key = self._cache_key(ibcontract)
+        if cache_key is None:
+            return
+
+        cache_entry = (time.time(), contract_details_list)
+
+        with self._lock:
+            self._add_to_memory_cache(cache_key, cache_entry)
+
+            if self._disk_cache is not None:
+                self._disk_cache[cache_key] = cache_entry
+                if sync:
+                    self._disk_cache.sync()
+
+    def sync(self):
+        with self._lock:
+            if self._disk_cache is not None:
+                self._disk_cache.sync()
+
+    def purge_stale(self):
+        """
+        Delete anything that is out of date, in memory and on disk
+        """
+
+        with self._lock:
+            all_keys = set(self._memory_cache.keys())
+            if self._disk_cache is not None:
+                all_keys = all_keys.union(self._disk_cache.keys())
+
+            for cache_key in all_keys:
+                cache_entry = self._memory_cache.get(cache_key, None)
+                if cache_entry is None:
+                    cache_entry = self._disk_cache[cache_key]
+
+                if self._is_stale(cache_entry[0]):
+                    self._delete(cache_key)
+
+            if self._disk_cache is not None:
+                self._disk_cache.sync()
+
+    def close(self):
+        with self._lock:
+            if self._disk_cache is not None:
+                self._disk_cache.close()
+                self._disk_cache = None
+
+    def _add_to_memory_cache(self, cache_key, cache_entry):
+        ## must hold the lock
+        self._memory_cache[cache_key] = cache_entry
+        self._memory_cache.move_to_end(cache_key)
+
+        while len(self._memory_cache) > self._max_entries:
+            ## least recently used; still on disk
+            self._memory_cache.popitem(last=False)
+
+    def _delete(self, cache_key):
+        ## must hold the lock
+        self._memory_cache.pop(cache_key, None)
+
+        if self._disk_cache is not None and cache_key in self._disk_cache:
+            del self._disk_cache[cache_key]
+
+
+
+
+
+## numpy record for one bar in the store
+BAR_STORE_DTYPE=np.dtype([("time", np.int64)] + [(column, np.float64) for column in BAR_COLUMNS])
+
+## store used for historical bars
+class historicalBarStore(object):
+    """
+    Historical bars we've already downloaded, so we only need to ask the gateway for what's new
+
+    Partitioned by conId, bar size and whatToShow, then one .npy file of BAR_STORE_DTYPE records per calendar month,
+    which we memory map when reading. coverage.json in each partition lists the time ranges we've downloaded, so we
+    can tell a gap we haven't asked for from one where there weren't any bars (eg weekends).
+
+    All times are int seconds since 1970, as from _bar_date_to_epoch
+    """
+
+    def __init__(self, directory=DEFAULT_BAR_STORE_DIRECTORY):
+        """
+        :param directory: where to keep the files; created if it doesn't exist
+        """
+
+        self._directory = directory
+        self._lock = Lock()
+
+    def __repr__(self):
+        return "Historical bar store in %s" % self._directory
+
+    def _partition_directory(self, conId, barSizeSetting, whatToShow):
+        return os.path.join(self._directory, str(conId), barSizeSetting.replace(" ", "_"), whatToShow)
+
+    def _month_filename(self, partition_directory, month):
+        return os.path.join(partition_directory, "%s.npy" % month)
+
+    def _coverage_filename(self, partition_directory):
+        return os.path.join(partition_directory, "coverage.json")
+
+    def coverage(self, conId, barSizeSetting, whatToShow):
+        """
+        :return: sorted list of tuples (start, end) we have downloaded
+        """
+
+        coverage_filename = self._coverage_filename(self._partition_directory(conId, barSizeSetting, whatToShow))
+
+        with self._lock:
+            if not os.path.exists(coverage_filename):
+                return []
+
+            with open(coverage_filename) as coverage_file:
+                return [tuple(interval) for interval in json.load(coverage_file)]
+
+    def missing(self, conId, barSizeSetting, whatToShow, start, end):
+        """
+        :return: list of tuples (start, end), the parts of start to end we haven't downloaded
+        """
+
+        missing_intervals = []
+        missing_from = start
+        for covered_start, covered_end in self.coverage(conId, barSizeSetting, whatToShow):
+            if covered_end<=missing_from:
+                continue
+            if covered_start>=end:
+                break
+            if covered_start>missing_from:
+                missing_intervals.append((missing_from, covered_start))
+            missing_from = max(missing_from, covered_end)
+
+        if missing_from<end:
+            missing_intervals.append((missing_from, end))
+
+        return missing_intervals
+
+    def get(self, conId, barSizeSetting, whatToShow, start, end):
+        """
+        :return: pd.DataFrame as from historicalBarBuffer, of the bars we have from start to end inclusive
+        """
+
+        partition_directory = self._partition_directory(conId, barSizeSetting, whatToShow)
+
+        all_bars = []
+        with self._lock:
+            for month in _months_between(start, end):
+                month_filename = self._month_filename(partition_directory, month)
+                if not os.path.exists(month_filename):
+                    continue
+
+                month_bars = np.load(month_filename, mmap_mode="r")
+                times = month_bars["time"]
+                all_bars.append(np.array(month_bars[np.searchsorted(times, start, side="left"):
+                                                    np.searchsorted(times, end, side="right")]))
+
+        if len(all_bars)==0:
+            all_bars = np.empty(0, dtype=BAR_STORE_DTYPE)
+        else:
+            all_bars = np.concatenate(all_bars)
+
+        index = _epochs_to_index(all_bars["time"])
+
+        return pd.DataFrame(dict([(column, all_bars[column]) for column in BAR_COLUMNS]), index=index)
+
+    def put(self, conId, barSizeSetting, whatToShow, historic_data, covered_intervals):
+        """
+        Add bars to the store; where we already have a bar for the same time, the new one wins
+
+        :param historic_data: pd.DataFrame as from historicalBarBuffer
+        :param covered_intervals: list of tuples (start, end) that historic_data is complete for
+        """
+
+        partition_directory = self._partition_directory(conId, barSizeSetting, whatToShow)
+
+        new_bars = np.empty(len(historic_data), dtype=BAR_STORE_DTYPE)
+        new_bars["time"] = historic_data.index.tz_convert("UTC").tz_localize(None).values.astype(
+            "datetime64[s]").view(np.int64)
+        for column in BAR_COLUMNS:
+            new_bars[column] = historic_data[column].values
+
+        new_bar_months = np.array([_epoch_to_month(epoch) for epoch in new_bars["time"]])
+
+        with self._lock:
+            os.makedirs(partition_directory, exist_ok=True)
+
+            ## only the months we have new bars for get written
+            for month in np.unique(new_bar_months):
+                month_filename = self._month_filename(partition_directory, month)
+                month_bars = new_bars[new_bar_months==month]
+
+                if os.path.exists(month_filename):
+                    old_bars = np.load(month_filename)
+                    old_bars = old_bars[~np.isin(old_bars["time"], month_bars["time"])]
+                    month_bars = np.concatenate([old_bars, month_bars])
+
+                month_bars = month_bars[np.argsort(month_bars["time"], kind="stable")]
+
+                self._write_atomically(month_filename, lambda temp_file: np.save(temp_file, month_bars))
+
+            coverage_filename = self._coverage_filename(partition_directory)
+            if os.path.exists(coverage_filename):
+                with open(coverage_filename) as coverage_file:
+                    coverage = [tuple(interval) for interval in json.load(coverage_file)]
+            else:
+                coverage = []
+
+            coverage = _merge_intervals(coverage + [tuple(interval) for interval in covered_intervals])
+
+            self._write_atomically(coverage_filename, lambda temp_file: temp_file.write(json.dumps(coverage).encode()))
+
+    def _write_atomically(self, filename, write_function):
+        ## so a crash part way through can't leave a half written file
+        temp_filename = filename + ".tmp"
+        with open(temp_filename, "wb") as temp_file:
+            write_function(temp_file)
+
+        os.replace(temp_filename, filename)
+
+
+def _epoch_to_month(epoch):
+    ## 1514764800 -> "201801"
+    return time.strftime("%Y%m", time.gmtime(int(epoch)))
+
+
+def _months_between(start, end):
+    """
+    :return: list of str yyyymm, every month from the one start is in to the one end is in
+    """
+
+    start_time = time.gmtime(start)
+    end_time = time.gmtime(end)
+
+    months = []
+    year, month = start_time.tm_year, start_time.tm_mon
+    while (year, month)<=(end_time.tm_year, end_time.tm_mon):
+        months.append("%04d%02d" % (year, month))
+        month += 1
+        if month>12:
+            year, month = year+1, 1
+
+    return months
+
+
+class TestWrapper(EWrapper):
+    """
+    The wrapper deals with the action coming back from the IB gateway or TWS instance
+    We override methods in EWrapper that will get called when this action happens, like currentTime
+    Extra methods are added as we need to store the results in this object
+    """
+
+    ## error handling code
+    def init_error(self):
+        error_queue=queue.Queue()
+        self._my_errors = error_queue
+
+        ## connectivity and data farm messages go here, rather than in with everything else
+        connection_error_queue=queue.Queue()
+        self._my_connection_errors = connection_error_queue
+
+    def get_error(self, timeout=5):
+        if self.is_error():
+            try:
+                return self._my_errors.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        return None
+
+    def is_error(self):
+        an_error_if=not self._my_errors.empty()
+        return an_error_if
+
+    def get_connection_error(self, timeout=5):
+        if self.is_connection_error():
+            try:
+                return self._my_connection_errors.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        return None
+
+    def is_connection_error(self):
+        a_connection_error_if=not self._my_connection_errors.empty()
+        return a_connection_error_if
+
+    def error(self, id, errorCode, errorString):
+        ## Overriden method
+        ib_error = IBerror(id, errorCode, errorString)
+
+        if ib_error.is_connection_error():
+            self._my_connection_errors.put(ib_error)
+            return
+
+        if not _is_warning(errorCode):
+            ## If it's about a request we're waiting for, it fails now rather than when it times out
+            request_queue = self._requests.channel(id)
+            if request_queue is not None:
+                request_queue.fail(ib_error)
+                return
+
+        self._my_errors.put(ib_error)
+
+
+    ## get contract details code
+    ## the queue for each reqId is set up by the client, in its request registry
+    def contractDetails(self, reqId, contractDetails):
+        ## overridden method
+
+        contract_details_queue = self._requests.channel(reqId)
+        if contract_details_queue is None:
+            ## not something we asked for, or we've given up waiting for it
+            return
+
+        contract_details_queue.put(contractDetails)
+
+    def contractDetailsEnd(self, reqId):
+        ## overriden method
+
+        contract_details_queue = self._requests.channel(reqId)
+        if contract_details_queue is None:
+            return
+
+        contract_details_queue.finish()
+
+    ## Historic data code
+    ## the client registers a historicalBarBuffer for each tickerid
+    def historicalData(self, tickerid , bar):
+
+        ## Overriden method
+        historic_data_buffer = self._requests.channel(tickerid)
+        if historic_data_buffer is None:
+            return
+
+        historic_data_buffer.add_bar(bar)
+
+    def historicalDataEnd(self, tickerid, start:str, end:str):
+        ## overriden method
+
+        historic_data_queue = self._requests.channel(tickerid)
+        if historic_data_queue is None:
+            return
+
+        historic_data_queue.finish()
+
+    ## historical ticks; which of these we get depends on whatToShow
+    def historicalTicks(self, reqId, ticks, done):
+        ## overriden method, MIDPOINT
+        self._add_historical_ticks(reqId, ticks, done)
+
+    def historicalTicksBidAsk(self, reqId, ticks, done):
+        ## overriden method, BID_ASK
+        self._add_historical_ticks(reqId, ticks, done)
+
+    def historicalTicksLast(self, reqId, ticks, done):
+        ## overriden method, TRADES
+        self._add_historical_ticks(reqId, ticks, done)
+
+    def _add_historical_ticks(self, reqId, ticks, done):
+        historical_ticks_queue = self._requests.channel(reqId)
+        if historical_ticks_queue is None:
+            return
+
+        historical_ticks_queue.add_ticks(ticks, done)
+
+    def historicalDataUpdate(self, tickerid, bar):
+        ## overriden method; only keepUpToDate requests get these
+
+        historic_data_stream = self._requests.channel(tickerid)
+        if historic_data_stream is None:
+            return
+
+        historic_data_stream.update_bar(bar)
+
+
+
+
+class TestClient(EClient):
+    """
+    The client method
+    We don't override native methods, but instead call them from our own wrappers
+    """
+    def __init__(self, wrapper, contract_cache_filename=None):
+        """
+        :param contract_cache_filename: shelve file to keep resolved contracts in between runs, eg
+            DEFAULT_CONTRACT_CACHE_FILENAME; None to only keep them in memory
+        """
+        ## Set up with a wrapper inside
+        EClient.__init__(self, wrapper)
+
+        ## hands out reqIds, and keeps track of where the wrapper should put the data for each one
+        self._requests = requestRegistry()
+
+        ## contracts we've already resolved, so we don't have to ask again
+        self._contract_cache = contractDetailsCache(contract_cache_filename)
+
+        ## holds requests back so we don't break the IB pacing rules
+        self._pacing = pacingScheduler()
+
+        ## bars we've already downloaded, so we only ask for what's new
+        self._bar_store = historicalBarStore()
+
+        ## tickerid: pacingTicket, for keepUpToDate historical data requests
+        self._historical_streams = {}
+
+    def resolve_ib_contract(self, ibcontract, reqId=None):
+
+        """
+        From a partially formed contract, returns a fully fledged version
+        :param reqId: the identifier for the request; if None we get a new unique one
+        :returns fully resolved IB contract
+        """
+
+        new_contract_details = self._contract_cache.get(ibcontract)
+
+        if new_contract_details is None:
+            new_contract_details = self._get_contract_details_from_server(ibcontract, reqId)
+
+        if len(new_contract_details)==0:
+            print("Failed to get additional contract details: returning unresolved contract")
+            return ibcontract
+
+        if len(new_contract_details)>1:
+            print("got multiple contracts using first one")
+
+        new_contract_details=new_contract_details[0]
+
+        resolved_ibcontract=contract_from_details(new_contract_details)
+
+        return resolved_ibcontract
+
+    def resolve_ib_contracts(self, list_of_partial_contracts, max_in_flight=DEFAULT_MAX_CONTRACTS_IN_FLIGHT):
+        """
+        Resolves a lot of partially formed contracts, keeping up to max_in_flight requests going at once
+
+        This is a generator: results come back as they finish, which won't be the order we asked for them in
+
+        :param list_of_partial_contracts: list of Contract
+        :param max_in_flight: maximum number of contract details requests to have going at any one time
+        :returns yields tuples (index into list_of_partial_contracts, contractResolution)
+        """
+
+        ## Each request gets its own deadline, not reset as other contracts finish
+        MAX_WAIT_SECONDS = 10
+
+        try:
+            ## anything we already know about comes back straight away
+            contracts_to_send = []
+            for index, ibcontract in enumerate(list_of_partial_contracts):
+                cached_contract_details = self._contract_cache.get(ibcontract)
+                if cached_contract_details is None:
+                    contracts_to_send.append((index, ibcontract))
+                else:
+                    yield index, contractResolution(ibcontract, cached_contract_details)
+
+            yield from self._requests_in_window(contracts_to_send, self._send_contract_details_request,
+                                                self._collect_contract_resolution, max_in_flight, MAX_WAIT_SECONDS)
+
+        finally:
+            self._contract_cache.sync()
+
+    def _send_contract_details_request(self, request):
+        """
+        :param request: tuple index, ibcontract
+        :return: tuple reqId, contract_details_queue, pacingTicket
+        """
+
+        index_unused, ibcontract = request
+
+        reqId, contract_details_queue = self._requests.new_request()
+
+        pacing_ticket = self._pacing.submit(lambda: self.reqContractDetails(reqId, ibcontract),
+                                            _contract_details_pacing_keys(), priority=REFERENCE_DATA_PRIORITY)
+
+        return reqId, contract_details_queue, pacing_ticket
+
+    def _requests_in_window(self, requests_to_send, send, collect, max_in_flight, max_wait_seconds,
+                            cancel=None):
+        """
+        Sends a lot of requests, keeping up to max_in_flight going at once, and collects each one as soon as it's
+           finished or has run out of time
+
+        Each request gets its own deadline, max_wait_seconds after the pacing scheduler sends it. If we're stopped
+           early, whatever is still going is cancelled and released.
+
+        :param requests_to_send: list of whatever send needs to make each request
+        :param send: function(request) -> tuple reqId, finishableQueue, pacingTicket
+        :param collect: function(reqId, request, finishableQueue) -> whatever we yield; the queue is either
+            finished or past its deadline, so get(timeout=0) won't wait. It has to release reqId.
+        :param cancel: function(reqId) to cancel a request which has been sent, eg self.cancelHistoricalData; None
+            if there's no such thing
+        :returns yields whatever collect returns, in the order requests finish
+        """
+
+        requests_to_send = deque(requests_to_send)
+
+        ## reqId: (request, finishableQueue, pacingTicket)
+        requests_in_flight = {}
+
+        ## the wrapper drops reqIds in here as each request finishes
+        finished_reqids = queue.Queue()
+
+        try:
+            while len(requests_to_send)>0 or len(requests_in_flight)>0:
+
+                ## top up the window
+                while len(requests_to_send)>0 and len(requests_in_flight)<max_in_flight:
+                    request = requests_to_send.popleft()
+
+                    reqId, finishable_queue, pacing_ticket = send(request)
+                    finishable_queue.add_done_callback(lambda reqId=reqId: finished_reqids.put(reqId))
+
+                    def _fail_if_not_sent(pacing_ticket=pacing_ticket, finishable_queue=finishable_queue):
+                        ## if it couldn't be sent, it fails now rather than waiting for an answer that won't come
+                        if pacing_ticket.error is not None:
+                            finishable_queue.fail(pacing_ticket.error)
+
+                    pacing_ticket.add_sent_callback(_fail_if_not_sent)
+
+                    requests_in_flight[reqId] = (request, finishable_queue, pacing_ticket)
+
+                ## wait for something to finish, or the earliest deadline
+                ## the clock doesn't start for a request until the pacing scheduler has sent it
+                time_now = time.time()
+                deadlines = dict([(reqId, in_flight[2].time_sent + max_wait_seconds)
+                                  for reqId, in_flight in requests_in_flight.items()
+                                  if in_flight[2].time_sent is not None])
+                next_deadline = min(list(deadlines.values()) + [time_now + max_wait_seconds])
+
+                try:
+                    reqids_to_collect = [finished_reqids.get(timeout=max(next_deadline - time_now, 0))]
+                except queue.Empty:
+                    reqids_to_collect = []
+
+                time_now = time.time()
+                reqids_to_collect = reqids_to_collect + [reqId for reqId, deadline in deadlines.items()
+                                                         if deadline<=time_now and reqId not in reqids_to_collect]
+
+                while self.wrapper.is_error():
+                    print(self.get_error())
+
+                for reqId in reqids_to_collect:
+                    if reqId not in requests_in_flight.keys():
+                        ## already dealt with as a time out
+                        continue
+
+                    request, finishable_queue, pacing_ticket_unused = requests_in_flight.pop(reqId)
+                    yield collect(reqId, request, finishable_queue)
+
+        finally:
+            ## we might have been stopped early
+            for reqId, in_flight in requests_in_flight.items():
+                in_flight[2].cancel()
+                if cancel is not None and in_flight[2].time_sent is not None:
+                    cancel(reqId)
+                self._requests.release(reqId)
+
+    def _collect_contract_resolution(self, reqId, request, contract_details_queue):
+        """
+        :param request: tuple index, ibcontract
+        :return: tuple index, contractResolution
+        """
+
+        index, ibcontract = request
+
+        ## won't wait, it's either finished or we've run out of time
+        new_contract_details = contract_details_queue.get(timeout=0)
+        self._requests.release(reqId)
+
+        if contract_details_queue.failed():
+            ## eg error 200, no security definition has been found
+            error = contract_details_queue.error
+        elif contract_details_queue.finished():
+            if len(new_contract_details)==0:
+                error = "No contract details returned"
+            else:
+                error = None
+                self._contract_cache.put(ibcontract, new_contract_details, sync=False)
+        else:
+            error = "Exceeded maximum wait for wrapper to confirm finished"
+
+            ## don't use a partial answer
+            new_contract_details = []
+
+        return index, contractResolution(ibcontract, new_contract_details, error=error)
+
+    def _get_contract_details_from_server(self, ibcontract, reqId=None):
+        """
+        Asks the gateway for contract details, and caches them if we get a complete answer
+
+        :returns list of ContractDetails
+        """
+
+        ## Make a place to store the data we're going to return
+        reqId, contract_details_queue = self._requests.new_request(reqId=reqId)
+
+        print("Getting full contract details from the server... ")
+
+        pacing_ticket = self._pacing.submit(lambda: self.reqContractDetails(reqId, ibcontract),
+                                            _contract_details_pacing_keys(), priority=REFERENCE_DATA_PRIORITY)
+        try:
+            pacing_ticket.wait_until_sent()
+        except Exception:
+            self._requests.release(reqId)
+            raise
+
+        ## Run until we get a valid contract(s) or get bored waiting
+        MAX_WAIT_SECONDS = 10
+        new_contract_details = contract_details_queue.get(timeout = MAX_WAIT_SECONDS)
+        self._requests.release(reqId)
+
+        while self.wrapper.is_error():
+            print(self.get_error())
+
+        if contract_details_queue.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished")
+
+        if contract_details_queue.failed():
+            print(contract_details_queue.error)
+
+        if contract_details_queue.finished() and len(new_contract_details)>0:
+            self._contract_cache.put(ibcontract, new_contract_details)
+
+        return new_contract_details
+
+
+    def get_IB_historical_data(self, ibcontract, durationStr="1 Y", barSizeSetting="1 day",
+                               tickerid=None, whatToShow="TRADES", formatDate=DEFAULT_FORMAT_DATE,
+                               tws_timezone=DEFAULT_TWS_TIMEZONE):
+
+        """
+        Returns historical prices for a contract, up to today
+        ibcontract is a Contract
+        tickerid is the identifier for the request; if None we get a new unique one
+        whatToShow is eg "TRADES", "MIDPOINT", "BID", "ASK", "ADJUSTED_LAST"
+        formatDate is 2 to have intraday bar times sent as seconds since 1970, 1 for TWS local time strings; either
+            way they end up in UTC
+        tws_timezone is the timezone TWS is logged in with eg "US/Eastern"; with formatDate=1, that's what bar times
+            without a timezone are in
+        :returns pd.DataFrame indexed by date in UTC, columns open high low close volume wap barCount
+        """
+
+        ## the bar store always asks for bar times as seconds since 1970; if the caller wants them sent some other way,
+        ##    they get the one request they asked for
+        use_bar_store = tickerid is None and formatDate==DEFAULT_FORMAT_DATE and tws_timezone==DEFAULT_TWS_TIMEZONE
+
+        if use_bar_store and _can_use_bar_store(ibcontract, barSizeSetting, whatToShow):
+            ## only ask for the bars we haven't already got
+            end_datetime = _utc_now()
+            start_datetime = end_datetime - datetime.timedelta(seconds=_duration_seconds(durationStr))
+
+            return self.get_IB_historical_data_range(ibcontract, start_datetime, end_datetime,
+                                                     barSizeSetting=barSizeSetting, whatToShow=whatToShow)
+
+        tickerid, historic_data_queue, pacing_ticket = self._request_historical_data(ibcontract, durationStr,
+                                                                                     barSizeSetting, tickerid,
+                                                                                     whatToShow=whatToShow,
+                                                                                     formatDate=formatDate,
+                                                                                     tws_timezone=tws_timezone)
+
+        ## The pacing scheduler might hold the request back; the clock starts once it's gone
+        try:
+            if not pacing_ticket.wait_until_sent(PACING_NOTICE_SECONDS):
+                print("Waiting to send historical data request so we don't break pacing rules")
+                pacing_ticket.wait_until_sent()
+        except Exception:
+            self._requests.release(tickerid)
+            raise
+
+        ## Wait until we get a completed data, an error, or get bored waiting
+        MAX_WAIT_SECONDS = 10
+        print("Getting historical data from the server... could take %d seconds to complete " % MAX_WAIT_SECONDS)
+
+        historic_data = historic_data_queue.get(timeout = MAX_WAIT_SECONDS)
+
+        while self.wrapper.is_error():
+            print(self.get_error())
+
+        if historic_data_queue.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished")
+
+        if historic_data_queue.failed():
+            print(historic_data_queue.error)
+
+        if historic_data_queue.partial():
+            print("Only got %d bars before giving up: data is incomplete" % len(historic_data))
+
+        self.cancelHistoricalData(tickerid)
+        self._requests.release(tickerid)
+
+
+        return historic_data
+
+    def get_IB_historical_data_range(self, ibcontract, start_datetime, end_datetime=None, barSizeSetting="1 min",
+                                     max_in_flight=DEFAULT_MAX_HISTORICAL_CHUNKS_IN_FLIGHT, whatToShow="TRADES"):
+        """
+        Returns historical prices for a contract between two dates, however far apart they are
+
+        IB limits how much history we can get in one request, so this splits it into as many requests as it needs,
+           keeping up to max_in_flight of them going at once, and stitches the answers together
+
+        If the contract has a conId, bars we've downloaded before come from the bar store, and we only ask IB for
+           the gaps
+
+        :param start_datetime: datetime.datetime; UTC unless it has a timezone
+        :param end_datetime: datetime.datetime, or None for now; UTC unless it has a timezone
+        :param max_in_flight: maximum number of historical data requests to have going at any one time
+        :param whatToShow: str eg "TRADES", "MIDPOINT"; not "ADJUSTED_LAST", which can only run up to now
+        :returns pd.DataFrame indexed by date, columns open high low close volume wap barCount; sorted, one row per
+            bar, and only including bars from start_datetime to end_datetime
+        """
+
+        if whatToShow in WHAT_TO_SHOW_UP_TO_NOW:
+            raise Exception("Can't get %s in chunks, as IB will only give it to us up to now" % whatToShow)
+
+        ## Each chunk gets its own deadline, once it has been sent
+        MAX_WAIT_SECONDS = 30
+
+        if end_datetime is None:
+            end_datetime = _utc_now()
+
+        use_bar_store = _can_use_bar_store(ibcontract, barSizeSetting, whatToShow)
+
+        start_epoch = _datetime_to_epoch(start_datetime)
+        end_epoch = _datetime_to_epoch(end_datetime)
+
+        if use_bar_store:
+            missing_intervals = self._bar_store.missing(ibcontract.conId, barSizeSetting, whatToShow,
+                                                        start_epoch, end_epoch)
+        else:
+            missing_intervals = [(start_epoch, end_epoch)]
+
+        ## tuples endDateTime, durationStr; newest first
+        chunks_to_send = deque()
+        for missing_start, missing_end in reversed(missing_intervals):
+            chunks_to_send.extend(_historical_data_chunks(_epoch_to_datetime(missing_start),
+                                                          _epoch_to_datetime(missing_end), barSizeSetting))
+        print("Getting historical data in %d requests" % len(chunks_to_send))
+
+        ## the last bar might still be forming, so we don't count it as downloaded
+        latest_complete_epoch = int(time.time()) - _bar_size_seconds(barSizeSetting)
+
+        ## tuples start, end that we got all the bars for
+        covered_intervals = []
+
+        def _send_chunk(chunk):
+            endDateTime, durationStr = chunk
+            return self._request_historical_data(ibcontract, durationStr, barSizeSetting, endDateTime=endDateTime,
+                                                 whatToShow=whatToShow)
+
+        def _collect_chunk(tickerid, chunk, historic_data_queue):
+            historic_data = self._collect_historical_chunk(tickerid, chunk, historic_data_queue)
+
+            if historic_data_queue.finished() or \
+                    (historic_data_queue.failed() and historic_data_queue.error.is_no_data()):
+                ## we know there aren't any more bars, even if there weren't any at all; so we won't ask again
+                endDateTime, durationStr = chunk
+                chunk_end = _bar_date_to_epoch(endDateTime)
+                chunk_start = chunk_end - _duration_seconds(durationStr)
+                covered_intervals.append((max(chunk_start, start_epoch),
+                                          min(chunk_end, end_epoch, latest_complete_epoch)))
+
+            return historic_data
+
+        all_historic_data = list(self._requests_in_window(chunks_to_send, _send_chunk, _collect_chunk, max_in_flight,
+                                                          MAX_WAIT_SECONDS, cancel=self.cancelHistoricalData))
+
+        historic_data = _stitch_historical_data(all_historic_data, start_datetime, end_datetime)
+
+        if not use_bar_store:
+            return historic_data
+
+        covered_intervals = [(start, end) for start, end in covered_intervals if end>start]
+        self._bar_store.put(ibcontract.conId, barSizeSetting, whatToShow, historic_data, covered_intervals)
+
+        return self._bar_store.get(ibcontract.conId, barSizeSetting, whatToShow, start_epoch, end_epoch)
+
+    def iterate_IB_historical_data(self, ibcontract, durationStr="1 Y", barSizeSetting="1 day", whatToShow="TRADES"):
+        """
+        Historical prices for a contract, up to today, in blocks as they arrive rather than all at the end
+
+        This is a generator; if we stop early the request is cancelled. If the request fails or times out, it
+           raises an Exception.
+
+        :returns yields pd.DataFrame indexed by date, columns open high low close volume wap barCount
+        """
+
+        tickerid, historic_data_queue, pacing_ticket = self._request_historical_data(ibcontract, durationStr,
+                                                                                     barSizeSetting,
+                                                                                     whatToShow=whatToShow)
+
+        try:
+            yield from self._historical_data_blocks(historic_data_queue, pacing_ticket)
+        finally:
+            self._finish_historical_request(tickerid, historic_data_queue, pacing_ticket)
+
+    def iterate_IB_historical_data_range(self, ibcontract, start_datetime, end_datetime=None, barSizeSetting="1 min",
+                                         whatToShow="TRADES", max_ahead=DEFAULT_MAX_HISTORICAL_CHUNKS_AHEAD):
+        """
+        Historical prices for a contract between two dates, in blocks as they arrive, oldest first
+
+        Split into requests as get_IB_historical_data_range, but we only get up to max_ahead requests ahead of
+           whoever is using the bars, so if they're slower than the gateway we don't keep piling up bars
+
+        This is a generator; if we stop early the requests are cancelled. If a request fails or times out, it raises
+           an Exception, so there's never a gap in what we've yielded.
+
+        :param start_datetime: datetime.datetime; UTC unless it has a timezone
+        :param end_datetime: datetime.datetime, or None for now; UTC unless it has a timezone
+        :param max_ahead: maximum number of requests to have sent, but not yet used
+        :returns yields pd.DataFrame indexed by date, columns open high low close volume wap barCount; each bar
+            only once, and only from start_datetime to end_datetime
+        """
+
+        if whatToShow in WHAT_TO_SHOW_UP_TO_NOW:
+            raise Exception("Can't get %s in chunks, as IB will only give it to us up to now" % whatToShow)
+
+        start_datetime = _utc_datetime(start_datetime)
+        if end_datetime is None:
+            end_datetime = _utc_now()
+        else:
+            end_datetime = _utc_datetime(end_datetime)
+
+        chunks_to_send = deque(reversed(_historical_data_chunks(start_datetime, end_datetime, barSizeSetting)))
+
+        ## tuples tickerid, historicalBarBuffer, pacingTicket; oldest first
+        chunks_in_flight = deque()
+
+        ## so we don't send the same bar twice where requests overlap, or any bars from before start_datetime
+        last_bar_time = np.datetime64(_datetime_to_epoch(start_datetime) - 1, "s")
+        end_bar_time = np.datetime64(_datetime_to_epoch(end_datetime), "s")
+
+        try:
+            while len(chunks_to_send)>0 or len(chunks_in_flight)>0:
+                while len(chunks_to_send)>0 and len(chunks_in_flight)<max_ahead:
+                    endDateTime, durationStr = chunks_to_send.popleft()
+                    chunks_in_flight.append(self._request_historical_data(ibcontract, durationStr, barSizeSetting,
+                                                                          endDateTime=endDateTime,
+                                                                          whatToShow=whatToShow))
+
+                tickerid, historic_data_queue, pacing_ticket = chunks_in_flight[0]
+
+                for historic_data in self._historical_data_blocks(historic_data_queue, pacing_ticket):
+                    bar_times = historic_data.index.values
+                    historic_data = historic_data[(bar_times>last_bar_time) & (bar_times<=end_bar_time)]
+                    if len(historic_data)>0:
+                        last_bar_time = historic_data.index.values[-1]
+                        yield historic_data
+
+                self._finish_historical_request(*chunks_in_flight.popleft())
+
+        finally:
+            ## we might have been stopped early
+            for chunk in chunks_in_flight:
+                self._finish_historical_request(*chunk)
+
+    def _historical_data_blocks(self, historic_data_queue, pacing_ticket):
+        """
+        :returns yields pd.DataFrame, as each lot of bars arrives, until the request is finished; raises Exception if
+            it fails or we give up waiting, rather than quietly stopping short
+        """
+
+        ## if nothing arrives for this long
+        MAX_WAIT_SECONDS = 30
+
+        if not pacing_ticket.wait_until_sent(PACING_NOTICE_SECONDS):
+            print("Waiting to send historical data request so we don't break pacing rules")
+            pacing_ticket.wait_until_sent()
+
+        finished = False
+        while not finished:
+            historic_data, finished = self._take_historical_block(historic_data_queue, timeout=MAX_WAIT_SECONDS)
+            if len(historic_data)>0:
+                yield historic_data
+
+    def _take_historical_block(self, historic_data_queue, timeout):
+        """
+        One go round the loop for iterating over historical data; asyncapp uses this as well
+
+        :param timeout: how long to wait for some bars; 0 if we've already waited
+        :return: tuple pd.DataFrame possibly empty, bool True if there are no more bars to come
+        """
+
+        historic_data = historic_data_queue.get_block(timeout=timeout)
+
+        while self.wrapper.is_error():
+            print(self.get_error())
+
+        if historic_data_queue.failed():
+            if historic_data_queue.error.is_no_data():
+                ## eg a weekend; not a gap, there just aren't any bars
+                return historic_data, True
+
+            raise Exception("Historical data request failed: %s" % str(historic_data_queue.error))
+
+        if historic_data_queue.timed_out():
+            raise Exception("Exceeded maximum wait for next historical data")
+
+        return historic_data, historic_data_queue.finished()
+
+    def _finish_historical_request(self, tickerid, historic_data_queue, pacing_ticket):
+        ## cancel it if it isn't done with, and forget about it
+        pacing_ticket.cancel()
+        if pacing_ticket.time_sent is not None and not (historic_data_queue.finished() or
+                                                        historic_data_queue.failed()):
+            self.cancelHistoricalData(tickerid)
+
+        self._requests.release(tickerid)
+
+    def get_IB_historical_data_resolutions(self, ibcontract, start_datetime, end_datetime=None,
+                                           base_barSizeSetting="1 min", day_starts_at=DEFAULT_DAY_STARTS_AT,
+                                           timezone=None):
+        """
+        Gets short bars for a contract, from which we can make any longer bar size without asking IB again
+
+        :param start_datetime: datetime.datetime; UTC unless it has a timezone
+        :param end_datetime: datetime.datetime, or None for now; UTC unless it has a timezone
+        :param base_barSizeSetting: str, the only bar size we download
+        :param day_starts_at: datetime.timedelta, when each trading day starts relative to midnight
+        :param timezone: str, the exchange's timezone eg "US/Eastern", for lining up longer bars; None for UTC
+        :returns multiResolutionHistoricalData
+        """
+
+        historic_data = self.get_IB_historical_data_range(ibcontract, start_datetime, end_datetime,
+                                                          barSizeSetting=base_barSizeSetting)
+
+        return multiResolutionHistoricalData(historic_data, base_barSizeSetting, day_starts_at=day_starts_at,
+                                             timezone=timezone)
+
+    def get_IB_historical_data_batch(self, list_of_ibcontracts, durationStr="1 Y", barSizeSetting="1 day",
+                                     keys=None, whatToShow="TRADES",
+                                     max_in_flight=DEFAULT_MAX_HISTORICAL_REQUESTS_IN_FLIGHT):
+        """
+        Returns the same historical prices for a lot of contracts, up to the same time
+
+        Keeps up to max_in_flight requests going at once, each with its own reqId; the pacing scheduler makes sure
+           they don't break the pacing rules between them
+
+        :param list_of_ibcontracts: list of Contract
+        :param keys: list of labels for the contracts, one each; if None we use the symbols, which need to be unique
+        :param max_in_flight: maximum number of historical data requests to have going at any one time
+        :returns historicalDataBatch
+        """
+
+        if keys is None:
+            keys = [ibcontract.symbol for ibcontract in list_of_ibcontracts]
+            if len(set(keys))<len(keys):
+                raise Exception("Symbols aren't unique, so you need to supply keys")
+        elif len(keys)!=len(list_of_ibcontracts):
+            raise Exception("Need one key for each contract")
+
+        print("Getting historical data for %d contracts" % len(keys))
+
+        all_historic_data, errors = self._get_historical_data_concurrently(
+            [(key, ibcontract, whatToShow) for key, ibcontract in zip(keys, list_of_ibcontracts)],
+            durationStr, barSizeSetting, max_in_flight)
+
+        ## back in the order we were asked for
+        all_historic_data = [(key, all_historic_data[key]) for key in keys if key in all_historic_data]
+
+        if len(all_historic_data)==0:
+            empty_historic_data = historicalBarBuffer().get(timeout=0)
+            data = empty_historic_data.set_index(pd.MultiIndex.from_arrays([[], empty_historic_data.index],
+                                                                           names=["contract", "date"]))
+        else:
+            data = pd.concat(dict(all_historic_data), names=["contract", "date"])
+
+        return historicalDataBatch(data, errors)
+
+    def get_IB_historical_data_fields(self, ibcontract, list_of_whatToShow=DEFAULT_WHAT_TO_SHOW_FIELDS,
+                                      durationStr="1 Y", barSizeSetting="1 day"):
+        """
+        Returns several kinds of historical prices for one contract, eg trades and midpoints, side by side
+
+        All the requests go at once, and the answers are lined up by date; where one kind has a bar and another
+           doesn't, the missing one is NaN
+
+        :param list_of_whatToShow: list of str eg ["TRADES", "MIDPOINT", "BID", "ASK", "ADJUSTED_LAST"]
+        :returns pd.DataFrame indexed by date, with two levels of columns: whatToShow, then open high low close
+            volume wap barCount
+        """
+
+        all_historic_data, errors = self._get_historical_data_concurrently(
+            [(whatToShow, ibcontract, whatToShow) for whatToShow in list_of_whatToShow],
+            durationStr, barSizeSetting, max_in_flight=len(list_of_whatToShow))
+
+        for whatToShow, error in errors.items():
+            print("Historical data for %s: %s" % (whatToShow, str(error)))
+
+        ## failed ones are all NaN, so we always get the same columns back
+        empty_historic_data = historicalBarBuffer().get(timeout=0)
+        all_historic_data = dict([(whatToShow, all_historic_data.get(whatToShow, empty_historic_data))
+                                  for whatToShow in list_of_whatToShow])
+
+        return pd.concat(all_historic_data, axis=1, join="outer", names=["whatToShow", None]).sort_index()
+
+    def _get_historical_data_concurrently(self, list_of_requests, durationStr, barSizeSetting, max_in_flight):
+        """
+        Sends a lot of historical data requests, keeping up to max_in_flight going at once, all up to the same time
+
+        :param list_of_requests: list of tuples key, Contract, whatToShow
+        :returns tuple: dict of pd.DataFrame, dict of errors, both keyed by key
+        """
+
+        ## Each request gets its own deadline, once it has been sent
+        MAX_WAIT_SECONDS = 30
+
+        ## everything runs up to the same time
+        endDateTime = _epoch_to_ib_datetime(int(time.time()))
+
+        all_historic_data = {}
+        errors = {}
+
+        def _send_request(request):
+            key_unused, ibcontract, whatToShow = request
+            return self._request_historical_data(ibcontract, durationStr, barSizeSetting, endDateTime=endDateTime,
+                                                 whatToShow=whatToShow)
+
+        for key, historic_data, error in self._requests_in_window(list_of_requests, _send_request,
+                                                                  self._collect_historical_batch_request,
+                                                                  max_in_flight, MAX_WAIT_SECONDS,
+                                                                  cancel=self.cancelHistoricalData):
+            if error is None:
+                all_historic_data[key] = historic_data
+            else:
+                errors[key] = error
+
+        return all_historic_data, errors
+
+    def _collect_historical_batch_request(self, tickerid, request, historic_data_queue):
+        """
+        :param request: tuple key, Contract, whatToShow
+        :return: tuple key, pd.DataFrame, error; error is None unless it failed
+        """
+
+        key = request[0]
+
+        ## won't wait, it's either finished or we've run out of time
+        historic_data = historic_data_queue.get(timeout=0)
+
+        if historic_data_queue.failed():
+            error = historic_data_queue.error
+        elif historic_data_queue.finished():
+            error = None
+        else:
+            ## don't use a partial answer
+            error = "Exceeded maximum wait for wrapper to confirm finished, got %d bars" % len(historic_data)
+            self.cancelHistoricalData(tickerid)
+
+        self._requests.release(tickerid)
+
+        return key, historic_data, error
+
+    def get_IB_historical_ticks(self, ibcontract, start_datetime, end_datetime=None, whatToShow="TRADES"):
+        """
+        Historical ticks for a contract, a page at a time, working forward from start_datetime
+
+        IB only sends MAX_HISTORICAL_TICKS_PER_REQUEST ticks for each request, so we keep asking from where the
+           last page got to. Tick times are only to the second, so the next page starts at the same second as the
+           last tick, and we drop the ticks in that second we've already had.
+
+        This is a generator: pd.concat what it yields to get everything in one go
+
+        :param start_datetime: datetime.datetime; UTC unless it has a timezone
+        :param end_datetime: datetime.datetime, or None for now; UTC unless it has a timezone
+        :param whatToShow: str "TRADES", "BID_ASK" or "MIDPOINT"
+        :returns yields pd.DataFrame indexed by time, columns as HISTORICAL_TICK_COLUMNS[whatToShow]
+        """
+
+        if whatToShow not in HISTORICAL_TICK_COLUMNS:
+            raise Exception("Historical ticks can only be one of %s" % ", ".join(HISTORICAL_TICK_COLUMNS.keys()))
+
+        if end_datetime is None:
+            end_datetime = _utc_now()
+
+        page_start = _datetime_to_epoch(start_datetime)
+        end_epoch = _datetime_to_epoch(end_datetime)
+
+        ## how many ticks we've already had in the second page_start
+        ticks_already_had = 0
+
+        while page_start<=end_epoch:
+            historical_ticks = self._get_historical_ticks_page(ibcontract, page_start, whatToShow)
+            if historical_ticks is None:
+                ## it failed, which has been reported
+                return
+
+            times = historical_ticks.index.values.astype("datetime64[s]").view(np.int64)
+            repeated_ticks = min(ticks_already_had, int(np.count_nonzero(times==page_start)))
+            new_ticks = historical_ticks.iloc[repeated_ticks:]
+
+            if len(new_ticks)==0:
+                if len(historical_ticks)<MAX_HISTORICAL_TICKS_PER_REQUEST:
+                    ## nothing more up to now
+                    return
+
+                ## a whole page of ticks in the one second, and we've had them; IB always sends all the ticks in
+                ## the last second of a page, so that's all of them
+                page_start += 1
+                ticks_already_had = 0
+                continue
+
+            new_times = times[repeated_ticks:]
+            if new_times[0]<=end_epoch:
+                yield new_ticks[new_times<=end_epoch]
+
+            last_tick_time = int(new_times[-1])
+            if last_tick_time>end_epoch or len(historical_ticks)<MAX_HISTORICAL_TICKS_PER_REQUEST:
+                ## we've got as far as we need to, or as far as there is
+                return
+
+            if last_tick_time==page_start:
+                ticks_already_had += len(new_ticks)
+            else:
+                page_start = last_tick_time
+                ticks_already_had = int(np.count_nonzero(new_times==last_tick_time))
+
+    def _get_historical_ticks_page(self, ibcontract, page_start, whatToShow):
+        """
+        One reqHistoricalTicks request
+
+        :param page_start: int seconds since 1970
+        :returns pd.DataFrame, or None if it failed
+        """
+
+        ## once it's been sent
+        MAX_WAIT_SECONDS = 30
+
+        reqId, historical_ticks_queue = self._requests.new_request(channel=historicalTickBuffer(whatToShow))
+
+        startDateTime = _epoch_to_ib_datetime(page_start)
+        useRth = 1
+
+        pacing_ticket = self._pacing.submit(
+            lambda: self.reqHistoricalTicks(reqId, ibcontract, startDateTime, "", MAX_HISTORICAL_TICKS_PER_REQUEST,
+                                            whatToShow, useRth, True, []),
+            _historical_ticks_pacing_keys(ibcontract, startDateTime, whatToShow, useRth),
+            priority=HISTORICAL_DATA_PRIORITY)
+
+        try:
+            pacing_ticket.wait_until_sent()
+            historical_ticks = historical_ticks_queue.get(timeout=MAX_WAIT_SECONDS)
+        finally:
+            ## if we've been stopped early
+            pacing_ticket.cancel()
+            self._requests.release(reqId)
+
+        while self.wrapper.is_error():
+            print(self.get_error())
+
+        if historical_ticks_queue.failed():
+            print("Historical ticks from %s: %s" % (startDateTime, str(historical_ticks_queue.error)))
+            return None
+
+        if historical_ticks_queue.timed_out():
+            print("Historical ticks from %s: exceeded maximum wait for wrapper to confirm finished" % startDateTime)
+            return None
+
+        return historical_ticks
+
+    def start_streaming_IB_historical_data(self, ibcontract, durationStr="1 D", barSizeSetting="1 min",
+                                           on_bar_close=None, max_bars=DEFAULT_MAX_STREAMING_BARS, tickerid=None,
+                                           whatToShow="TRADES"):
+        """
+        Kick off a keepUpToDate historical data request: we get durationStr of history up to now, then the gateway
+           keeps the latest bar current until we stop it
+
+        :param on_bar_close: function called with a pd.Series each time a bar closes, see historicalBarStream
+        :param max_bars: how many of the most recent bars to keep
+        :param tickerid: the identifier for the request; if None we get a new unique one
+        :return: tickerid
+        """
+
+        tickerid, historic_data_stream, pacing_ticket = self._request_historical_data(
+            ibcontract, durationStr, barSizeSetting, tickerid,
+            channel=historicalBarStream(max_bars=max_bars, on_bar_close=on_bar_close), keepUpToDate=True,
+            whatToShow=whatToShow)
+
+        self._historical_streams[tickerid] = pacing_ticket
+
+        return tickerid
+
+    def get_IB_streaming_historical_data(self, tickerid):
+        """
+        The bars we have so far for a stream; waits for the history if it hasn't all arrived yet
+
+        :param tickerid: identifier for the request
+        :returns pd.DataFrame indexed by date, columns open high low close volume wap barCount; a copy, so it won't
+            change as new bars arrive
+        """
+
+        ## includes any wait to get past the pacing scheduler
+        MAX_WAIT_SECONDS = 30
+
+        historic_data_stream = self._requests.channel(tickerid)
+        if historic_data_stream is None:
+            raise Exception("Not streaming historical data for tickerid %d" % tickerid)
+
+        historic_data = historic_data_stream.get(timeout=MAX_WAIT_SECONDS)
+
+        while self.wrapper.is_error():
+            print(self.get_error())
+
+        if historic_data_stream.timed_out():
+            print("Exceeded maximum wait for wrapper to confirm finished")
+
+        if historic_data_stream.failed():
+            print(historic_data_stream.error)
+
+        return historic_data
+
+    def stop_streaming_IB_historical_data(self, tickerid):
+        """
+        Stops the stream, and returns the bars we ended up with
+
+        :param tickerid: identifier for the request
+        :returns pd.DataFrame, as get_IB_streaming_historical_data
+        """
+
+        historic_data_stream = self._requests.channel(tickerid)
+        pacing_ticket = self._historical_streams.pop(tickerid, None)
+        if historic_data_stream is None or pacing_ticket is None:
+            raise Exception("Not streaming historical data for tickerid %d" % tickerid)
+
+        ## it might not have got past the pacing scheduler yet
+        pacing_ticket.cancel()
+        if pacing_ticket.time_sent is not None:
+            self.cancelHistoricalData(tickerid)
+
+        ## anything that arrives after this is ignored, so there's no need to wait for the cancel to go through
+        self._requests.release(tickerid)
+
+        while self.wrapper.is_error():
+            print(self.get_error())
+
+        return historic_data_stream.get(timeout=0)
+
+    def _collect_historical_chunk(self, tickerid, chunk, historic_data_queue):
+        """
+        :param chunk: tuple endDateTime, durationStr
+        :return: pd.DataFrame, whatever we got
+        """
+
+        endDateTime, durationStr_unused = chunk
+
+        ## won't wait, it's either finished or we've run out of time
+        historic_data = historic_data_queue.get(timeout=0)
+
+        if historic_data_queue.failed() and not historic_data_queue.error.is_no_data():
+            ## the other chunks are still good
+            print("Historical data request ending %s: %s" % (endDateTime, str(historic_data_queue.error)))
+        elif historic_data_queue.timed_out():
+            print("Historical data request ending %s: exceeded maximum wait, got %d bars" %
+                  (endDateTime, len(historic_data)))
+
+        if not historic_data_queue.finished():
+            self.cancelHistoricalData(tickerid)
+
+        self._requests.release(tickerid)
+
+        return historic_data
+
+    def _request_historical_data(self, ibcontract, durationStr, barSizeSetting, tickerid=None,
+                                 priority=HISTORICAL_DATA_PRIORITY, endDateTime=None, whatToShow="TRADES",
+                                 channel=None, keepUpToDate=False, formatDate=DEFAULT_FORMAT_DATE,
+                                 tws_timezone=DEFAULT_TWS_TIMEZONE):
+        """
+        Queues the historical data request with the pacing scheduler, without waiting for it
+
+        :param endDateTime: str "yyyymmdd hh:mm:ss GMT", or None for now
+        :param formatDate: 2 for intraday bar times as seconds since 1970, 1 for local time strings
+        :param tws_timezone: str, the timezone TWS is logged in with, for a new historicalBarBuffer
+        :param whatToShow: str eg "TRADES", "MIDPOINT"
+        :param channel: where the bars go; a new historicalBarBuffer if not supplied
+        :param keepUpToDate: if True, the gateway keeps sending the latest bar until we cancel
+        :returns tuple tickerid, historicalBarBuffer the bars will arrive in, pacingTicket
+        """
+
+        if channel is None:
+            channel = historicalBarBuffer(tws_timezone=tws_timezone)
+
+        ## Make a place to store the data we're going to return
+        tickerid, historic_data_queue = self._requests.new_request(channel=channel, reqId=tickerid)
+
+        if keepUpToDate or whatToShow in WHAT_TO_SHOW_UP_TO_NOW:
+            ## IB won't do these unless they run up to now, which it wants as a blank end time
+            endDateTime = ""
+        elif endDateTime is None:
+            endDateTime = _epoch_to_ib_datetime(int(time.time()))
+        useRTH = 1
+
+        def _send_request():
+            # Request some historical data. Native method in EClient
+            self.reqHistoricalData(
+                tickerid,  # tickerId,
+                ibcontract,  # contract,
+                endDateTime,  # endDateTime,
+                durationStr,  # durationStr,
+                barSizeSetting,  # barSizeSetting,
+                whatToShow,  # whatToShow,
+                useRTH,  # useRTH,
+                formatDate,  # formatDate
+                keepUpToDate,  # KeepUpToDate <<==== added for api 9.73.2
+                [] ## chartoptions not used
+            )
+
+        pacing_keys = _historical_data_pacing_keys(ibcontract, endDateTime, durationStr, barSizeSetting,
+                                                   whatToShow, useRTH)
+        pacing_ticket = self._pacing.submit(_send_request, pacing_keys, priority=priority)
+
+        return tickerid, historic_data_queue, pacing_ticket
+
+
+
+class TestApp(TestWrapper, TestClient):
+    def __init__(self, ipaddress, portid, clientid, contract_cache_filename=None):
+        TestWrapper.__init__(self)
+        TestClient.__init__(self, wrapper=self, contract_cache_filename=contract_cache_filename)
+
+        ## before we connect, as the gateway sends data farm messages straight away
+        self.init_error()
+
+        self.connect(ipaddress, portid, clientid)
+
+        thread = Thread(target = self.run)
+        thread.start()
+
+        setattr(self, "_thread", thread)
 
 
-#if __name__ == '__main__':
+if __name__ == '__main__':
 
-app = TestApp("127.0.0.1", 4001, 1)
+    app = TestApp("127.0.0.1", 4001, 1, contract_cache_filename=DEFAULT_CONTRACT_CACHE_FILENAME)
 
-ibcontract = IBcontract()
-ibcontract.secType = "FUT"
-ibcontract.lastTradeDateOrContractMonth="201809"
-ibcontract.symbol="GE"
-ibcontract.exchange="GLOBEX"
+    ibcontract = IBcontract()
+    ibcontract.secType = "FUT"
+    ibcontract.lastTradeDateOrContractMonth="201809"
+    ibcontract.symbol="GE"
+    ibcontract.exchange="GLOBEX"
 
-resolved_ibcontract=app.resolve_ib_contract(ibcontract)
+    resolved_ibcontract=app.resolve_ib_contract(ibcontract)
 
-historic_data = app.get_IB_historical_data(resolved_ibcontract)
+    historic_data = app.get_IB_historical_data(resolved_ibcontract)
 
-print(historic_data)
+    print(historic_data)
 
-app.disconnect()
\ No newline at end of file
+    app.disconnect()
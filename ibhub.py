@@ -0,0 +1,283 @@
+# One connection shared by all the examples
+#
+# Each of the example scripts builds its own TestApp, with its own socket, reader thread and clientid. To do
+#    history, streaming prices, orders and account monitoring in one process we'd need four connections and four
+#    clientids. The hub owns one connection and one reader thread, and each subsystem is one of the example TestApps
+#    which sends its requests down the hub's socket. The hub's wrapper passes each callback on to the subsystem
+#    that it belongs to.
+#
+#    hub = TestHub("127.0.0.1", 4001, 1)
+#    hub.historical.get_IB_historical_data(...)
+#    hub.market_data.start_getting_IB_market_data(...)
+#    hub.orders.place_new_IB_order(...)
+#    hub.accounts.get_current_positions()
+#
+
+from ibapi.wrapper import EWrapper
+from ibapi.client import EClient
+
+from threading import Thread
+
+import histpricetest
+import mkstream
+import placetrade
+import getposition
+
+from latencystats import latencyRecorder, latencyInstrumentedApp
+
+## Each subsystem hands out reqIds from its own range, so they never clash over the one connection
+REQUEST_ID_RANGE=10000000
+FIRST_HISTORICAL_REQUEST_ID=histpricetest.FIRST_REQUEST_ID
+FIRST_MARKET_DATA_REQUEST_ID=FIRST_HISTORICAL_REQUEST_ID+REQUEST_ID_RANGE
+FIRST_ORDERS_REQUEST_ID=FIRST_MARKET_DATA_REQUEST_ID+REQUEST_ID_RANGE
+
+
+class hubbedApp(object):
+    """
+    Mixin for one of the example TestApps, so it sends over the hub's connection instead of having its own
+
+    EClient request methods only use isConnected, serverVersion and sendMsg to talk to the socket
+    """
+
+    def _use_hub(self, hub):
+        self._hub = hub
+
+        ## all the subsystems add to the hub's latency figures
+        self.init_latency(hub.latency_recorder)
+
+    def isConnected(self):
+        return self._hub.isConnected()
+
+    def serverVersion(self):
+        return self._hub.serverVersion()
+
+    def sendMsg(self, msg):
+        self._hub.sendMsg(msg)
+
+
+class historicalSubsystem(latencyInstrumentedApp, hubbedApp, histpricetest.TestWrapper, histpricetest.TestClient):
+    def __init__(self, hub):
+        histpricetest.TestWrapper.__init__(self)
+        histpricetest.TestClient.__init__(self, wrapper=self)
+
+        self.init_error()
+        self._requests = histpricetest.requestRegistry(FIRST_HISTORICAL_REQUEST_ID)
+        self._use_hub(hub)
+
+
+class marketDataSubsystem(latencyInstrumentedApp, hubbedApp, mkstream.TestWrapper, mkstream.TestClient):
+    def __init__(self, hub):
+        mkstream.TestWrapper.__init__(self)
+        mkstream.TestClient.__init__(self, wrapper=self)
+
+        self.init_error()
+        self._requests = mkstream.requestRegistry(FIRST_MARKET_DATA_REQUEST_ID)
+        self._use_hub(hub)
+
+
+class ordersSubsystem(latencyInstrumentedApp, hubbedApp, placetrade.TestWrapper, placetrade.TestClient):
+    def __init__(self, hub):
+        placetrade.TestWrapper.__init__(self)
+        placetrade.TestClient.__init__(self, wrapper=self)
+
+        self.init_error()
+        self._requests = placetrade.requestRegistry(FIRST_ORDERS_REQUEST_ID)
+        self._use_hub(hub)
+
+
+class accountsSubsystem(latencyInstrumentedApp, hubbedApp, getposition.TestWrapper, getposition.TestClient):
+    def __init__(self, hub):
+        getposition.TestWrapper.__init__(self)
+        getposition.TestClient.__init__(self, wrapper=self)
+
+        self._use_hub(hub)
+
+
+class hubWrapper(EWrapper):
+    """
+    Gets all the callbacks from the one reader thread, and passes each one on to the subsystem it belongs to
+
+    Callbacks with a reqId go to whichever subsystem made that request; the rest are sent by type
+    """
+
+    def __init__(self):
+        self.latency_recorder = latencyRecorder()
+
+        self.historical = historicalSubsystem(self)
+        self.market_data = marketDataSubsystem(self)
+        self.orders = ordersSubsystem(self)
+        self.accounts = accountsSubsystem(self)
+
+    def all_subsystems(self):
+        return [self.historical, self.market_data, self.orders, self.accounts]
+
+    def latency_snapshot(self):
+        return self.latency_recorder.snapshot()
+
+    def latency_exposition(self):
+        return self.latency_recorder.exposition()
+
+    def _subsystem_for_reqid(self, reqId, default_subsystem):
+        """
+        :return: the subsystem with reqId in flight, otherwise default_subsystem
+        """
+
+        for subsystem in [self.historical, self.market_data, self.orders]:
+            if subsystem._requests.channel(reqId) is not None:
+                return subsystem
+
+        return default_subsystem
+
+    ## errors
+    def error(self, id, errorCode, errorString):
+        ## Overriden method
+
+        if errorCode in histpricetest.CONNECTION_ERROR_CODES:
+            ## everyone needs to know about these
+            for subsystem in self.all_subsystems():
+                subsystem.error(id, errorCode, errorString)
+            return
+
+        if id>=0 and id<histpricetest.FIRST_REQUEST_ID:
+            ## an orderid, unless someone has supplied their own reqId
+            default_subsystem = self.orders
+        else:
+            default_subsystem = self.historical
+
+        self._subsystem_for_reqid(id, default_subsystem).error(id, errorCode, errorString)
+
+    ## the latency figures are shared, so it doesn't matter which subsystem asked
+    def currentTime(self, *args):
+        self.historical.currentTime(*args)
+
+    ## contract details; any subsystem can resolve contracts
+    def contractDetails(self, reqId, contractDetails):
+        self._subsystem_for_reqid(reqId, self.historical).contractDetails(reqId, contractDetails)
+
+    def contractDetailsEnd(self, reqId):
+        self._subsystem_for_reqid(reqId, self.historical).contractDetailsEnd(reqId)
+
+    ## historical data
+    def historicalData(self, *args):
+        self.historical.historicalData(*args)
+
+    def historicalDataEnd(self, *args):
+        self.historical.historicalDataEnd(*args)
+
+    def historicalDataUpdate(self, *args):
+        self.historical.historicalDataUpdate(*args)
+
+    def historicalTicks(self, *args):
+        self.historical.historicalTicks(*args)
+
+    def historicalTicksBidAsk(self, *args):
+        self.historical.historicalTicksBidAsk(*args)
+
+    def historicalTicksLast(self, *args):
+        self.historical.historicalTicksLast(*args)
+
+    ## market data
+    def tickPrice(self, *args):
+        self.market_data.tickPrice(*args)
+
+    def tickSize(self, *args):
+        self.market_data.tickSize(*args)
+
+    def tickString(self, *args):
+        self.market_data.tickString(*args)
+
+    def tickGeneric(self, *args):
+        self.market_data.tickGeneric(*args)
+
+    def tickReqParams(self, *args):
+        self.market_data.tickReqParams(*args)
+
+    ## orders and executions
+    def orderStatus(self, *args):
+        self.orders.orderStatus(*args)
+
+    def openOrder(self, *args):
+        self.orders.openOrder(*args)
+
+    def openOrderEnd(self):
+        self.orders.openOrderEnd()
+
+    def execDetails(self, *args):
+        self.orders.execDetails(*args)
+
+    def execDetailsEnd(self, *args):
+        self.orders.execDetailsEnd(*args)
+
+    def commissionReport(self, *args):
+        self.orders.commissionReport(*args)
+
+    def nextValidId(self, orderId):
+        self.orders.nextValidId(orderId)
+
+    ## positions and accounts
+    def position(self, *args):
+        self.accounts.position(*args)
+
+    def positionEnd(self):
+        self.accounts.positionEnd()
+
+    def updateAccountValue(self, *args):
+        self.accounts.updateAccountValue(*args)
+
+    def updatePortfolio(self, *args):
+        self.accounts.updatePortfolio(*args)
+
+    def updateAccountTime(self, *args):
+        self.accounts.updateAccountTime(*args)
+
+    def accountDownloadEnd(self, *args):
+        self.accounts.accountDownloadEnd(*args)
+
+
+class TestHub(hubWrapper, EClient):
+    def __init__(self, ipaddress, portid, clientid):
+        ## subsystems have to exist before we connect, as the gateway starts sending straight away
+        hubWrapper.__init__(self)
+        EClient.__init__(self, wrapper=self)
+
+        self.connect(ipaddress, portid, clientid)
+
+        thread = Thread(target = self.run)
+        thread.start()
+
+        setattr(self, "_thread", thread)
+
+
+if __name__ == '__main__':
+
+    from ibapi.contract import Contract as IBcontract
+    import time
+
+    hub = TestHub("127.0.0.1", 4001, 1)
+
+    ibcontract = IBcontract()
+    ibcontract.secType = "FUT"
+    ibcontract.lastTradeDateOrContractMonth="201812"
+    ibcontract.symbol="GE"
+    ibcontract.exchange="GLOBEX"
+
+    resolved_ibcontract = hub.historical.resolve_ib_contract(ibcontract)
+
+    ## all of these share the one connection
+    tickerid = hub.market_data.start_getting_IB_market_data(resolved_ibcontract)
+
+    historic_data = hub.historical.get_IB_historical_data(resolved_ibcontract)
+    print(historic_data[:5])
+
+    positions_list = hub.accounts.get_current_positions()
+    print(positions_list)
+
+    print(hub.orders.get_open_orders())
+
+    time.sleep(10)
+    market_data = hub.market_data.stop_getting_IB_market_data(tickerid)
+    print(market_data.as_pdDataFrame())
+
+    print(hub.latency_exposition())
+
+    hub.disconnect()
@@ -0,0 +1,406 @@
+# Round trip latency and payload size for each type of request we send to the gateway
+#
+# latencyInstrumentedApp is a mixin that goes in front of any of the example TestApps:
+#
+#    class timedTestApp(latencyInstrumentedApp, histpricetest.TestApp):
+#        pass
+#
+#    app = timedTestApp("127.0.0.1", 4001, 1)
+#    ...
+#    print(app.latency_exposition())
+#
+# For each request type we keep three histograms:
+#    queueing   - from registering the request to it going down the socket; this is us (eg pacing), not the gateway
+#    round_trip - from it going down the socket to the final callback; this is the gateway
+#    payload    - how many callbacks carried data back
+#
+# Everything is a fixed set of bucket counts, so recording is a bisect and a few additions under a lock
+#
+
+from threading import Lock
+from bisect import bisect_left
+
+import time
+
+## Upper bounds of each bucket. Anything larger goes into a final overflow bucket
+LATENCY_BUCKET_SECONDS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+PAYLOAD_BUCKET_SIZES = [0, 1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000]
+
+INSTRUMENTED_REQUESTS = ["reqContractDetails", "reqHistoricalData", "reqHistoricalTicks", "reqPositions",
+                         "reqAccountUpdates", "reqAllOpenOrders", "reqExecutions", "reqIds", "reqCurrentTime"]
+
+## These are matched to their callbacks by reqId, the rest can only have one in flight at a time
+REQID_REQUESTS = ["reqContractDetails", "reqHistoricalData", "reqHistoricalTicks", "reqExecutions"]
+
+## Only needed the first time each app records something
+_init_latency_lock = Lock()
+
+## If we never hear back about a request we stop waiting for it eventually
+MAX_REQUESTS_IN_FLIGHT = 10000
+
+
+def _is_warning(errorCode):
+    ## 2100-2199 are informational, and don't mean the request has failed
+    return errorCode>=2100 and errorCode<2200
+
+
+class histogram(object):
+    """
+    Counts of observations falling into fixed buckets, plus count, sum and max
+
+    Not thread safe on its own; latencyRecorder holds a lock around it
+    """
+
+    def __init__(self, bucket_bounds):
+        self.bucket_bounds = list(bucket_bounds)
+        self.bucket_counts = [0] * (len(bucket_bounds)+1)
+        self.count = 0
+        self.total = 0.0
+        self.max = None
+
+    def observe(self, value):
+        self.bucket_counts[bisect_left(self.bucket_bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value>self.max:
+            self.max = value
+
+    def mean(self):
+        if self.count==0:
+            return None
+        return self.total / self.count
+
+    def quantile(self, q):
+        """
+        :param q: between 0 and 1
+        :return: upper bound of the bucket the qth observation is in; the max if it's in the overflow bucket
+        """
+
+        if self.count==0:
+            return None
+
+        target = q * self.count
+        cumulative = 0
+        for bucket_index, bucket_count in enumerate(self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative>=target and bucket_count>0:
+                if bucket_index<len(self.bucket_bounds):
+                    return min(self.bucket_bounds[bucket_index], self.max)
+                return self.max
+
+        return self.max
+
+    def snapshot(self):
+        return dict(bucket_bounds=list(self.bucket_bounds), bucket_counts=list(self.bucket_counts),
+                    count=self.count, sum=self.total, max=self.max, mean=self.mean(),
+                    p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99))
+
+
+class requestTypeStats(object):
+    """
+    All the histograms for one type of request
+    """
+
+    def __init__(self):
+        self.queueing = histogram(LATENCY_BUCKET_SECONDS)
+        self.round_trip = histogram(LATENCY_BUCKET_SECONDS)
+        self.payload = histogram(PAYLOAD_BUCKET_SIZES)
+        self.errors = 0
+        self.abandoned = 0
+
+    def snapshot(self):
+        return dict(queueing=self.queueing.snapshot(), round_trip=self.round_trip.snapshot(),
+                    payload=self.payload.snapshot(), errors=self.errors, abandoned=self.abandoned)
+
+
+class latencyRecorder(object):
+    """
+    Times requests from being sent to being finished, by request type
+
+    Requests are identified by (request type, key); key is the reqId, or None where there can only be one
+    """
+
+    def __init__(self, request_types=INSTRUMENTED_REQUESTS):
+
+        self._lock = Lock()
+        self._stats = dict([(request_type, requestTypeStats()) for request_type in request_types])
+
+        ## (request_type, key) -> [time_requested, time_sent, payload_size]
+        self._in_flight = {}
+
+    def start(self, request_type, key=None, time_requested=None):
+        """
+        Called as the request goes down the socket
+
+        :param time_requested: time.time() when we first wanted to send it, if there was a delay before sending
+        """
+
+        time_sent = time.time()
+        if time_requested is None:
+            time_requested = time_sent
+
+        with self._lock:
+            if len(self._in_flight)>=MAX_REQUESTS_IN_FLIGHT:
+                ## oldest first, as dicts keep their order
+                oldest_in_flight = next(iter(self._in_flight))
+                self._in_flight.pop(oldest_in_flight)
+                self._stats[oldest_in_flight[0]].abandoned += 1
+
+            self._in_flight[(request_type, key)] = [time_requested, time_sent, 0]
+
+    def add_payload(self, request_type, key=None, size=1):
+        ## Called from the wrapper for each callback carrying data
+        with self._lock:
+            in_flight = self._in_flight.get((request_type, key), None)
+            if in_flight is not None:
+                in_flight[2] += size
+
+    def finish(self, request_type, key=None, error=False):
+        """
+        Called from the wrapper when the request is done; does nothing if we weren't timing it
+
+        :return: round trip time in seconds, or None
+        """
+
+        time_finished = time.time()
+
+        with self._lock:
+            in_flight = self._in_flight.pop((request_type, key), None)
+            if in_flight is None:
+                return None
+
+            time_requested, time_sent, payload_size = in_flight
+            round_trip = time_finished - time_sent
+
+            stats = self._stats[request_type]
+            stats.queueing.observe(time_sent - time_requested)
+            stats.round_trip.observe(round_trip)
+            stats.payload.observe(payload_size)
+            if error:
+                stats.errors += 1
+
+        return round_trip
+
+    def fail_reqid(self, reqId):
+        ## An error came back for reqId; whichever request it was is finished
+        for request_type in REQID_REQUESTS:
+            if self.finish(request_type, reqId, error=True) is not None:
+                return
+
+    def abandon(self, request_type, key=None):
+        ## We've given up on it, eg cancelled; doesn't count towards the latency
+        with self._lock:
+            if self._in_flight.pop((request_type, key), None) is not None:
+                self._stats[request_type].abandoned += 1
+
+    def in_flight(self):
+        with self._lock:
+            return len(self._in_flight)
+
+    def snapshot(self):
+        """
+        :return: dict, keys are request types, values are dicts of queueing, round_trip, payload, errors, abandoned
+        """
+        with self._lock:
+            return dict([(request_type, stats.snapshot()) for request_type, stats in self._stats.items()])
+
+    def exposition(self):
+        """
+        Text version of snapshot, one line per bucket, in the Prometheus text format so it can be scraped
+
+        :return: str
+        """
+
+        lines = []
+        for request_type, request_snapshot in self.snapshot().items():
+            for histogram_name, unit in [("queueing", "seconds"), ("round_trip", "seconds"), ("payload", "items")]:
+                metric_name = "ib_request_%s_%s" % (histogram_name, unit)
+                histogram_snapshot = request_snapshot[histogram_name]
+
+                cumulative = 0
+                for bucket_bound, bucket_count in zip(histogram_snapshot["bucket_bounds"]+["+Inf"],
+                                                      histogram_snapshot["bucket_counts"]):
+                    cumulative += bucket_count
+                    lines.append('%s_bucket{request="%s",le="%s"} %d' % (metric_name, request_type,
+                                                                        bucket_bound, cumulative))
+
+                lines.append('%s_sum{request="%s"} %f' % (metric_name, request_type, histogram_snapshot["sum"]))
+                lines.append('%s_count{request="%s"} %d' % (metric_name, request_type,
+                                                           histogram_snapshot["count"]))
+
+            lines.append('ib_request_errors_total{request="%s"} %d' % (request_type, request_snapshot["errors"]))
+            lines.append('ib_request_abandoned_total{request="%s"} %d' % (request_type,
+                                                                         request_snapshot["abandoned"]))
+
+        return "\n".join(lines)+"\n"
+
+
+class latencyInstrumentedApp(object):
+    """
+    Mixin which times each instrumented request, from the EClient method to the wrapper callback that ends it
+
+    Put it first in the bases, so it sees both the requests and the callbacks
+    """
+
+    def _latency(self):
+        ## created on first use, unless someone has supplied one to share with init_latency
+        latency_recorder = getattr(self, "_latency_recorder", None)
+        if latency_recorder is None:
+            with _init_latency_lock:
+                latency_recorder = getattr(self, "_latency_recorder", None)
+                if latency_recorder is None:
+                    latency_recorder = self.init_latency()
+
+        return latency_recorder
+
+    def init_latency(self, latency_recorder=None):
+        if latency_recorder is None:
+            latency_recorder = latencyRecorder()
+
+        self._latency_recorder = latency_recorder
+
+        return latency_recorder
+
+    def latency_snapshot(self):
+        return self._latency().snapshot()
+
+    def latency_exposition(self):
+        return self._latency().exposition()
+
+    def _time_requested(self, reqId):
+        ## when the request was registered, if the app keeps track; any wait for pacing happens after this
+        time_requested = getattr(getattr(self, "_requests", None), "time_requested", None)
+        if time_requested is None:
+            return None
+
+        return time_requested(reqId)
+
+    ## requests
+    def reqContractDetails(self, reqId, contract):
+        self._latency().start("reqContractDetails", reqId, self._time_requested(reqId))
+        super().reqContractDetails(reqId, contract)
+
+    def reqHistoricalData(self, reqId, *args):
+        self._latency().start("reqHistoricalData", reqId, self._time_requested(reqId))
+        super().reqHistoricalData(reqId, *args)
+
+    def cancelHistoricalData(self, reqId):
+        self._latency().abandon("reqHistoricalData", reqId)
+        super().cancelHistoricalData(reqId)
+
+    def reqHistoricalTicks(self, reqId, *args):
+        self._latency().start("reqHistoricalTicks", reqId, self._time_requested(reqId))
+        super().reqHistoricalTicks(reqId, *args)
+
+    def reqPositions(self):
+        self._latency().start("reqPositions")
+        super().reqPositions()
+
+    def reqAccountUpdates(self, subscribe, acctCode):
+        if subscribe:
+            self._latency().start("reqAccountUpdates")
+        else:
+            self._latency().abandon("reqAccountUpdates")
+        super().reqAccountUpdates(subscribe, acctCode)
+
+    def reqAllOpenOrders(self):
+        self._latency().start("reqAllOpenOrders")
+        super().reqAllOpenOrders()
+
+    def reqExecutions(self, reqId, execFilter):
+        self._latency().start("reqExecutions", reqId, self._time_requested(reqId))
+        super().reqExecutions(reqId, execFilter)
+
+    def reqIds(self, numIds):
+        self._latency().start("reqIds")
+        super().reqIds(numIds)
+
+    def reqCurrentTime(self):
+        self._latency().start("reqCurrentTime")
+        super().reqCurrentTime()
+
+    ## callbacks
+    def error(self, id, errorCode, errorString):
+        if not _is_warning(errorCode):
+            self._latency().fail_reqid(id)
+        super().error(id, errorCode, errorString)
+
+    def contractDetails(self, reqId, contractDetails):
+        self._latency().add_payload("reqContractDetails", reqId)
+        super().contractDetails(reqId, contractDetails)
+
+    def contractDetailsEnd(self, reqId):
+        self._latency().finish("reqContractDetails", reqId)
+        super().contractDetailsEnd(reqId)
+
+    def historicalData(self, reqId, *args):
+        self._latency().add_payload("reqHistoricalData", reqId)
+        super().historicalData(reqId, *args)
+
+    def historicalDataEnd(self, reqId, *args):
+        self._latency().finish("reqHistoricalData", reqId)
+        super().historicalDataEnd(reqId, *args)
+
+    def historicalTicks(self, reqId, ticks, done):
+        self._historical_ticks_latency(reqId, ticks, done)
+        super().historicalTicks(reqId, ticks, done)
+
+    def historicalTicksBidAsk(self, reqId, ticks, done):
+        self._historical_ticks_latency(reqId, ticks, done)
+        super().historicalTicksBidAsk(reqId, ticks, done)
+
+    def historicalTicksLast(self, reqId, ticks, done):
+        self._historical_ticks_latency(reqId, ticks, done)
+        super().historicalTicksLast(reqId, ticks, done)
+
+    def _historical_ticks_latency(self, reqId, ticks, done):
+        ## all the ticks come in one callback, so the payload is how many there are
+        self._latency().add_payload("reqHistoricalTicks", reqId, size=len(ticks))
+        if done:
+            self._latency().finish("reqHistoricalTicks", reqId)
+
+    def position(self, *args):
+        self._latency().add_payload("reqPositions")
+        super().position(*args)
+
+    def positionEnd(self):
+        self._latency().finish("reqPositions")
+        super().positionEnd()
+
+    def updateAccountValue(self, *args):
+        self._latency().add_payload("reqAccountUpdates")
+        super().updateAccountValue(*args)
+
+    def updatePortfolio(self, *args):
+        self._latency().add_payload("reqAccountUpdates")
+        super().updatePortfolio(*args)
+
+    def accountDownloadEnd(self, accountName):
+        self._latency().finish("reqAccountUpdates")
+        super().accountDownloadEnd(accountName)
+
+    def openOrder(self, *args):
+        self._latency().add_payload("reqAllOpenOrders")
+        super().openOrder(*args)
+
+    def openOrderEnd(self):
+        self._latency().finish("reqAllOpenOrders")
+        super().openOrderEnd()
+
+    def execDetails(self, reqId, *args):
+        self._latency().add_payload("reqExecutions", reqId)
+        super().execDetails(reqId, *args)
+
+    def execDetailsEnd(self, reqId):
+        self._latency().finish("reqExecutions", reqId)
+        super().execDetailsEnd(reqId)
+
+    def nextValidId(self, orderId):
+        self._latency().add_payload("reqIds")
+        self._latency().finish("reqIds")
+        super().nextValidId(orderId)
+
+    def currentTime(self, time_from_server):
+        self._latency().add_payload("reqCurrentTime")
+        self._latency().finish("reqCurrentTime")
+        super().currentTime(time_from_server)
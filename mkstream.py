@@ -21,60 +21,413 @@
 from ibapi.wrapper import EWrapper
 from ibapi.client import EClient
 from ibapi.contract import Contract as IBcontract
+from ibapi.server_versions import MIN_SERVER_VER_REQ_SMART_COMPONENTS
 
 import time
-from threading import Thread
+from threading import Thread, Condition, Lock, Event
 import queue
 import datetime
 import pandas as pd
 import numpy as np
 
-DEFAULT_MARKET_DATA_ID=50
-DEFAULT_GET_CONTRACT_ID=43
-
 ## marker for when queue is finished
 FINISHED = object()
 STARTED = object()
 TIME_OUT = object()
+## timed out, but with some data
+PARTIAL = object()
+## the gateway sent an error for this request
+FAILED = object()
+
+## reqIds are handed out from here upwards, high enough not to clash with broker order ids
+FIRST_REQUEST_ID=10000000
 
 class finishableQueue(object):
 
-    def __init__(self, queue_to_finish):
+    def __init__(self):
 
-        self._queue = queue_to_finish
+        self._contents = []
+        self._finished = False
+        self._done_callbacks = []
+        self._condition = Condition()
         self.status = STARTED
+        self.error = None
+
+    def put(self, element):
+        """
+        Add an element; called from the wrapper, ie the thread running EClient.run
+
+        Putting FINISHED marks the queue as finished and wakes up anyone waiting in get()
+        """
+        done_callbacks = []
+
+        with self._condition:
+            if element is FINISHED:
+                self._finished = True
+                done_callbacks = self._done_callbacks
+                self._done_callbacks = []
+            else:
+                self._contents.append(element)
+
+            self._condition.notify_all()
+
+        for done_callback in done_callbacks:
+            done_callback()
+
+    def finish(self):
+        ## called by the wrapper when the relevant ...End method arrives
+        self.put(FINISHED)
+
+    def fail(self, error):
+        """
+        Called by the wrapper if the gateway sends an error for this request, so we don't wait for an End that
+        won't come
+
+        :param error: IBerror
+        """
+        with self._condition:
+            self.error = error
+
+        self.put(FINISHED)
+
+    def add_done_callback(self, done_callback):
+        """
+        Call done_callback() once the queue is finished, or straight away if it already is
+
+        It will usually be called from the wrapper thread, so it needs to be quick and thread safe
+        """
+        with self._condition:
+            already_finished = self._finished
+            if not already_finished:
+                self._done_callbacks.append(done_callback)
+
+        if already_finished:
+            done_callback()
 
     def get(self, timeout):
         """
-        Returns a list of queue elements once timeout is finished, or a FINISHED flag is received in the queue
+        Returns a list of queue elements as soon as a FINISHED flag is received, or once timeout is finished
+
+        The timeout is one overall deadline for the request, it doesn't restart every time an element arrives
 
         :param timeout: how long to wait before giving up
         :return: list of queue elements
         """
-        contents_of_queue=[]
-        finished=False
 
-        while not finished:
-            try:
-                current_element = self._queue.get(timeout=timeout)
-                if current_element is FINISHED:
-                    finished = True
-                    self.status = FINISHED
-                else:
-                    contents_of_queue.append(current_element)
-                    ## keep going and try and get more data
+        with self._condition:
+            finished = self._condition.wait_for(lambda: self._finished, timeout=timeout)
 
-            except queue.Empty:
-                ## If we hit a time out it's most probable we're not getting a finished element any time soon
-                ## give up and return what we have
-                finished = True
-                self.status = TIME_OUT
+            contents_of_queue = self._contents
+            self._contents = []
 
+        if finished and self.error is not None:
+            self.status = FAILED
+        elif finished:
+            self.status = FINISHED
+        elif len(contents_of_queue)>0:
+            ## we have some data but never got the end marker
+            self.status = PARTIAL
+        else:
+            self.status = TIME_OUT
 
         return contents_of_queue
 
     def timed_out(self):
-        return self.status is TIME_OUT
+        return self.status is TIME_OUT or self.status is PARTIAL
+
+    def partial(self):
+        return self.status is PARTIAL
+
+    def finished(self):
+        return self.status is FINISHED
+
+    def failed(self):
+        return self.status is FAILED
+
+## errors which are about the connection or the data farms, not about any one request
+CONNECTION_ERROR_CODES = [502, 504, 1100, 1101, 1102, 1300, 2103, 2104, 2105, 2106, 2107, 2108, 2110, 2119, 2157, 2158]
+
+## errors which mean a market data request won't get any ticks, so won't get a tickReqParams either
+MARKET_DATA_FAILED_ERROR_CODES = [200, 354, 10168, 10197]
+
+
+def _is_warning(errorCode):
+    ## 2100-2199 are warnings; the request carries on regardless
+    return errorCode>=2100 and errorCode<2200
+
+
+class IBerror(object):
+    """
+    An error message from the gateway
+    """
+
+    def __init__(self, id, errorCode, errorString):
+        """
+        :param id: reqId or orderId the error is about, -1 if it isn't about anything in particular
+        :param errorCode: int
+        :param errorString: str
+        """
+
+        self.id = id
+        self.errorCode = errorCode
+        self.errorString = errorString
+        self.timestamp = datetime.datetime.now()
+
+    def __repr__(self):
+        return "IB error id %d errorcode %d string %s" % (self.id, self.errorCode, self.errorString)
+
+    def is_connection_error(self):
+        return self.id==-1 or self.errorCode in CONNECTION_ERROR_CODES
+
+
+
+class requestRegistry(object):
+    """
+    Hands out unique reqIds, and owns the channel (usually a finishableQueue) for each request in flight
+
+    The wrapper looks up the channel for whatever reqId it gets called with, so any number of requests can be
+    running at once over the same connection
+    """
+
+    def __init__(self, first_reqid=FIRST_REQUEST_ID):
+
+        self._lock = Lock()
+        self._next_reqid = first_reqid
+        self._channels = {}
+        self._times_requested = {}
+
+    def new_request(self, channel=None, reqId=None):
+        """
+        Register a new request
+
+        :param channel: where the wrapper will put the data; a new finishableQueue if not supplied
+        :param reqId: use this id rather than allocating one, eg if the caller wants a particular tickerid
+        :return: tuple reqId, channel
+        """
+
+        if channel is None:
+            channel = finishableQueue()
+
+        with self._lock:
+            if reqId is None:
+                reqId = self._next_reqid
+                self._next_reqid += 1
+            elif reqId in self._channels.keys():
+                raise Exception("reqId %d is already being used by a request in flight" % reqId)
+
+            self._channels[reqId] = channel
+            self._times_requested[reqId] = time.time()
+
+        return reqId, channel
+
+    def channel(self, reqId):
+        """
+        Called from the wrapper
+
+        :return: channel for reqId, or None if we never made this request or have released it
+        """
+        with self._lock:
+            return self._channels.get(reqId, None)
+
+    def release(self, reqId):
+        ## we're done with this request; anything else that arrives for it will be ignored
+        with self._lock:
+            self._channels.pop(reqId, None)
+            self._times_requested.pop(reqId, None)
+
+    def time_requested(self, reqId):
+        """
+        :return: time.time() when the request was registered, or None; any gap before it is sent is our queueing
+        """
+        with self._lock:
+            return self._times_requested.get(reqId, None)
+
+    def in_flight(self):
+        with self._lock:
+            return list(self._channels.keys())
+
+
+def contract_from_details(contract_details):
+    ## the resolved contract; older versions of the API call it summary
+    return getattr(contract_details, "contract", None) or contract_details.summary
+
+
+## ticks kept for each tickerid; once it's full the oldest are overwritten
+DEFAULT_TICK_BUFFER_CAPACITY = 65536
+
+## how long get_IB_market_data will wait, if we ask it to wait for ticks
+DEFAULT_MARKET_DATA_WAIT_SECONDS = 10
+
+## a cursor the wrapper will never get to, for when nobody is waiting
+_NOBODY_WAITING = np.iinfo(np.int64).max
+
+## IB tickType -> tick attribute; anything else is kept in the buffer, but isn't one of the tick columns
+TICK_FIELD_NAMES = {0: "bid_size", 1: "bid_price", 2: "ask_price", 3: "ask_size",
+                    4: "last_trade_price", 5: "last_trade_size"}
+
+## columns of stream_of_ticks.as_pdDataFrame; the quote ones are the state of the book, the rest are trades
+TICK_COLUMNS = ["bid_size", "bid_price", "ask_size", "ask_price", "last_trade_size", "last_trade_price"]
+QUOTE_COLUMNS = ["bid_size", "bid_price", "ask_size", "ask_price"]
+
+## tickType -> position in TICK_COLUMNS, -1 if it isn't one; indexed by any uint16 field
+_TICK_FIELD_COLUMNS = np.full(np.iinfo(np.uint16).max+1, -1, dtype=np.int8)
+for _tickType, _field_name in TICK_FIELD_NAMES.items():
+    _TICK_FIELD_COLUMNS[_tickType] = TICK_COLUMNS.index(_field_name)
+
+
+class tickRingBuffer(object):
+    """
+    Fixed size columns of ticks for one tickerid: timestamp in nanoseconds since 1970 UTC, field (the IB tickType)
+       and value
+
+    Only the wrapper thread appends, so appending doesn't need a lock. Readers keep their own cursor, which counts
+       ticks since the stream started, and ask for everything after it. If a reader falls more than capacity ticks
+       behind then the oldest ticks it hasn't seen are gone, and it's told how many.
+
+    Once the stream is cancelled the buffer is retired, and the wrapper stops putting ticks into it
+    """
+
+    def __init__(self, capacity=DEFAULT_TICK_BUFFER_CAPACITY, generation=None):
+        """
+        :param capacity: int, how many ticks to keep
+        :param generation: int, which subscription to this tickerid this is; None if the gateway can't tell us
+            which subscription ticks belong to
+        """
+
+        self._capacity = capacity
+        self._timestamps = np.zeros(capacity, dtype=np.int64)
+        self._fields = np.zeros(capacity, dtype=np.uint16)
+        self._values = np.zeros(capacity, dtype=np.float64)
+
+        ## how many ticks have ever been appended; the next one goes at _count % capacity
+        self._count = 0
+
+        self.generation = generation
+        self.retired = False
+
+        ## where get_IB_market_data has got up to
+        self._taken_cursor = 0
+
+        ## someone in wait_until wants waking up once _count gets here
+        self._wake_at_cursor = _NOBODY_WAITING
+        self._woken = Event()
+
+    def append(self, timestamp, field, value):
+        """
+        Called from the wrapper
+
+        :param timestamp: int nanoseconds since 1970 UTC
+        :param field: int IB tickType
+        :param value: price, size or whatever else the tickType is
+        """
+
+        position = self._count % self._capacity
+        self._timestamps[position] = timestamp
+        self._fields[position] = field
+        self._values[position] = value
+
+        ## only now is the tick there for readers
+        self._count += 1
+
+        if self._count>=self._wake_at_cursor:
+            self._wake_at_cursor = _NOBODY_WAITING
+            self._woken.set()
+
+    def retire(self):
+        """
+        The stream has been cancelled; anything still on its way is an orphan
+        """
+        self.retired = True
+
+        ## nothing else is coming, so don't keep anyone waiting
+        self._woken.set()
+
+    def cursor(self):
+        """
+        :return: int cursor just after the latest tick
+        """
+        return self._count
+
+    def read(self, cursor, end_cursor=None):
+        """
+        Ticks from cursor up to end_cursor, or up to now
+
+        :param cursor: int, from an earlier read or from cursor()
+        :param end_cursor: int, or None for everything which has arrived
+        :return: tuple stream_of_ticks, int cursor to read from next time
+        """
+
+        if end_cursor is None:
+            end_cursor = self._count
+
+        start_cursor = max(cursor, end_cursor - self._capacity)
+
+        timestamps = self._copy_column(self._timestamps, start_cursor, end_cursor)
+        fields = self._copy_column(self._fields, start_cursor, end_cursor)
+        values = self._copy_column(self._values, start_cursor, end_cursor)
+
+        ## The wrapper might have gone round and overwritten the oldest ones whilst we were copying; it could also
+        ##    be half way through writing the next one
+        first_intact_cursor = self._count + 1 - self._capacity
+        if first_intact_cursor>start_cursor:
+            overwritten = min(first_intact_cursor, end_cursor) - start_cursor
+            timestamps = timestamps[overwritten:]
+            fields = fields[overwritten:]
+            values = values[overwritten:]
+            start_cursor += overwritten
+
+        ticks = stream_of_ticks(timestamps, fields, values, ticks_lost=start_cursor - cursor)
+
+        return ticks, end_cursor
+
+    def wait_until(self, cursor, timeout=None):
+        """
+        Block until the ticks before cursor have arrived; only one thread should wait at a time
+
+        :param cursor: int
+        :param timeout: seconds, or None to wait as long as it takes
+        :return: bool, True if they have
+        """
+
+        self._woken.clear()
+        self._wake_at_cursor = cursor
+
+        ## they might have arrived before the wrapper could see we were waiting, or there may be no more coming
+        if self._count>=cursor or self.retired:
+            self._wake_at_cursor = _NOBODY_WAITING
+            return True
+
+        arrived = self._woken.wait(timeout)
+        self._wake_at_cursor = _NOBODY_WAITING
+
+        return arrived or self._count>=cursor
+
+    def take(self, min_new_ticks=0, timeout=None):
+        """
+        Everything since we last took anything
+
+        :param min_new_ticks: wait until there are at least this many, or until timeout
+        :param timeout: seconds, or None to wait as long as it takes
+        :return: stream_of_ticks
+        """
+
+        if min_new_ticks>0:
+            self.wait_until(self._taken_cursor + min_new_ticks, timeout)
+
+        ## whatever has arrived by now, and nothing after it
+        ticks, self._taken_cursor = self.read(self._taken_cursor)
+
+        return ticks
+
+    def _copy_column(self, column, start_cursor, end_cursor):
+        start_position = start_cursor % self._capacity
+        end_position = start_position + end_cursor - start_cursor
+
+        if end_position<=self._capacity:
+            return column[start_position:end_position].copy()
+
+        ## wraps round the end
+        return np.concatenate([column[start_position:], column[:end_position - self._capacity]])
 
 
 def _nan_or_int(x):
@@ -83,26 +436,197 @@ def _nan_or_int(x):
     else:
         return x
 
-class stream_of_ticks(list):
+class stream_of_ticks(object):
     """
-    Stream of ticks
+    Stream of ticks, as columns
     """
 
-    def __init__(self, list_of_ticks):
-        super().__init__(list_of_ticks)
+    def __init__(self, timestamps, fields, values, ticks_lost=0):
+        """
+        :param timestamps: np.array of int64 nanoseconds since 1970 UTC
+        :param fields: np.array of uint16 IB tickType
+        :param values: np.array of float64
+        :param ticks_lost: int, how many ticks before these were overwritten before we could read them
+        """
+
+        self.timestamps = timestamps
+        self.fields = fields
+        self.values = values
+        self.ticks_lost = ticks_lost
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __getitem__(self, index):
+        """
+        :param index: int, for one IBtick; or a slice, for a stream_of_ticks of just those ticks
+        """
+        if isinstance(index, slice):
+            ## ticks were only lost before the first of these if it's the first of ours
+            first_tick = index.indices(len(self))[0]
+            ticks_lost = self.ticks_lost if first_tick==0 else 0
+
+            return stream_of_ticks(self.timestamps[index], self.fields[index], self.values[index],
+                                   ticks_lost=ticks_lost)
 
-    def as_pdDataFrame(self):
+        return IBtick(pd.Timestamp(int(self.timestamps[index]), tz="UTC"), int(self.fields[index]),
+                      float(self.values[index]))
+
+    def as_pdDataFrame(self, forward_fill_quotes=False):
+        """
+        One row per tick, with the value in the column for its tickType; ticks which aren't one of TICK_COLUMNS
+           are a row of nans
+
+        :param forward_fill_quotes: if True, each row has the latest bid and ask as of that tick, rather than
+            just whatever changed
+        :return: pd.DataFrame indexed by timestamp, columns TICK_COLUMNS
+        """
 
         if len(self)==0:
             ## no data; do a blank tick
-            return tick(datetime.datetime.now()).as_pandas_row()
+            return tick(pd.Timestamp.now(tz="UTC")).as_pandas_row()
+
+        ## pivot from one value per tick to one column per field
+        tick_columns = _TICK_FIELD_COLUMNS[self.fields]
+        rows = np.flatnonzero(tick_columns>=0)
+
+        wide_values = np.full((len(TICK_COLUMNS), len(self)), np.nan)
+        wide_values[tick_columns[rows], rows] = self.values[rows]
+
+        if forward_fill_quotes:
+            for column_number in [TICK_COLUMNS.index(column_name) for column_name in QUOTE_COLUMNS]:
+                wide_values[column_number] = _forward_fill(wide_values[column_number])
+
+        index = pd.DatetimeIndex(self.timestamps.view("datetime64[ns]")).tz_localize("UTC")
 
-        pd_row_list=[tick.as_pandas_row() for tick in self]
-        pd_data_frame=pd.concat(pd_row_list)
+        pd_data_frame = pd.DataFrame(dict(zip(TICK_COLUMNS, wide_values)), index=index, copy=False)
 
         return pd_data_frame
 
 
+## the latest of everything for each tickerid; times are nanoseconds since 1970 UTC, 0 if nothing has arrived yet
+QUOTE_TABLE_DTYPE = np.dtype([("tickerid", np.int64), ("bid_price", np.float64), ("bid_size", np.float64),
+                              ("ask_price", np.float64), ("ask_size", np.float64),
+                              ("last_trade_price", np.float64), ("last_trade_size", np.float64),
+                              ("volume", np.float64), ("quote_time", np.int64), ("trade_time", np.int64)])
+
+## IB tickType -> quote table column, and which time column it updates
+QUOTE_TABLE_FIELDS = {0: ("bid_size", "quote_time"), 1: ("bid_price", "quote_time"),
+                      2: ("ask_price", "quote_time"), 3: ("ask_size", "quote_time"),
+                      4: ("last_trade_price", "trade_time"), 5: ("last_trade_size", "trade_time"),
+                      8: ("volume", "trade_time")}
+
+## a row before anything has arrived
+_EMPTY_QUOTE = np.zeros((), dtype=QUOTE_TABLE_DTYPE)
+for _column_name in ["bid_price", "bid_size", "ask_price", "ask_size", "last_trade_price", "last_trade_size", "volume"]:
+    _EMPTY_QUOTE[_column_name] = np.nan
+
+## rows we start with; the table doubles in size if it needs to
+DEFAULT_QUOTE_TABLE_ROWS = 256
+
+
+class quoteTable(object):
+    """
+    Top of book for every tickerid we're streaming, one row each, updated in place by the wrapper on every tick
+
+    Finding a tickerid's row is a dict lookup, so getting the latest quote doesn't depend on how many ticks or
+       instruments there are
+    """
+
+    def __init__(self, rows=DEFAULT_QUOTE_TABLE_ROWS):
+
+        self._lock = Lock()
+        self._rows = {}
+        self._new_table(rows)
+
+    def _new_table(self, rows):
+        old_table = getattr(self, "_table", None)
+
+        self._table = np.zeros(rows, dtype=QUOTE_TABLE_DTYPE)
+        if old_table is not None:
+            self._table[:len(old_table)] = old_table
+
+        ## views of each column, so an update doesn't have to look the column up
+        self._columns = dict([(column_name, self._table[column_name]) for column_name in QUOTE_TABLE_DTYPE.names])
+
+    def add(self, tickerid):
+        with self._lock:
+            if tickerid in self._rows:
+                return
+
+            row = len(self._rows)
+            if row==len(self._table):
+                self._new_table(2*len(self._table))
+
+            self._table[row] = _EMPTY_QUOTE
+            self._columns["tickerid"][row] = tickerid
+
+            self._rows[tickerid] = row
+
+    def remove(self, tickerid):
+        with self._lock:
+            row = self._rows.pop(tickerid, None)
+            if row is None:
+                return
+
+            ## keep the rows we're using together at the top, by moving the last one into the gap
+            last_row = len(self._rows)
+            if row!=last_row:
+                self._table[row] = self._table[last_row]
+                self._rows[int(self._table[row]["tickerid"])] = row
+
+    def update(self, tickerid, tickType, value, timestamp):
+        """
+        Called from the wrapper
+
+        :param timestamp: int nanoseconds since 1970 UTC
+        """
+
+        columns = QUOTE_TABLE_FIELDS.get(tickType, None)
+        if columns is None:
+            ## not something we keep
+            return
+
+        column_name, time_column_name = columns
+
+        with self._lock:
+            row = self._rows.get(tickerid, None)
+            if row is None:
+                return
+
+            self._columns[column_name][row] = value
+            self._columns[time_column_name][row] = timestamp
+
+    def latest_quote(self, tickerid):
+        """
+        :return: np.void with the fields in QUOTE_TABLE_DTYPE, a copy; None if we aren't streaming tickerid
+        """
+        with self._lock:
+            row = self._rows.get(tickerid, None)
+            if row is None:
+                return None
+
+            return self._table[row].copy()
+
+    def latest_quotes(self):
+        """
+        :return: np.array with dtype QUOTE_TABLE_DTYPE, a copy, one row for each tickerid
+        """
+        with self._lock:
+            return self._table[:len(self._rows)].copy()
+
+
+def _forward_fill(values):
+    """
+    :param values: np.array of float
+    :return: np.array, nans replaced by the last value before them
+    """
+    last_valid_position = np.where(np.isnan(values), 0, np.arange(len(values)))
+    np.maximum.accumulate(last_valid_position, out=last_valid_position)
+
+    return values[last_valid_position]
+
+
 class tick(object):
     """
     Convenience method for storing ticks
@@ -152,14 +676,8 @@ class IBtick(tick):
 
     def resolve_tickids(self, tickid):
 
-        tickid_dict=dict([("0", "bid_size"), ("1", "bid_price"), ("2", "ask_price"), ("3", "ask_size"),
-                          ("4", "last_trade_price"), ("5", "last_trade_size")])
-
-        if str(tickid) in tickid_dict.keys():
-            return tickid_dict[str(tickid)]
-        else:
-            # This must be the same as the argument name in the parent class
-            return "ignorable_tick_id"
+        # Anything else must be the same as the argument name in the parent class
+        return TICK_FIELD_NAMES.get(int(tickid), "ignorable_tick_id")
 
 
 
@@ -172,15 +690,15 @@ class TestWrapper(EWrapper):
     Extra methods are added as we need to store the results in this object
     """
 
-    def __init__(self):
-        self._my_contract_details = {}
-        self._my_market_data_dict = {}
-
     ## error handling code
     def init_error(self):
         error_queue=queue.Queue()
         self._my_errors = error_queue
 
+        ## connectivity and data farm messages go here, rather than in with everything else
+        connection_error_queue=queue.Queue()
+        self._my_connection_errors = connection_error_queue
+
     def get_error(self, timeout=5):
         if self.is_error():
             try:
@@ -194,44 +712,99 @@ class TestWrapper(EWrapper):
         an_error_if=not self._my_errors.empty()
         return an_error_if
 
+    def get_connection_error(self, timeout=5):
+        if self.is_connection_error():
+            try:
+                return self._my_connection_errors.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        return None
+
+    def is_connection_error(self):
+        a_connection_error_if=not self._my_connection_errors.empty()
+        return a_connection_error_if
+
     def error(self, id, errorCode, errorString):
         ## Overriden method
-        errormsg = "IB error id %d errorcode %d string %s" % (id, errorCode, errorString)
-        self._my_errors.put(errormsg)
+        ib_error = IBerror(id, errorCode, errorString)
 
+        if ib_error.is_connection_error():
+            self._my_connection_errors.put(ib_error)
+            return
 
-    ## get contract details code
-    def init_contractdetails(self, reqId):
-        contract_details_queue = self._my_contract_details[reqId] = queue.Queue()
+        if errorCode in MARKET_DATA_FAILED_ERROR_CODES:
+            self._market_data_request_failed(id)
+
+        if not _is_warning(errorCode):
+            ## If it's about a request we're waiting for, it fails now rather than when it times out
+            request_queue = self._requests.channel(id)
+            if isinstance(request_queue, finishableQueue):
+                request_queue.fail(ib_error)
+                return
 
-        return contract_details_queue
+        self._my_errors.put(ib_error)
 
+
+    ## get contract details code
+    ## the queue for each reqId is set up by the client, in its request registry
     def contractDetails(self, reqId, contractDetails):
         ## overridden method
 
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
+        contract_details_queue = self._requests.channel(reqId)
+        if contract_details_queue is None:
+            ## not something we asked for, or we've given up waiting for it
+            return
 
-        self._my_contract_details[reqId].put(contractDetails)
+        contract_details_queue.put(contractDetails)
 
     def contractDetailsEnd(self, reqId):
         ## overriden method
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
 
-        self._my_contract_details[reqId].put(FINISHED)
+        contract_details_queue = self._requests.channel(reqId)
+        if contract_details_queue is None:
+            return
+
+        contract_details_queue.finish()
 
     # market data
-    def init_market_data(self, tickerid):
-        market_data_queue = self._my_market_data_dict[tickerid] = queue.Queue()
+    def _put_market_data(self, tickerid, tickType, value):
+
+        tick_buffer = self._requests.channel(tickerid)
+        if tick_buffer is None or tick_buffer.retired:
+            ## stream has been stopped, this is an 'orphan' tick
+            return
+
+        if tick_buffer.generation is not None and \
+                tick_buffer.generation!=self._market_data_generations_arriving.get(tickerid, 0):
+            ## from an earlier subscription which used the same tickerid, that we've since cancelled
+            return
+
+        timestamp = self.get_time_stamp()
+        tick_buffer.append(timestamp, tickType, value)
+        self._quote_table.update(tickerid, tickType, value, timestamp)
 
-        return market_data_queue
+    def _market_data_request_failed(self, tickerid):
+        ## There'll be no tickReqParams for this subscription, so count it as arrived here instead; otherwise we'd
+        ##    be one behind for good, and drop the ticks of every later subscription with this tickerid
+        tick_buffer = self._requests.channel(tickerid)
+        if not isinstance(tick_buffer, tickRingBuffer) or tick_buffer.generation is None:
+            return
 
+        if tick_buffer.generation>self._market_data_generations_arriving.get(tickerid, 0):
+            self._market_data_generations_arriving[tickerid] = tick_buffer.generation
+
+    def tickReqParams(self, tickerid, minTick, bboExchange, snapshotPermissions):
+        ## overriden method
+
+        ## The gateway sends this first for each new subscription, so any ticks after it are from that one
+        generation = self._market_data_generations_arriving.get(tickerid, 0) + 1
+        self._market_data_generations_arriving[tickerid] = generation
 
     def get_time_stamp(self):
-        ## Time stamp to apply to market data
+        ## Time stamp to apply to market data, nanoseconds since 1970 UTC
         ## We could also use IB server time
-        return datetime.datetime.now()
+        return time.time_ns()
 
 
     def tickPrice(self, tickerid , tickType, price, attrib):
@@ -242,30 +815,26 @@ class TestWrapper(EWrapper):
         # attrib.canAutoExecute
         # attrib.pastLimit
 
-        this_tick_data=IBtick(self.get_time_stamp(),tickType, price)
-        self._my_market_data_dict[tickerid].put(this_tick_data)
+        self._put_market_data(tickerid, tickType, price)
 
 
     def tickSize(self, tickerid, tickType, size):
         ## overriden method
 
-        this_tick_data=IBtick(self.get_time_stamp(), tickType, size)
-        self._my_market_data_dict[tickerid].put(this_tick_data)
+        self._put_market_data(tickerid, tickType, size)
 
 
     def tickString(self, tickerid, tickType, value):
         ## overriden method
 
-        ## value is a string, make it a float, and then in the parent class will be resolved to int if size
-        this_tick_data=IBtick(self.get_time_stamp(),tickType, float(value))
-        self._my_market_data_dict[tickerid].put(this_tick_data)
+        ## value is a string, make it a float
+        self._put_market_data(tickerid, tickType, float(value))
 
 
     def tickGeneric(self, tickerid, tickType, value):
         ## overriden method
 
-        this_tick_data=IBtick(self.get_time_stamp(),tickType, value)
-        self._my_market_data_dict[tickerid].put(this_tick_data)
+        self._put_market_data(tickerid, tickType, value)
 
 
 
@@ -279,18 +848,28 @@ class TestClient(EClient):
         ## Set up with a wrapper inside
         EClient.__init__(self, wrapper)
 
-        self._market_data_q_dict = {}
+        ## hands out reqIds, and keeps track of where the wrapper should put the data for each one
+        self._requests = requestRegistry()
+
+        ## how many times we've subscribed to market data for each tickerid, and how many of those subscriptions
+        ##    the wrapper has seen start
+        self._market_data_generations_requested = {}
+        self._market_data_generations_arriving = {}
 
-    def resolve_ib_contract(self, ibcontract, reqId=DEFAULT_GET_CONTRACT_ID):
+        ## the wrapper keeps the latest quote for each tickerid in here
+        self._quote_table = quoteTable()
+
+    def resolve_ib_contract(self, ibcontract, reqId=None):
 
         """
         From a partially formed contract, returns a fully fledged version
 
+        :param reqId: the identifier for the request; if None we get a new unique one
         :returns fully resolved IB contract
         """
 
         ## Make a place to store the data we're going to return
-        contract_details_queue = finishableQueue(self.init_contractdetails(reqId))
+        reqId, contract_details_queue = self._requests.new_request(reqId=reqId)
 
         print("Getting full contract details from the server... ")
 
@@ -299,12 +878,16 @@ class TestClient(EClient):
         ## Run until we get a valid contract(s) or get bored waiting
         MAX_WAIT_SECONDS = 10
         new_contract_details = contract_details_queue.get(timeout = MAX_WAIT_SECONDS)
+        self._requests.release(reqId)
 
         while self.wrapper.is_error():
             print(self.get_error())
 
         if contract_details_queue.timed_out():
-            print("Exceeded maximum wait for wrapper to confirm finished - seems to be normal behaviour")
+            print("Exceeded maximum wait for wrapper to confirm finished")
+
+        if contract_details_queue.failed():
+            print(contract_details_queue.error)
 
         if len(new_contract_details)==0:
             print("Failed to get additional contract details: returning unresolved contract")
@@ -315,20 +898,37 @@ class TestClient(EClient):
 
         new_contract_details=new_contract_details[0]
 
-        resolved_ibcontract=new_contract_details.summary
+        resolved_ibcontract=contract_from_details(new_contract_details)
 
         return resolved_ibcontract
 
 
-    def start_getting_IB_market_data(self, resolved_ibcontract, tickerid=DEFAULT_MARKET_DATA_ID):
+    def start_getting_IB_market_data(self, resolved_ibcontract, tickerid=None,
+                                     capacity=DEFAULT_TICK_BUFFER_CAPACITY):
         """
         Kick off market data streaming
         :param resolved_ibcontract: a Contract object
-        :param tickerid: the identifier for the request
+        :param tickerid: the identifier for the request; if None we get a new unique one
+        :param capacity: how many ticks to keep; if we don't get them out in time the oldest are lost
         :return: tickerid
         """
 
-        self._market_data_q_dict[tickerid] = self.wrapper.init_market_data(tickerid)
+        ## Older gateways don't send tickReqParams, so we can't tell which subscription a tick is from
+        if self.isConnected() and self.serverVersion()>=MIN_SERVER_VER_REQ_SMART_COMPONENTS:
+            ## Until we know which generation this is, generation 0 won't let in ticks from any earlier subscription
+            ##    which used this tickerid
+            tick_buffer = tickRingBuffer(capacity, generation=0)
+        else:
+            tick_buffer = tickRingBuffer(capacity)
+
+        tickerid, tick_buffer = self._requests.new_request(tick_buffer, reqId=tickerid)
+
+        if tick_buffer.generation is not None:
+            generation = self._market_data_generations_requested.get(tickerid, 0) + 1
+            self._market_data_generations_requested[tickerid] = generation
+            tick_buffer.generation = generation
+
+        self._quote_table.add(tickerid)
         self.reqMktData(tickerid, resolved_ibcontract, "", False, False, [])
 
         return tickerid
@@ -340,42 +940,78 @@ class TestClient(EClient):
         :return: market data
         """
 
-        ## native EClient method
-        self.cancelMktData(tickerid)
+        return self.stop_getting_IB_market_data_batch([tickerid])[tickerid]
+
+    def stop_getting_IB_market_data_batch(self, list_of_tickerids):
+        """
+        Stops several streams of market data, and returns all the data we've had for each since we last asked
+
+        :param list_of_tickerids: identifiers for the requests
+        :return: dict, keys are tickerids, values are market data
+        """
 
-        ## Sometimes a lag whilst this happens, this prevents 'orphan' ticks appearing
-        time.sleep(5)
+        ## native EClient method; all the cancels go straight out, we don't wait for anything in between
+        for tickerid in list_of_tickerids:
+            self.cancelMktData(tickerid)
 
-        market_data = self.get_IB_market_data(tickerid)
+        ## Anything still on its way is dropped by the wrapper, even if we use the same tickerid again straight away,
+        ##    so we don't need to wait for the gateway to stop sending
+        all_market_data = {}
+        for tickerid in list_of_tickerids:
+            self._requests.channel(tickerid).retire()
+            self._quote_table.remove(tickerid)
+            all_market_data[tickerid] = self.get_IB_market_data(tickerid)
+            self._requests.release(tickerid)
 
         ## output ay errors
         while self.wrapper.is_error():
             print(self.get_error())
 
-        return market_data
+        return all_market_data
+
+    def latest_quote(self, tickerid):
+        """
+        The latest bid, ask, trade and volume for a stream, as of the last tick
+
+        :param tickerid: identifier for the request
+        :return: np.void with the fields in QUOTE_TABLE_DTYPE, eg quote["bid_price"]; None if we aren't streaming it
+        """
+
+        return self._quote_table.latest_quote(tickerid)
+
+    def latest_quotes(self):
+        """
+        The latest quote for every stream we have running
 
-    def get_IB_market_data(self, tickerid):
+        :return: np.array with dtype QUOTE_TABLE_DTYPE, one row per tickerid
+        """
+
+        return self._quote_table.latest_quotes()
+
+    def get_IB_market_data(self, tickerid, min_new_ticks=0, timeout=DEFAULT_MARKET_DATA_WAIT_SECONDS):
         """
         Takes all the market data we have received so far out of the stack, and clear the stack
+
+        Returns straight away with whatever has arrived, unless we ask it to wait for some ticks
+
         :param tickerid: identifier for the request
+        :param min_new_ticks: wait until we have at least this many ticks since we last asked, or until timeout
+        :param timeout: how long to wait for them, in seconds
         :return: market data
         """
 
-        ## how long to wait for next item
-        MAX_WAIT_MARKETDATEITEM = 5
-        market_data_q = self._market_data_q_dict[tickerid]
+        tick_buffer = self._requests.channel(tickerid)
 
-        market_data=[]
-        finished=False
+        market_data = tick_buffer.take(min_new_ticks, timeout)
 
-        while not finished:
-            try:
-                market_data.append(market_data_q.get(timeout=MAX_WAIT_MARKETDATEITEM))
-            except queue.Empty:
-                ## no more data
-                finished=True
+        if len(market_data)<min_new_ticks:
+            print("Exceeded maximum wait for market data: only got %d ticks" % len(market_data))
 
-        return stream_of_ticks(market_data)
+        if market_data.ticks_lost>0:
+            print("Lost %d ticks which arrived faster than we took them: use a bigger capacity" %
+                  market_data.ticks_lost)
+
+        return market_data
 
 
 class TestApp(TestWrapper, TestClient):
@@ -383,6 +1019,9 @@ class TestApp(TestWrapper, TestClient):
         TestWrapper.__init__(self)
         TestClient.__init__(self, wrapper=self)
 
+        ## before we connect, as the gateway sends data farm messages straight away
+        self.init_error()
+
         self.connect(ipaddress, portid, clientid)
 
         thread = Thread(target = self.run)
@@ -390,53 +1029,51 @@ class TestApp(TestWrapper, TestClient):
 
         setattr(self, "_thread", thread)
 
-        self.init_error()
-
-
-#if __name__ == '__main__':
-
-app = TestApp("127.0.0.1", 4001, 1)
 
-## lets get prices for this
-ibcontract = IBcontract()
-ibcontract.secType = "FUT"
-ibcontract.lastTradeDateOrContractMonth="201812"
-ibcontract.symbol="GE"
-ibcontract.exchange="GLOBEX"
+if __name__ == '__main__':
 
-## resolve the contract
-resolved_ibcontract = app.resolve_ib_contract(ibcontract)
+    app = TestApp("127.0.0.1", 4001, 1)
 
-tickerid = app.start_getting_IB_market_data(resolved_ibcontract)
+    ## lets get prices for this
+    ibcontract = IBcontract()
+    ibcontract.secType = "FUT"
+    ibcontract.lastTradeDateOrContractMonth="201812"
+    ibcontract.symbol="GE"
+    ibcontract.exchange="GLOBEX"
 
-time.sleep(30)
+    ## resolve the contract
+    resolved_ibcontract = app.resolve_ib_contract(ibcontract)
 
-## What have we got so far?
-market_data1 = app.get_IB_market_data(tickerid)
+    tickerid = app.start_getting_IB_market_data(resolved_ibcontract)
 
-print(market_data1[0])
+    time.sleep(30)
 
-market_data1_as_df = market_data1.as_pdDataFrame()
-print(market_data1_as_df)
+    ## What have we got so far?
+    market_data1 = app.get_IB_market_data(tickerid)
 
-time.sleep(30)
+    ## Where the market is right now
+    print(app.latest_quote(tickerid))
 
-## stops the stream and returns all the data we've got so far
-market_data2 = app.stop_getting_IB_market_data(tickerid)
+    print(market_data1[0])
 
-## glue the data together
-market_data2_as_df = market_data2.as_pdDataFrame()
-all_market_data_as_df = pd.concat([market_data1_as_df, market_data2_as_df])
+    market_data1_as_df = market_data1.as_pdDataFrame()
+    print(market_data1_as_df)
 
-## show some quotes
-some_quotes = all_market_data_as_df.resample("1S").last()[["bid_size", "bid_price", "ask_price", "ask_size"]]
-print(some_quotes.head(10))
+    time.sleep(30)
 
-## show some trades
-some_trades = all_market_data_as_df.resample("10L").last()[["last_trade_price", "last_trade_size"]]
-print(some_trades.head(10))
+    ## stops the stream and returns all the data we've got so far
+    market_data2 = app.stop_getting_IB_market_data(tickerid)
 
-app.disconnect()
+    ## glue the data together
+    market_data2_as_df = market_data2.as_pdDataFrame()
+    all_market_data_as_df = pd.concat([market_data1_as_df, market_data2_as_df])
 
+    ## show some quotes
+    some_quotes = all_market_data_as_df.resample("1S").last()[["bid_size", "bid_price", "ask_price", "ask_size"]]
+    print(some_quotes.head(10))
 
+    ## show some trades
+    some_trades = all_market_data_as_df.resample("10L").last()[["last_trade_price", "last_trade_size"]]
+    print(some_trades.head(10))
 
+    app.disconnect()
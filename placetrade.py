@@ -25,24 +25,29 @@ from ibapi.order import Order
 from ibapi.execution import ExecutionFilter
 
 import time
-from threading import Thread
+from threading import Thread, Condition, Lock
 import queue
 import datetime
 from copy import deepcopy
 
-## these are just arbitrary numbers in leiu of a policy on this sort of thing
-DEFAULT_MARKET_DATA_ID=50
-DEFAULT_GET_CONTRACT_ID=43
-DEFAULT_EXEC_TICKER=78
-
 ## marker for when queue is finished
 FINISHED = object()
 STARTED = object()
 TIME_OUT = object()
+## timed out, but with some data
+PARTIAL = object()
+## the gateway sent an error for this request
+FAILED = object()
+
+## reqIds are handed out from here upwards, high enough not to clash with broker order ids
+FIRST_REQUEST_ID=10000000
 
 ## This is the reqId IB API sends when a fill is received
 FILL_CODE=-1
 
+## This is the error code IB API sends to confirm an order has been cancelled
+ORDER_CANCELLED_CODE=202
+
 """
 Next section is 'scaffolding'
 
@@ -53,42 +58,210 @@ class finishableQueue(object):
     Creates a queue which will finish at some point
     """
 
-    def __init__(self, queue_to_finish):
+    def __init__(self):
 
-        self._queue = queue_to_finish
+        self._contents = []
+        self._finished = False
+        self._done_callbacks = []
+        self._condition = Condition()
         self.status = STARTED
+        self.error = None
+
+    def put(self, element):
+        """
+        Add an element; called from the wrapper, ie the thread running EClient.run
+
+        Putting FINISHED marks the queue as finished and wakes up anyone waiting in get()
+        """
+        done_callbacks = []
+
+        with self._condition:
+            if element is FINISHED:
+                self._finished = True
+                done_callbacks = self._done_callbacks
+                self._done_callbacks = []
+            else:
+                self._contents.append(element)
+
+            self._condition.notify_all()
+
+        for done_callback in done_callbacks:
+            done_callback()
+
+    def finish(self):
+        ## called by the wrapper when the relevant ...End method arrives
+        self.put(FINISHED)
+
+    def fail(self, error):
+        """
+        Called by the wrapper if the gateway sends an error for this request, so we don't wait for an End that
+        won't come
+
+        :param error: IBerror
+        """
+        with self._condition:
+            self.error = error
+
+        self.put(FINISHED)
+
+    def add_done_callback(self, done_callback):
+        """
+        Call done_callback() once the queue is finished, or straight away if it already is
+
+        It will usually be called from the wrapper thread, so it needs to be quick and thread safe
+        """
+        with self._condition:
+            already_finished = self._finished
+            if not already_finished:
+                self._done_callbacks.append(done_callback)
+
+        if already_finished:
+            done_callback()
 
     def get(self, timeout):
         """
-        Returns a list of queue elements once timeout is finished, or a FINISHED flag is received in the queue
+        Returns a list of queue elements as soon as a FINISHED flag is received, or once timeout is finished
+
+        The timeout is one overall deadline for the request, it doesn't restart every time an element arrives
 
         :param timeout: how long to wait before giving up
         :return: list of queue elements
         """
-        contents_of_queue=[]
-        finished=False
 
-        while not finished:
-            try:
-                current_element = self._queue.get(timeout=timeout)
-                if current_element is FINISHED:
-                    finished = True
-                    self.status = FINISHED
-                else:
-                    contents_of_queue.append(current_element)
-                    ## keep going and try and get more data
+        with self._condition:
+            finished = self._condition.wait_for(lambda: self._finished, timeout=timeout)
 
-            except queue.Empty:
-                ## If we hit a time out it's most probable we're not getting a finished element any time soon
-                ## give up and return what we have
-                finished = True
-                self.status = TIME_OUT
+            contents_of_queue = self._contents
+            self._contents = []
 
+        if finished and self.error is not None:
+            self.status = FAILED
+        elif finished:
+            self.status = FINISHED
+        elif len(contents_of_queue)>0:
+            ## we have some data but never got the end marker
+            self.status = PARTIAL
+        else:
+            self.status = TIME_OUT
 
         return contents_of_queue
 
     def timed_out(self):
-        return self.status is TIME_OUT
+        return self.status is TIME_OUT or self.status is PARTIAL
+
+    def partial(self):
+        return self.status is PARTIAL
+
+    def finished(self):
+        return self.status is FINISHED
+
+    def failed(self):
+        return self.status is FAILED
+
+## errors which are about the connection or the data farms, not about any one request
+CONNECTION_ERROR_CODES = [502, 504, 1100, 1101, 1102, 1300, 2103, 2104, 2105, 2106, 2107, 2108, 2110, 2119, 2157, 2158]
+
+
+def _is_warning(errorCode):
+    ## 2100-2199 are warnings; the request carries on regardless
+    return errorCode>=2100 and errorCode<2200
+
+
+class IBerror(object):
+    """
+    An error message from the gateway
+    """
+
+    def __init__(self, id, errorCode, errorString):
+        """
+        :param id: reqId or orderId the error is about, -1 if it isn't about anything in particular
+        :param errorCode: int
+        :param errorString: str
+        """
+
+        self.id = id
+        self.errorCode = errorCode
+        self.errorString = errorString
+        self.timestamp = datetime.datetime.now()
+
+    def __repr__(self):
+        return "IB error id %d errorcode %d string %s" % (self.id, self.errorCode, self.errorString)
+
+    def is_connection_error(self):
+        return self.id==-1 or self.errorCode in CONNECTION_ERROR_CODES
+
+
+
+class requestRegistry(object):
+    """
+    Hands out unique reqIds, and owns the channel (usually a finishableQueue) for each request in flight
+
+    The wrapper looks up the channel for whatever reqId it gets called with, so any number of requests can be
+    running at once over the same connection
+    """
+
+    def __init__(self, first_reqid=FIRST_REQUEST_ID):
+
+        self._lock = Lock()
+        self._next_reqid = first_reqid
+        self._channels = {}
+        self._times_requested = {}
+
+    def new_request(self, channel=None, reqId=None):
+        """
+        Register a new request
+
+        :param channel: where the wrapper will put the data; a new finishableQueue if not supplied
+        :param reqId: use this id rather than allocating one, eg if the caller wants a particular tickerid
+        :return: tuple reqId, channel
+        """
+
+        if channel is None:
+            channel = finishableQueue()
+
+        with self._lock:
+            if reqId is None:
+                reqId = self._next_reqid
+                self._next_reqid += 1
+            elif reqId in self._channels.keys():
+                raise Exception("reqId %d is already being used by a request in flight" % reqId)
+
+            self._channels[reqId] = channel
+            self._times_requested[reqId] = time.time()
+
+        return reqId, channel
+
+    def channel(self, reqId):
+        """
+        Called from the wrapper
+
+        :return: channel for reqId, or None if we never made this request or have released it
+        """
+        with self._lock:
+            return self._channels.get(reqId, None)
+
+    def release(self, reqId):
+        ## we're done with this request; anything else that arrives for it will be ignored
+        with self._lock:
+            self._channels.pop(reqId, None)
+            self._times_requested.pop(reqId, None)
+
+    def time_requested(self, reqId):
+        """
+        :return: time.time() when the request was registered, or None; any gap before it is sent is our queueing
+        """
+        with self._lock:
+            return self._times_requested.get(reqId, None)
+
+    def in_flight(self):
+        with self._lock:
+            return list(self._channels.keys())
+
+
+def contract_from_details(contract_details):
+    ## the resolved contract; older versions of the API call it summary
+    return getattr(contract_details, "contract", None) or contract_details.summary
+
 
 """
 Mergable objects are used to capture order and execution information which comes from different sources and needs
@@ -296,19 +469,23 @@ class TestWrapper(EWrapper):
     """
 
     def __init__(self):
-        self._my_contract_details = {}
-        self._my_requested_execution = {}
-
         ## We set these up as we could get things coming along before we run an init
         self._my_executions_stream = queue.Queue()
         self._my_commission_stream = queue.Queue()
-        self._my_open_orders = queue.Queue()
+        self._my_open_orders = finishableQueue()
+
+        ## errors about orders, keys are orderids
+        self._my_order_errors = {}
 
     ## error handling code
     def init_error(self):
         error_queue=queue.Queue()
         self._my_errors = error_queue
 
+        ## connectivity and data farm messages go here, rather than in with everything else
+        connection_error_queue=queue.Queue()
+        self._my_connection_errors = connection_error_queue
+
     def get_error(self, timeout=5):
         if self.is_error():
             try:
@@ -322,36 +499,89 @@ class TestWrapper(EWrapper):
         an_error_if=not self._my_errors.empty()
         return an_error_if
 
+    def get_connection_error(self, timeout=5):
+        if self.is_connection_error():
+            try:
+                return self._my_connection_errors.get(timeout=timeout)
+            except queue.Empty:
+                return None
+
+        return None
+
+    def is_connection_error(self):
+        a_connection_error_if=not self._my_connection_errors.empty()
+        return a_connection_error_if
+
     def error(self, id, errorCode, errorString):
         ## Overriden method
-        errormsg = "IB error id %d errorcode %d string %s" % (id, errorCode, errorString)
-        self._my_errors.put(errormsg)
+        ib_error = IBerror(id, errorCode, errorString)
 
+        if ib_error.is_connection_error():
+            self._my_connection_errors.put(ib_error)
+            return
 
-    ## get contract details code
-    def init_contractdetails(self, reqId):
-        contract_details_queue = self._my_contract_details[reqId] = queue.Queue()
+        if not _is_warning(errorCode):
+            ## If it's about a request we're waiting for, it fails now rather than when it times out
+            request_queue = self._requests.channel(id)
+            if request_queue is not None:
+                request_queue.fail(ib_error)
+                return
+
+        if id>=0 and id<FIRST_REQUEST_ID:
+            ## Not one of our requests, so it's about an order
+            order_errors = self._my_order_errors.setdefault(id, queue.Queue())
+            order_errors.put(ib_error)
+
+        self._my_errors.put(ib_error)
+
+    def get_order_errors(self, orderid):
+        """
+        Returns any errors we've had about an order since we last asked, and clears them
+
+        They will also have gone into the general error queue
+
+        :param orderid: broker orderid
+        :return: list of IBerror
+        """
 
-        return contract_details_queue
+        order_errors = self._my_order_errors.get(orderid, None)
+        if order_errors is None:
+            return []
+
+        list_of_errors = []
+        while not order_errors.empty():
+            try:
+                list_of_errors.append(order_errors.get(block=False))
+            except queue.Empty:
+                pass
 
+        return list_of_errors
+
+
+    ## get contract details code
+    ## the queue for each reqId is set up by the client, in its request registry
     def contractDetails(self, reqId, contractDetails):
         ## overridden method
 
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
+        contract_details_queue = self._requests.channel(reqId)
+        if contract_details_queue is None:
+            ## not something we asked for, or we've given up waiting for it
+            return
 
-        self._my_contract_details[reqId].put(contractDetails)
+        contract_details_queue.put(contractDetails)
 
     def contractDetailsEnd(self, reqId):
         ## overriden method
-        if reqId not in self._my_contract_details.keys():
-            self.init_contractdetails(reqId)
 
-        self._my_contract_details[reqId].put(FINISHED)
+        contract_details_queue = self._requests.channel(reqId)
+        if contract_details_queue is None:
+            return
+
+        contract_details_queue.finish()
 
     # orders
     def init_open_orders(self):
-        open_orders_queue = self._my_open_orders = queue.Queue()
+        open_orders_queue = self._my_open_orders = finishableQueue()
 
         return open_orders_queue
 
@@ -385,12 +615,12 @@ class TestWrapper(EWrapper):
         Overriden method
         """
 
-        self._my_open_orders.put(FINISHED)
+        self._my_open_orders.finish()
 
 
     """ Executions and commissions
 
-    requested executions get dropped into single queue: self._my_requested_execution[reqId]
+    requested executions get dropped into the queue the client registered for that reqId
     Those that arrive as orders are completed without a relevant reqId go into self._my_executions_stream
     All commissions go into self._my_commission_stream (could be requested or not)
 
@@ -399,11 +629,6 @@ class TestWrapper(EWrapper):
     """
 
 
-    def init_requested_execution_data(self, reqId):
-        execution_queue = self._my_requested_execution[reqId] = queue.Queue()
-
-        return execution_queue
-
     def access_commission_stream(self):
         ## Access to the 'permanent' queue for commissions
 
@@ -467,8 +692,14 @@ class TestWrapper(EWrapper):
         ## We eithier put this into a stream if its just happened, or store it for a specific request
         if reqId==FILL_CODE:
             self._my_executions_stream.put(execdata)
-        else:
-            self._my_requested_execution[reqId].put(execdata)
+            return
+
+        execution_queue = self._requests.channel(reqId)
+        if execution_queue is None:
+            ## not something we asked for, or we've given up waiting for it
+            return
+
+        execution_queue.put(execdata)
 
 
 
@@ -476,7 +707,11 @@ class TestWrapper(EWrapper):
         """
         No more orders to look at if execution details requested
         """
-        self._my_requested_execution[reqId].put(FINISHED)
+        execution_queue = self._requests.channel(reqId)
+        if execution_queue is None:
+            return
+
+        execution_queue.finish()
 
 
     ## order ids
@@ -516,16 +751,20 @@ class TestClient(EClient):
         self._market_data_q_dict = {}
         self._commissions=list_of_execInformation()
 
-    def resolve_ib_contract(self, ibcontract, reqId=DEFAULT_GET_CONTRACT_ID):
+        ## hands out reqIds, and keeps track of where the wrapper should put the data for each one
+        self._requests = requestRegistry()
+
+    def resolve_ib_contract(self, ibcontract, reqId=None):
 
         """
         From a partially formed contract, returns a fully fledged version
 
+        :param reqId: the identifier for the request; if None we get a new unique one
         :returns fully resolved IB contract
         """
 
         ## Make a place to store the data we're going to return
-        contract_details_queue = finishableQueue(self.init_contractdetails(reqId))
+        reqId, contract_details_queue = self._requests.new_request(reqId=reqId)
 
         print("Getting full contract details from the server... ")
 
@@ -534,12 +773,16 @@ class TestClient(EClient):
         ## Run until we get a valid contract(s) or get bored waiting
         MAX_WAIT_SECONDS = 10
         new_contract_details = contract_details_queue.get(timeout = MAX_WAIT_SECONDS)
+        self._requests.release(reqId)
 
         while self.wrapper.is_error():
             print(self.get_error())
 
         if contract_details_queue.timed_out():
-            print("Exceeded maximum wait for wrapper to confirm finished - seems to be normal behaviour")
+            print("Exceeded maximum wait for wrapper to confirm finished")
+
+        if contract_details_queue.failed():
+            print(contract_details_queue.error)
 
         if len(new_contract_details)==0:
             print("Failed to get additional contract details: returning unresolved contract")
@@ -550,7 +793,7 @@ class TestClient(EClient):
 
         new_contract_details=new_contract_details[0]
 
-        resolved_ibcontract=new_contract_details.summary
+        resolved_ibcontract=contract_from_details(new_contract_details)
 
         return resolved_ibcontract
 
@@ -626,7 +869,7 @@ class TestClient(EClient):
         """
 
         ## store the orders somewhere
-        open_orders_queue = finishableQueue(self.init_open_orders())
+        open_orders_queue = self.init_open_orders()
 
         ## You may prefer to use reqOpenOrders() which only retrieves orders for this client
         self.reqAllOpenOrders()
@@ -647,13 +890,15 @@ class TestClient(EClient):
         return open_orders_dict
 
 
-    def get_executions_and_commissions(self, reqId=DEFAULT_EXEC_TICKER, execution_filter = ExecutionFilter()):
+    def get_executions_and_commissions(self, reqId=None, execution_filter = ExecutionFilter()):
         """
         Returns a list of all executions done today with commission data
+
+        reqId is the identifier for the request; if None we get a new unique one
         """
 
         ## store somewhere
-        execution_queue = finishableQueue(self.init_requested_execution_data(reqId))
+        reqId, execution_queue = self._requests.new_request(reqId=reqId)
 
         ## We can change ExecutionFilter to subset different orders
         ## note this will also pull in commissions but we would use get_executions_with_commissions
@@ -662,6 +907,7 @@ class TestClient(EClient):
         ## Run until we get a terimination or get bored waiting
         MAX_WAIT_SECONDS = 10
         exec_list = list_of_execInformation(execution_queue.get(timeout = MAX_WAIT_SECONDS))
+        self._requests.release(reqId)
 
         while self.wrapper.is_error():
             print(self.get_error())
@@ -669,6 +915,9 @@ class TestClient(EClient):
         if execution_queue.timed_out():
             print("Exceeded maximum wait for wrapper to confirm finished whilst getting exec / commissions")
 
+        if execution_queue.failed():
+            print(execution_queue.error)
+
         ## Commissions will arrive seperately. We get all of them, but will only use those relevant for us
         commissions = self._all_commissions()
 
@@ -767,6 +1016,9 @@ class TestClient(EClient):
         ## Has to be an order placed by this client. I don't check this here -
         ## If you have multiple IDs then you you need to check this yourself.
 
+        ## Clear out anything from before, so we only see errors about the cancellation
+        self.get_order_errors(orderid)
+
         self.cancelOrder(orderid)
 
         ## Wait until order is cancelled
@@ -780,6 +1032,15 @@ class TestClient(EClient):
                 ## finally cancelled
                 finished = True
 
+            for order_error in self.get_order_errors(orderid):
+                if order_error.errorCode==ORDER_CANCELLED_CODE:
+                    ## confirmation that it's cancelled
+                    finished = True
+                elif not _is_warning(order_error.errorCode):
+                    ## eg can't find the order, or it can't be cancelled; no point waiting
+                    print("Couldn't cancel order %d: %s" % (orderid, str(order_error)))
+                    finished = True
+
             if (datetime.datetime.now() - start_time).seconds > MAX_WAIT_TIME_SECONDS:
                 print("Wrapper didn't come back with confirmation that order was cancelled!")
                 finished = True
@@ -790,7 +1051,7 @@ class TestClient(EClient):
 
         ## Cancels all orders, from all client ids.
         ## if you don't want to do this, then instead run .cancel_order over named IDs
-        app.reqGlobalCancel()
+        self.reqGlobalCancel()
 
         start_time=datetime.datetime.now()
         MAX_WAIT_TIME_SECONDS = 10
@@ -812,6 +1073,9 @@ class TestApp(TestWrapper, TestClient):
         TestWrapper.__init__(self)
         TestClient.__init__(self, wrapper=self)
 
+        ## before we connect, as the gateway sends data farm messages straight away
+        self.init_error()
+
         self.connect(ipaddress, portid, clientid)
 
         thread = Thread(target = self.run)
@@ -819,8 +1083,6 @@ class TestApp(TestWrapper, TestClient):
 
         setattr(self, "_thread", thread)
 
-        self.init_error()
-
 
 if __name__ == '__main__':
 